@@ -1,15 +1,147 @@
+import operator
+import re
+import threading
+import time
+from functools import reduce
+
+from bson import ObjectId
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .cache import get_version
 from .models import User, Team, Activity, Leaderboard, Workout
+from .mongo import get_db
+
+
+# Facet values and counts are recomputed at most this often per process
+FACET_CACHE_TTL = 300
+
+# Values listed per facet; the rest are still reachable through search
+FACET_MAX_VALUES = 50
+
+# Search terms used as prefixes. djongo turns startswith into an anchored
+# regex without escaping it, so other terms are matched exactly instead.
+_PREFIX_TERM = re.compile(r'^[\w -]+$')
+
+_facets = {}
+_facets_lock = threading.Lock()
+
+
+def get_facet_counts(collection, field, db=None):
+    """Return [(value, count)] for a changelist facet, most frequent first
+
+    One aggregation groups the collection by field and keeps the
+    FACET_MAX_VALUES largest groups, however many distinct values there
+    are. Results are cached for FACET_CACHE_TTL and dropped when the
+    collection's version is bumped by a write.
+    """
+    key = (collection, field, get_version(collection))
+    with _facets_lock:
+        item = _facets.get(key)
+    if item is not None and time.monotonic() - item[0] <= FACET_CACHE_TTL:
+        return item[1]
+
+    db = db if db is not None else get_db()
+    counts = [(row['_id'], row['count']) for row in db[collection].aggregate([
+        {'$match': {field: {'$nin': [None, '']}}},
+        {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1, '_id': 1}},
+        {'$limit': FACET_MAX_VALUES},
+    ], allowDiskUse=True)]
+    with _facets_lock:
+        for stale in [stale for stale in _facets if stale[:2] == key[:2]]:
+            del _facets[stale]
+        _facets[key] = (time.monotonic(), counts)
+    return counts
+
+
+class CachedFacetFilter(admin.SimpleListFilter):
+    """list_filter on a field's values, read from get_facet_counts
+
+    Replaces the default filter for plain fields, which lists the choices
+    with a SELECT DISTINCT over the whole collection on every page load.
+    """
+
+    field = None
+
+    def lookups(self, request, model_admin):
+        collection = model_admin.model._meta.db_table
+        return [(value, f'{value} ({count})') for value, count in get_facet_counts(collection, self.field)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.field: self.value()})
+        return queryset
+
+
+class ActivityTypeFilter(CachedFacetFilter):
+    title = 'type'
+    parameter_name = 'type'
+    field = 'type'
+
+
+class UserTeamFilter(CachedFacetFilter):
+    title = 'team'
+    parameter_name = 'team'
+    field = 'team'
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that counts an unfiltered changelist from collection metadata
+
+    estimated_document_count() reads the collection's stored count instead
+    of scanning it. Filtered changelists still count exactly, through the
+    indexes their search and facet filters are backed by.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where:
+            return super().count
+        return get_db()[self.object_list.model._meta.db_table].estimated_document_count()
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """ModelAdmin for collections too large to count or scan per page load"""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        return queryset.filter(self.get_search_filter(term)), False
+
+    def get_search_filter(self, term):
+        """Return the Q a search term filters on: an exact match on any of search_fields
+
+        Exact matches are answered by the index on each field, unlike the
+        default case-insensitive substring search.
+        """
+        return reduce(operator.or_, (Q(**{field: term}) for field in self.search_fields))
 
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(ScalableModelAdmin):
     list_display = ['name', 'email', 'team', 'total_points', 'created_at']
-    list_filter = ['team', 'created_at']
-    search_fields = ['name', 'email', 'username']
-    ordering = ['-total_points']
+    list_filter = [UserTeamFilter, 'created_at']
+    search_fields = ['email', 'name']
+    # _id ascending breaks ties, matching the total_points index
+    ordering = ['-total_points', '_id']
     readonly_fields = ['_id', 'created_at']
 
+    def get_search_filter(self, term):
+        """An email is matched exactly and anything else as a name prefix"""
+        if '@' in term:
+            return Q(email=term)
+        if _PREFIX_TERM.match(term):
+            return Q(name__startswith=term)
+        return Q(name=term)
+
 
 @admin.register(Team)
 class TeamAdmin(admin.ModelAdmin):
@@ -20,13 +152,21 @@ class TeamAdmin(admin.ModelAdmin):
 
 
 @admin.register(Activity)
-class ActivityAdmin(admin.ModelAdmin):
+class ActivityAdmin(ScalableModelAdmin):
     list_display = ['type', 'user_id', 'duration', 'calories_burned', 'points', 'date']
-    list_filter = ['type', 'date']
-    search_fields = ['user_id', 'type', 'notes']
+    list_filter = [ActivityTypeFilter, 'date']
+    search_fields = ['user_id', 'type']
     ordering = ['-date']
     readonly_fields = ['_id']
 
+    def get_search_filter(self, term):
+        """A user id is matched exactly and anything else as a type prefix"""
+        if ObjectId.is_valid(term):
+            return Q(user_id=term)
+        if _PREFIX_TERM.match(term):
+            return Q(type__startswith=term)
+        return Q(type=term)
+
 
 @admin.register(Leaderboard)
 class LeaderboardAdmin(admin.ModelAdmin):
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class OctofitTrackerConfig(AppConfig):
+    name = 'octofit_tracker'
+
+    def ready(self):
+        # The Mongo command and pool listeners only see clients created after
+        # they are registered, so register them before the first connection.
+        from . import monitoring  # noqa: F401
+        # Connects the signal receivers that invalidate cached responses
+        from . import cache  # noqa: F401
@@ -0,0 +1,207 @@
+import asyncio
+import functools
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.request import Request
+
+from .fast_serializers import FastSerializer
+from .models import Activity, Leaderboard, Team, User
+from .mongo import close_async_clients, get_async_db, id_variants
+from .pagination import KeysetPagination
+from .renderers import FastJSONRenderer
+from .serializers import ActivitySerializer, LeaderboardSerializer, TeamSerializer, UserSerializer
+from .stats import (
+    EMPTY_ACTIVITY_STATS,
+    USER_ACTIVITY_STATS,
+    format_activity_stats,
+    leaderboard_user_ids,
+    merge_leaderboard_stats
+)
+from .views import ActivityViewSet, LeaderboardViewSet
+
+
+USER_EXPANSIONS = ('team', 'stats', 'rank')
+
+
+def _json_response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(FastJSONRenderer().render(data), status=status_code, content_type='application/json')
+
+
+def async_api_view(view):
+    """Wrap an async GET view: DRF request parsing and APIException handling
+
+    The views below are async versions of the busiest read endpoints, with
+    the same response shapes. Served under ASGI they wait on Mongo without
+    holding a thread, and independent lookups run with asyncio.gather.
+    Under WSGI each request runs on an event loop of its own, so the motor
+    clients it opened are closed once it is served.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return _json_response(
+                {'detail': f'Method "{request.method}" not allowed.'}, status.HTTP_405_METHOD_NOT_ALLOWED,
+            )
+        try:
+            return await view(Request(request), *args, **kwargs)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return _json_response(detail, exc.status_code)
+        finally:
+            if not isinstance(request, ASGIRequest):
+                close_async_clients()
+    return wrapper
+
+
+def _documents(model, raw_documents):
+    """Fill missing fields with None, as DocumentQuery does"""
+    fields = [field.column for field in model._meta.concrete_fields]
+    return [{name: raw.get(name) for name in fields} for raw in raw_documents]
+
+
+async def _keyset_page(request, collection, model, query, ordering):
+    """Read one page of a keyset-paginated list; returns (paginator, rows)"""
+    paginator = KeysetPagination()
+    paginator.request = request
+    paginator.ordering = tuple(ordering)
+    paginator.page_size = paginator.get_page_size(request)
+    cursor = paginator.decode_cursor(request, model)
+    if cursor is not None:
+        keyset_filter = paginator.get_mongo_keyset_filter(cursor)
+        query = {'$and': [query, keyset_filter]} if query else keyset_filter
+
+    fields = [field.column for field in model._meta.concrete_fields]
+    sort = [(field.lstrip('-'), -1 if field.startswith('-') else 1) for field in ordering]
+    raw = await collection.find(query, {name: 1 for name in fields}, sort=sort).to_list(paginator.page_size + 1)
+
+    rows = _documents(model, raw)
+    paginator.has_next = len(rows) > paginator.page_size
+    paginator.page = rows[:paginator.page_size]
+    return paginator, paginator.page
+
+
+async def _leaderboard_stats(db, entries):
+    """get_leaderboard_stats, with users and teams read alongside the rollups"""
+    user_ids = leaderboard_user_ids(entries)
+    if not user_ids:
+        return {}
+
+    async def users_and_teams():
+        users = {
+            str(user['_id']): user
+            for user in await db.users.find(
+                {'_id': {'$in': id_variants(user_ids)}}, {'name': 1, 'team': 1},
+            ).to_list(None)
+        }
+        team_names = list({user['team'] for user in users.values() if user.get('team')})
+        teams = {}
+        if team_names:
+            teams = {
+                team['name']: team
+                for team in await db.teams.find({'name': {'$in': team_names}}, {'name': 1}).to_list(None)
+            }
+        return users, teams
+
+    async def activity_stats():
+        rows = await db[USER_ACTIVITY_STATS].find({'_id': {'$in': user_ids}}).to_list(None)
+        return format_activity_stats(rows)
+
+    (users, teams), stats = await asyncio.gather(users_and_teams(), activity_stats())
+    return merge_leaderboard_stats(user_ids, users, teams, stats)
+
+
+@async_api_view
+async def leaderboard_list(request):
+    """Async LeaderboardViewSet.list"""
+    db = get_async_db()
+    query = {}
+    if 'type' in request.query_params:
+        query['type'] = request.query_params['type']
+
+    paginator, entries = await _keyset_page(
+        request, db.leaderboard, Leaderboard, query, LeaderboardViewSet.keyset_ordering,
+    )
+    context = {'request': request, 'leaderboard_stats': await _leaderboard_stats(db, entries)}
+    results = FastSerializer(LeaderboardSerializer(context=context), entries, many=True).data
+    return _json_response({'next': paginator.get_next_link(), 'results': results})
+
+
+@async_api_view
+async def activity_list(request):
+    """Async ActivityViewSet.list"""
+    db = get_async_db()
+    query = {}
+    if 'user_id' in request.query_params:
+        query['user_id'] = request.query_params['user_id']
+    if 'type' in request.query_params:
+        query['type'] = request.query_params['type']
+
+    paginator, activities = await _keyset_page(
+        request, db.activities, Activity, query, ActivityViewSet.keyset_ordering,
+    )
+    results = FastSerializer(ActivitySerializer(context={'request': request}), activities, many=True).data
+    return _json_response({'next': paginator.get_next_link(), 'results': results})
+
+
+@async_api_view
+async def user_detail(request, pk):
+    """Async UserViewSet.retrieve
+
+    ?expand= takes a comma-separated subset of team, stats and rank and adds
+    team_detail, activity_stats and rank to the user. The team is looked up
+    once the user is read; the rollups and the rank are read at the same
+    time as the user.
+    """
+    expand = {name for name in request.query_params.get('expand', '').split(',') if name}
+    unknown = expand.difference(USER_EXPANSIONS)
+    if unknown:
+        raise ValidationError({'expand': f'Must be a subset of: {", ".join(USER_EXPANSIONS)}'})
+    try:
+        user_id = ObjectId(pk)
+    except (InvalidId, TypeError):
+        raise NotFound()
+
+    db = get_async_db()
+    fields = [field.column for field in User._meta.concrete_fields]
+    user_ids = [str(user_id)]
+
+    async def user_and_team():
+        user = await db.users.find_one({'_id': user_id}, {name: 1 for name in fields})
+        team = None
+        if user is not None and 'team' in expand and user.get('team'):
+            team = await db.teams.find_one({'name': user['team']})
+        return user, team
+
+    async def activity_stats():
+        if 'stats' not in expand:
+            return None
+        rows = await db[USER_ACTIVITY_STATS].find({'_id': {'$in': user_ids}}).to_list(None)
+        return format_activity_stats(rows)
+
+    async def rank():
+        if 'rank' not in expand:
+            return None
+        return await db.leaderboard.find_one(
+            {'type': 'individual', 'entity_id': {'$in': id_variants(user_ids)}}, {'rank': 1},
+        )
+
+    (user, team), stats, entry = await asyncio.gather(user_and_team(), activity_stats(), rank())
+    if user is None:
+        raise NotFound()
+
+    context = {'request': request}
+    data = FastSerializer(UserSerializer(context=context), _documents(User, [user])[0]).data
+    if 'team' in expand:
+        data['team_detail'] = None
+        if team is not None:
+            data['team_detail'] = FastSerializer(TeamSerializer(context=context), _documents(Team, [team])[0]).data
+    if 'stats' in expand:
+        data['activity_stats'] = {**EMPTY_ACTIVITY_STATS, 'total_points': 0, **stats.get(str(user_id), {})}
+    if 'rank' in expand:
+        data['rank'] = entry['rank'] if entry else None
+    return _json_response(data)
@@ -0,0 +1,235 @@
+from datetime import timedelta, timezone
+
+from .cache import bump_version
+from .indexes import create_indexes
+from .mongo import bulk_upsert_once, get_db, id_variants
+from .repository import CODEC_OPTIONS
+from .stats import activity_totals
+
+
+ACTIVITY_BUCKETS = 'activity_buckets'
+
+USER = 'user'
+TEAM = 'team'
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+GRANULARITIES = (DAY, WEEK, MONTH)
+
+REBUILD_CHUNK_SIZE = 5000
+
+TOTAL_FIELDS = ('activity_count', 'total_duration', 'total_distance', 'total_calories', 'total_points')
+
+# bucket_start as computed by bucket_start(), in aggregation form. Weeks are
+# ISO weeks, starting on Monday; all buckets are in UTC.
+_BUCKET_START_EXPRESSIONS = {
+    DAY: {'$dateFromParts': {
+        'year': {'$year': '$date'}, 'month': {'$month': '$date'}, 'day': {'$dayOfMonth': '$date'},
+    }},
+    WEEK: {'$dateFromParts': {
+        'isoWeekYear': {'$isoWeekYear': '$date'}, 'isoWeek': {'$isoWeek': '$date'}, 'isoDayOfWeek': 1,
+    }},
+    MONTH: {'$dateFromParts': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}, 'day': 1}},
+}
+
+_TOTAL_EXPRESSIONS = {
+    'activity_count': {'$sum': 1},
+    'total_duration': {'$sum': {'$ifNull': ['$duration', 0]}},
+    'total_distance': {'$sum': {'$ifNull': ['$distance', 0]}},
+    'total_calories': {'$sum': {'$ifNull': ['$calories_burned', 0]}},
+    'total_points': {'$sum': {'$ifNull': ['$points', 0]}},
+}
+
+
+def bucket_start(value, granularity):
+    """Return the UTC start of the day, ISO week or month holding value
+
+    Naive datetimes are taken as UTC, as Mongo stores them.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    day = value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == WEEK:
+        return day - timedelta(days=day.weekday())
+    if granularity == MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def get_user_teams(user_ids, db=None):
+    """Return the current team of each user, '' for none, keyed by user_id"""
+    user_ids = {str(user_id) for user_id in user_ids}
+    if not user_ids:
+        return {}
+    db = db if db is not None else get_db()
+    teams = dict.fromkeys(user_ids, '')
+    for user in db.users.find({'_id': {'$in': id_variants(user_ids)}}, {'team': 1}):
+        teams[str(user['_id'])] = user.get('team') or ''
+    return teams
+
+
+def apply_bucket_changes(changes, db=None, job_ids=None):
+    """Write (user_id, team, date, totals, sign) changes to every bucket they touch
+
+    Each activity counts towards its user's buckets and, when it was logged
+    in a team, that team's buckets, keyed by team name like the rest of the
+    API. Changes with a team of None, from activities stored before teams
+    were recorded on them, use the user's current team, read with one $in
+    lookup. All buckets are written with one unordered bulk_write of $inc
+    upserts. job_ids, keyed by user_id, mark the buckets so that a retried
+    job does not add its changes twice (see bulk_upsert_once). Returns the
+    number of bucket updates written.
+    """
+    changes = [change for change in changes if change[2] is not None]
+    if not changes:
+        return 0
+    db = db if db is not None else get_db()
+    job_ids = job_ids or {}
+    teams = get_user_teams({user_id for user_id, team, _, _, _ in changes if team is None}, db=db)
+
+    deltas = {}
+    for user_id, team, date, totals, sign in changes:
+        team = teams.get(user_id) if team is None else team
+        entities = [(USER, user_id)]
+        if team:
+            entities.append((TEAM, team))
+        for granularity in GRANULARITIES:
+            start = bucket_start(date, granularity)
+            for entity_type, entity_id in entities:
+                key = (entity_type, entity_id, granularity, start, job_ids.get(user_id))
+                bucket_deltas = deltas.setdefault(key, {})
+                for field, value in totals.items():
+                    bucket_deltas[field] = bucket_deltas.get(field, 0) + sign * value
+
+    upserts = []
+    for (entity_type, entity_id, granularity, start, job_id), bucket_deltas in deltas.items():
+        bucket_deltas = {field: value for field, value in bucket_deltas.items() if value}
+        if bucket_deltas:
+            upserts.append((
+                {'entity_type': entity_type, 'entity_id': entity_id, 'granularity': granularity,
+                 'bucket_start': start},
+                {'$inc': bucket_deltas},
+                job_id,
+            ))
+    if upserts:
+        bulk_upsert_once(db[ACTIVITY_BUCKETS], upserts)
+        bump_version(ACTIVITY_BUCKETS)
+    return len(upserts)
+
+
+def bucket_changes(previous=None, current=None):
+    """Return the (user_id, team, date, totals, sign) changes of an activity write
+
+    previous is the activity_snapshot taken before an update or delete and
+    current is the activity after a create or update. Both carry the team
+    stored on the activity, so a later team change of its user never moves
+    it out of the team buckets it was added to.
+    """
+    changes = []
+    if previous is not None:
+        changes.append((previous['user_id'], previous['team'], previous['date'], previous['totals'], -1))
+    if current is not None:
+        changes.append((str(current.user_id), current.team, current.date, activity_totals(current), 1))
+    return changes
+
+
+def apply_bucket_change(previous=None, current=None, db=None):
+    """Keep activity_buckets in step with an activity write"""
+    return apply_bucket_changes(bucket_changes(previous, current), db=db)
+
+
+def _bucket_pipeline(entity_type, granularity):
+    pipeline = []
+    if entity_type == TEAM:
+        # The team stored on the activity, or the user's current one for
+        # activities stored before teams were recorded on them
+        pipeline += [
+            {'$addFields': {'_user_id': {'$convert': {
+                'input': '$user_id', 'to': 'objectId', 'onError': None, 'onNull': None,
+            }}}},
+            {'$lookup': {'from': 'users', 'localField': '_user_id', 'foreignField': '_id', 'as': '_user'}},
+            {'$unwind': {'path': '$_user', 'preserveNullAndEmptyArrays': True}},
+            {'$addFields': {'_team': {'$ifNull': ['$team', '$_user.team']}}},
+            {'$match': {'_team': {'$nin': [None, '']}}},
+        ]
+        entity_id = '$_team'
+    else:
+        entity_id = {'$toString': '$user_id'}
+    return pipeline + [
+        {'$match': {'date': {'$type': 'date'}}},
+        {'$group': {
+            '_id': {'entity_id': entity_id, 'bucket_start': _BUCKET_START_EXPRESSIONS[granularity]},
+            **_TOTAL_EXPRESSIONS,
+        }},
+    ]
+
+
+def rebuild_activity_buckets(db=None):
+    """Recompute activity_buckets from the activities collection
+
+    Each (entity type, granularity) pair is one aggregation, streamed in
+    chunks into a staging collection that then replaces activity_buckets
+    in a single rename. Team buckets follow the team stored on each activity.
+    Returns the number of buckets written per granularity.
+    """
+    db = db if db is not None else get_db()
+    staging = db[f'{ACTIVITY_BUCKETS}_rebuild']
+    staging.drop()
+
+    counts = dict.fromkeys(GRANULARITIES, 0)
+    for entity_type in (USER, TEAM):
+        for granularity in GRANULARITIES:
+            chunk = []
+            for row in db.activities.aggregate(_bucket_pipeline(entity_type, granularity), allowDiskUse=True):
+                chunk.append({
+                    'entity_type': entity_type,
+                    'entity_id': row['_id']['entity_id'],
+                    'granularity': granularity,
+                    'bucket_start': row['_id']['bucket_start'],
+                    **{field: row[field] for field in TOTAL_FIELDS},
+                })
+                if len(chunk) >= REBUILD_CHUNK_SIZE:
+                    staging.insert_many(chunk, ordered=False)
+                    counts[granularity] += len(chunk)
+                    chunk = []
+            if chunk:
+                staging.insert_many(chunk, ordered=False)
+                counts[granularity] += len(chunk)
+
+    create_indexes(staging, ACTIVITY_BUCKETS)
+    if sum(counts.values()):
+        staging.rename(ACTIVITY_BUCKETS, dropTarget=True)
+    else:
+        db[ACTIVITY_BUCKETS].delete_many({})
+    bump_version(ACTIVITY_BUCKETS)
+    return counts
+
+
+def get_activity_buckets(entity_type, entity_id, granularity, since=None, until=None, db=None):
+    """Read the buckets of one user or team, oldest first
+
+    since is rounded down to the start of its bucket, so the bucket holding
+    it is included; until is exclusive. Buckets left empty by deletes are
+    skipped.
+    """
+    db = db if db is not None else get_db()
+    query = {'entity_type': entity_type, 'entity_id': str(entity_id), 'granularity': granularity}
+    if since is not None or until is not None:
+        query['bucket_start'] = {}
+        if since is not None:
+            query['bucket_start']['$gte'] = bucket_start(since, granularity)
+        if until is not None:
+            query['bucket_start']['$lt'] = until
+
+    collection = db.get_collection(ACTIVITY_BUCKETS, codec_options=CODEC_OPTIONS)
+    buckets = []
+    for row in collection.find(query, {'_id': 0, 'bucket_start': 1, **dict.fromkeys(TOTAL_FIELDS, 1)},
+                               sort=[('bucket_start', 1)]):
+        if row.get('activity_count', 0) <= 0:
+            continue
+        bucket = {'bucket_start': row['bucket_start']}
+        bucket.update({field: row.get(field, 0) for field in TOTAL_FIELDS})
+        bucket['total_distance'] = round(bucket['total_distance'], 2)
+        buckets.append(bucket)
+    return buckets
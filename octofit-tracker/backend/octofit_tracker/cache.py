@@ -0,0 +1,176 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import parse_etags
+
+
+RESPONSE_CACHE_MAX_ENTRIES = 512
+
+# Versions are kept per process, so writes made by other processes (another
+# worker, populate_db) reach cached responses only once they expire.
+RESPONSE_CACHE_TTL = 30
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_version(collection):
+    return _versions.get(collection, 0)
+
+
+def bump_version(*collections):
+    """Invalidate every cached response built from these collections"""
+    with _versions_lock:
+        for collection in collections:
+            _versions[collection] = _versions.get(collection, 0) + 1
+
+
+@receiver([post_save, post_delete], dispatch_uid='octofit_tracker.cache.bump_model_version')
+def bump_model_version(sender, **kwargs):
+    """Bump the collection of a model whenever it is written through the ORM"""
+    bump_version(sender._meta.db_table)
+
+
+def _etag_matches(request, etag):
+    """Whether If-None-Match holds etag; the comparison is weak, per RFC 9110"""
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return '*' in etags or any(candidate.removeprefix('W/') == etag for candidate in etags)
+
+
+class ResponseCache:
+    """Rendered responses kept in LRU order and dropped after a TTL
+
+    Keys embed the version of every collection a response was built from,
+    so a write makes the old entries unreachable; they age out through the
+    LRU instead of being searched for and deleted.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                del self._entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+            }
+
+
+response_cache = ResponseCache()
+
+
+class CachedResponseMixin:
+    """Serve repeated GET requests of a viewset from response_cache
+
+    Viewsets list in cache_collections every collection their responses
+    are read from. The cache is looked up once DRF's initial() has run, so
+    authentication, permissions, throttling and content negotiation apply
+    to hits as well; responses are keyed on the negotiated media type, and
+    those of authenticated users are not cached. A request whose
+    If-None-Match holds the current ETag gets a 304 from the cache, before
+    any query or serialization.
+    """
+    cache_collections = ()
+    cache_key = None
+
+    def is_cacheable(self, request):
+        return request.method == 'GET' and not request.user.is_authenticated and request.auth is None
+
+    def get_cache_key(self, request):
+        return (
+            request.scheme,
+            request.get_host(),
+            request.path,
+            tuple(sorted((name, tuple(values)) for name, values in request.GET.lists())),
+            request.accepted_media_type,
+            tuple(get_version(collection) for collection in self.cache_collections),
+        )
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.cache_key = None
+        if not self.is_cacheable(request):
+            return
+        self.cache_key = self.get_cache_key(request)
+        entry = response_cache.get(self.cache_key)
+        if entry is not None:
+            # dispatch() looks the handler up once initial() returns
+            self.get = lambda request, *args, **kwargs: self.cached_response(entry)
+
+    def cached_response(self, entry):
+        response = HttpResponse(entry['content'])
+        for header, value in entry['headers'].items():
+            response[header] = value
+        response['X-Cache'] = 'HIT'
+        response.cache_entry = entry
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.cache_key is None or response.status_code != 200 or response.streaming:
+            return response
+
+        entry = getattr(response, 'cache_entry', None)
+        if entry is None:
+            response.render()
+            entry = {
+                'content': response.content,
+                'headers': dict(response.items()),
+                'etag': '"%s"' % hashlib.sha1(response.content).hexdigest(),
+            }
+            response_cache.set(self.cache_key, entry)
+            response['X-Cache'] = 'MISS'
+
+        if _etag_matches(request, entry['etag']):
+            response_cache.record_not_modified()
+            response = HttpResponseNotModified()
+        response['ETag'] = entry['etag']
+        return response
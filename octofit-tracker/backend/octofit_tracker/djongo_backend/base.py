@@ -0,0 +1,37 @@
+from djongo import base
+
+from octofit_tracker.mongo import get_client
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """djongo's backend on top of the process-wide client of mongo.get_client
+
+    djongo closes its MongoClient whenever Django closes a connection, that
+    is after every request with the default CONN_MAX_AGE, so each request
+    used to open fresh sockets. Here the client, and its pool, outlive the
+    connection and are shared with the native query code.
+    """
+
+    def _client_options(self):
+        # Read from this wrapper's settings_dict: connections opened by
+        # Django itself, like the test runner's '__no_db__' one, are not
+        # registered under their alias
+        return self.settings_dict.get('CLIENT', {})
+
+    def get_new_connection(self, connection_params):
+        name = connection_params.pop('name')
+        enforce_schema = connection_params.pop('enforce_schema')
+        self.client_connection = get_client(self.alias, self._client_options())
+        self.djongo_connection = base.DjongoClient(self.client_connection[name], enforce_schema)
+        return self.client_connection[name]
+
+    def ensure_connection(self):
+        # After a fork get_client hands out a new client; drop the parent's
+        client = get_client(self.alias, self._client_options())
+        if self.connection is not None and self.client_connection is not client:
+            self.connection = None
+        super().ensure_connection()
+
+    def _close(self):
+        # The pool belongs to the process, not to this connection
+        pass
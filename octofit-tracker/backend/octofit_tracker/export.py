@@ -0,0 +1,89 @@
+from datetime import datetime, time, timezone as dt_timezone
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from .fast_serializers import FastSerializer
+from .mongo import get_db, id_variants
+from .repository import CODEC_OPTIONS
+from .serializers import ActivitySerializer
+
+
+EXPORT_BATCH_SIZE = 1000
+
+# Oldest first; served by the activity indexes walked backwards, so the
+# export never needs an in-memory sort
+EXPORT_ORDER = [('date', 1), ('_id', 1)]
+
+
+def parse_bound(value, name):
+    """Parse an ISO 8601 date or datetime query parameter into an aware datetime
+
+    A bare date means midnight UTC; naive datetimes are taken as UTC.
+    """
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime.combine(day, time.min) if day is not None else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: 'Must be an ISO 8601 date or datetime'})
+    if timezone.is_naive(parsed):
+        parsed = parsed.replace(tzinfo=dt_timezone.utc)
+    return parsed
+
+
+def export_query(user_id=None, activity_type=None, since=None, until=None):
+    """Build the Mongo filter of an export; since is inclusive, until exclusive"""
+    query = {}
+    if user_id is not None:
+        query['user_id'] = {'$in': id_variants([user_id])}
+    if activity_type is not None:
+        query['type'] = activity_type
+    if since is not None or until is not None:
+        query['date'] = {}
+        if since is not None:
+            query['date']['$gte'] = since
+        if until is not None:
+            query['date']['$lt'] = until
+    return query
+
+
+def iter_activity_batches(query, db=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield lists of serialized activities, batch_size at a time
+
+    Documents come from one cursor fetching batch_size documents per round
+    trip, so only a single batch is held in memory however many match.
+    """
+    db = db if db is not None else get_db()
+    serializer = FastSerializer(ActivitySerializer())
+    fields = [field.column for field in ActivitySerializer.Meta.model._meta.concrete_fields]
+    collection = db.get_collection('activities', codec_options=CODEC_OPTIONS)
+    cursor = collection.find(query, {name: 1 for name in fields}, sort=EXPORT_ORDER, batch_size=batch_size)
+    try:
+        batch = []
+        for document in cursor:
+            # Older documents may lack fields; export them as null like the API does
+            batch.append(serializer.to_representation({name: document.get(name) for name in fields}))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        cursor.close()
+
+
+def stream_ndjson(batches, renderer):
+    for batch in batches:
+        yield b''.join(renderer.render_rows(batch))
+
+
+def stream_csv(batches, renderer):
+    fields = list(ActivitySerializer.Meta.fields)
+    yield ''.join(renderer.render_rows([], fields)).encode(renderer.charset)
+    for batch in batches:
+        yield ''.join(renderer.render_rows(batch, fields, header=False)).encode(renderer.charset)
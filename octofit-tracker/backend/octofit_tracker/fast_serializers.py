@@ -0,0 +1,224 @@
+from datetime import datetime
+
+from rest_framework import ISO_8601, serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import SkipField
+from rest_framework.settings import api_settings
+
+from .monitoring import timed
+
+
+_MISSING = object()
+
+# Query parameter selecting the fields of list and retrieve responses
+FIELDS_PARAM = 'fields'
+
+# Field classes whose to_representation is a plain type conversion
+_CONVERTERS = {
+    serializers.CharField: str,
+    serializers.EmailField: str,
+    serializers.IntegerField: int,
+    serializers.FloatField: float,
+}
+
+_compiled = {}
+
+
+def _identity(value):
+    return value
+
+
+def _list_converter(child):
+    def convert(data):
+        return [None if item is None else child(item) for item in data]
+    return convert
+
+
+def _datetime_converter(field):
+    """DateTimeField.to_representation with the timezone looked up once"""
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return field.to_representation
+    field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if not isinstance(value, datetime) or value.tzinfo is None:
+            return field.to_representation(value)
+        try:
+            value = value.astimezone(field_timezone).isoformat()
+        except OverflowError:
+            return field.to_representation(value)
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return convert
+
+
+def _converter(field):
+    """Return a function doing field.to_representation for non-null values"""
+    if type(field) is serializers.DateTimeField:
+        return _datetime_converter(field)
+    if type(field) in _CONVERTERS:
+        return _CONVERTERS[type(field)]
+    if type(field) is serializers.JSONField and not field.binary:
+        return _identity
+    if type(field) is serializers.ListField:
+        return _list_converter(_converter(field.child))
+    return field.to_representation
+
+
+def _generic_value(field, row):
+    """Read one field the way Serializer.to_representation does"""
+    try:
+        attribute = field.get_attribute(row)
+    except SkipField:
+        return _MISSING
+    return None if attribute is None else field.to_representation(attribute)
+
+
+def compile_serializer(serializer_class):
+    """Build the extractors of a serializer class, once per process
+
+    Building the fields of a ModelSerializer is costly, so it is done once.
+    Returns (name, key, field) tuples in output order; key is the attribute
+    read from each row, or None for SerializerMethodFields and for fields
+    with a dotted or '*' source.
+    """
+    if serializer_class not in _compiled:
+        extractors = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            simple = len(field.source_attrs) == 1 and not isinstance(field, serializers.SerializerMethodField)
+            extractors.append((name, field.source_attrs[0] if simple else None, field))
+        _compiled[serializer_class] = extractors
+    return _compiled[serializer_class]
+
+
+def required_fields(serializer_class, names):
+    """Return the model fields read to output the named serializer fields
+
+    Method fields and fields without a simple source declare what they read
+    in the serializer's method_field_sources. Returns None when a named
+    field declares nothing, as it may then read any field.
+    """
+    sources = getattr(serializer_class, 'method_field_sources', {})
+    required = set()
+    for name, key, field in compile_serializer(serializer_class):
+        if name not in names:
+            continue
+        if key is not None:
+            required.add(key)
+        elif name in sources:
+            required.update(sources[name])
+        else:
+            return None
+    return required
+
+
+def _row_converter(serializer, field):
+    """Return a function of the whole row for fields without a simple key"""
+    if isinstance(field, serializers.SerializerMethodField):
+        return getattr(serializer, field.method_name)
+    return lambda row: _generic_value(field, row)
+
+
+class FastSerializer:
+    """Read-only stand-in for a ModelSerializer, for list and retrieve
+
+    Produces the same data as serializer.data, but each row goes through
+    a flat list of extractors compiled once per serializer class instead
+    of DRF's per-field get_attribute and to_representation calls. Rows can
+    be model instances, plain dicts or, when columns is given, tuples.
+    serializer supplies the context and the SerializerMethodField methods.
+    fields, a set of field names, limits the output to those fields; the
+    others are never read, so rows may omit them.
+    """
+
+    def __init__(self, serializer, instance=None, many=False, columns=None, fields=None):
+        self.serializer = serializer
+        self.instance = instance
+        self.many = many
+        self.columns = columns
+        self.extractors = [
+            (name, key, _converter(field) if key is not None else _row_converter(serializer, field), field)
+            for name, key, field in compile_serializer(type(serializer))
+            if fields is None or name in fields
+        ]
+
+    def to_representation(self, row):
+        if self.columns is not None:
+            row = dict(zip(self.columns, row))
+        if isinstance(row, dict):
+            get = row.get
+        else:
+            def get(key, default):
+                return getattr(row, key, default)
+
+        data = {}
+        for name, key, convert, field in self.extractors:
+            if key is None:
+                value = convert(row)
+            else:
+                value = get(key, _MISSING)
+                if value is _MISSING:
+                    value = _generic_value(field, row)
+                elif value is not None:
+                    value = convert(value)
+            if value is not _MISSING:
+                data[name] = value
+        return data
+
+    @property
+    def data(self):
+        with timed('serialize'):
+            if self.many:
+                return [self.to_representation(row) for row in self.instance]
+            return self.to_representation(self.instance)
+
+
+class FastReadMixin:
+    """Serialize the rows of read-only actions with FastSerializer
+
+    Only calls that pass the rows to serialize are switched, so the
+    browsable API still gets a regular serializer for its forms. These
+    actions also take ?fields=, a comma-separated list of serializer
+    fields: the output is trimmed to them and get_read_fields() tells the
+    queryset which model fields to load.
+    """
+    fast_actions = ('list', 'retrieve')
+
+    def get_sparse_fields(self):
+        """Return the set of serializer fields named by ?fields=, or None for all"""
+        if self.action not in self.fast_actions:
+            return None
+        names = {name.strip() for name in self.request.query_params.get(FIELDS_PARAM, '').split(',')}
+        names.discard('')
+        if not names:
+            return None
+        available = [name for name, _, _ in compile_serializer(self.get_serializer_class())]
+        unknown = names.difference(available)
+        if unknown:
+            raise ValidationError({FIELDS_PARAM: f'Unknown fields: {", ".join(sorted(unknown))}. '
+                                                 f'Must be a subset of: {", ".join(available)}'})
+        return names
+
+    def get_read_fields(self):
+        """Return the model fields needed by ?fields=, or None for all
+
+        The keyset ordering is always loaded, as the paginator builds the
+        next cursor from it.
+        """
+        fields = self.get_sparse_fields()
+        if fields is None:
+            return None
+        read_fields = required_fields(self.get_serializer_class(), fields)
+        if read_fields is None:
+            return None
+        return read_fields | {name.lstrip('-') for name in getattr(self, 'keyset_ordering', ())}
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action not in self.fast_actions or not args:
+            return super().get_serializer(*args, **kwargs)
+        many = kwargs.pop('many', False)
+        return FastSerializer(super().get_serializer(**kwargs), args[0], many=many, fields=self.get_sparse_fields())
@@ -0,0 +1,153 @@
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+from .mongo import get_db
+
+
+# Relative weight of a match in each field, shared by the workouts text
+# index and the in-memory index of octofit_tracker.search so that both rank
+# alike. Kept here, away from the models, so that the management commands'
+# worker processes can import this module before Django is set up.
+WORKOUT_FIELD_WEIGHTS = {'name': 10, 'exercises.name': 5, 'type': 3, 'description': 1}
+
+# Compound indexes backing every filter and keyset ordering used by the
+# viewsets, plus the lookups of the leaderboard engine and stats batches.
+# Equality fields come first, then the sort keys in keyset_ordering.
+INDEXES = {
+    'users': [
+        IndexModel([('email', ASCENDING)], unique=True),
+        IndexModel([('total_points', DESCENDING), ('_id', ASCENDING)]),
+        IndexModel([('team', ASCENDING), ('total_points', DESCENDING), ('_id', ASCENDING)]),
+        IndexModel([('name', ASCENDING)]),
+    ],
+    'teams': [
+        IndexModel([('total_points', DESCENDING), ('_id', ASCENDING)]),
+        IndexModel([('name', ASCENDING)]),
+    ],
+    'activities': [
+        IndexModel([('date', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('user_id', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('type', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('user_id', ASCENDING), ('type', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('notes', TEXT)]),
+    ],
+    'leaderboard': [
+        IndexModel([('rank', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('type', ASCENDING), ('rank', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('type', ASCENDING), ('points', DESCENDING), ('entity_id', ASCENDING)]),
+        IndexModel([('type', ASCENDING), ('entity_id', ASCENDING)], unique=True),
+    ],
+    'workouts': [
+        IndexModel([('created_at', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('type', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('difficulty', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([
+            ('type', ASCENDING), ('difficulty', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING),
+        ]),
+        IndexModel([(field, TEXT) for field in WORKOUT_FIELD_WEIGHTS], weights=WORKOUT_FIELD_WEIGHTS),
+    ],
+    'activity_buckets': [
+        IndexModel([
+            ('entity_type', ASCENDING), ('entity_id', ASCENDING), ('granularity', ASCENDING),
+            ('bucket_start', ASCENDING),
+        ], unique=True),
+    ],
+}
+
+_ENTITY = 'ffffffffffffffffffffffff'
+_SINCE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# (description, collection, filter, sort) for every query the API runs
+# against a collection that may grow large. ensure_indexes explains each one.
+QUERY_SHAPES = [
+    ('UserViewSet list', 'users', {}, [('total_points', -1), ('_id', 1)]),
+    ('UserViewSet list ?team=', 'users', {'team': 'Team'}, [('total_points', -1), ('_id', 1)]),
+    ('team total refresh', 'users', {'team': 'Team'}, None),
+    ('UserAdmin search by name prefix', 'users', {'name': {'$regex': '^Ali'}}, [('total_points', -1), ('_id', 1)]),
+    ('TeamViewSet list', 'teams', {}, [('total_points', -1), ('_id', 1)]),
+    ('leaderboard team lookup', 'teams', {'name': {'$in': ['Team']}}, None),
+    ('ActivityViewSet list', 'activities', {}, [('date', -1), ('_id', -1)]),
+    ('ActivityViewSet list ?user_id=', 'activities', {'user_id': _ENTITY}, [('date', -1), ('_id', -1)]),
+    ('ActivityViewSet list ?type=', 'activities', {'type': 'Running'}, [('date', -1), ('_id', -1)]),
+    (
+        'ActivityViewSet list ?user_id=&type=', 'activities',
+        {'user_id': _ENTITY, 'type': 'Running'}, [('date', -1), ('_id', -1)],
+    ),
+    (
+        'ActivityViewSet export ?user_id=&since=', 'activities',
+        {'user_id': {'$in': [_ENTITY]}, 'date': {'$gte': _SINCE}}, [('date', 1), ('_id', 1)],
+    ),
+    ('ActivityViewSet search ?q=&user_id=', 'activities', {'$text': {'$search': 'hill'}, 'user_id': _ENTITY}, None),
+    ('ActivityAdmin search by type prefix', 'activities', {'type': {'$regex': '^Run'}}, [('date', -1), ('_id', -1)]),
+    ('ActivityAdmin type facet count', 'activities', {'type': 'Running'}, None),
+    ('ActivityViewSet export ?type=', 'activities', {'type': 'Running'}, [('date', 1), ('_id', 1)]),
+    ('ActivityViewSet export ?since=', 'activities', {'date': {'$gte': _SINCE}}, [('date', 1), ('_id', 1)]),
+    (
+        'ActivityViewSet stats ?user_id=&since=', 'activity_buckets',
+        {'entity_type': 'user', 'entity_id': _ENTITY, 'granularity': 'week', 'bucket_start': {'$gte': _SINCE}},
+        [('bucket_start', 1)],
+    ),
+    ('LeaderboardViewSet list', 'leaderboard', {}, [('rank', 1), ('_id', 1)]),
+    ('LeaderboardViewSet list ?type=', 'leaderboard', {'type': 'individual'}, [('rank', 1), ('_id', 1)]),
+    ('leaderboard entry lookup', 'leaderboard', {'type': 'individual', 'entity_id': {'$in': [_ENTITY]}}, None),
+    (
+        'leaderboard move up', 'leaderboard',
+        {'type': 'individual', 'rank': {'$lt': 10}, '$or': [
+            {'points': {'$lt': 100}}, {'points': 100, 'entity_id': {'$gt': _ENTITY}},
+        ]},
+        [('points', -1), ('entity_id', 1)],
+    ),
+    ('leaderboard rank shift', 'leaderboard', {'type': 'individual', 'rank': {'$gte': 5, '$lt': 10}}, None),
+    ('WorkoutViewSet list', 'workouts', {}, [('created_at', -1), ('_id', -1)]),
+    ('WorkoutViewSet list ?type=', 'workouts', {'type': 'HIIT'}, [('created_at', -1), ('_id', -1)]),
+    ('WorkoutViewSet list ?difficulty=', 'workouts', {'difficulty': 'Beginner'}, [('created_at', -1), ('_id', -1)]),
+    (
+        'WorkoutViewSet list ?type=&difficulty=', 'workouts',
+        {'type': 'HIIT', 'difficulty': 'Beginner'}, [('created_at', -1), ('_id', -1)],
+    ),
+    ('WorkoutViewSet search ?q= on large catalogs', 'workouts', {'$text': {'$search': 'squats'}}, None),
+]
+
+
+def create_indexes(collection, name=None):
+    """Create the declared indexes of one collection; existing ones are kept"""
+    indexes = INDEXES.get(name or collection.name, [])
+    if indexes:
+        collection.create_indexes(indexes)
+    return indexes
+
+
+def ensure_indexes(db=None):
+    """Create every declared index and return the names per collection"""
+    db = db if db is not None else get_db()
+    return {
+        collection: [index.document['name'] for index in create_indexes(db[collection])]
+        for collection in INDEXES
+    }
+
+
+def _plan_stages(plan):
+    """Yield every stage name of a query plan tree"""
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _plan_stages(child)
+
+
+def explain_query_shapes(db=None, page_size=51):
+    """Explain every query shape and return (description, stages) pairs"""
+    db = db if db is not None else get_db()
+    plans = []
+    for description, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query).limit(page_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = cursor.explain()
+        plans.append((description, list(_plan_stages(explanation['queryPlanner']['winningPlan']))))
+    return plans
@@ -0,0 +1,79 @@
+from pymongo.errors import BulkWriteError
+from rest_framework.exceptions import ValidationError
+
+from .buckets import get_user_teams
+from .cache import bump_version
+from .jobs import schedule_activity_batch
+from .models import Activity
+from .mongo import get_db
+from .recommendations import user_profiles
+from .scoring import score_activity
+from .serializers import ActivitySerializer
+
+
+BULK_BATCH_SIZE = 500
+MAX_BULK_ITEMS = 10000
+
+
+def _activity_document(validated_data):
+    """Turn validated serializer data into an activities document"""
+    document = dict(validated_data)
+    for field in Activity._meta.concrete_fields:
+        if field.name in document:
+            continue
+        if field.has_default():
+            document[field.name] = field.get_default()
+        elif field.null:
+            document[field.name] = None
+    document['user_id'] = str(document['user_id'])
+    document.update(score_activity(document))
+    return document
+
+
+def ingest_activities(items, db=None):
+    """Validate and store many activities, returning one result per item
+
+    Items are validated with a single ActivitySerializer instance and
+    written in batches of BULK_BATCH_SIZE with an unordered insert_many, so
+    one bad document does not stop the rest of its batch. The rollup,
+    bucket and leaderboard updates of a batch are queued once per user,
+    like those of single activity writes.
+    """
+    db = db if db is not None else get_db()
+    serializer = ActivitySerializer()
+    results = [None] * len(items)
+
+    for start in range(0, len(items), BULK_BATCH_SIZE):
+        batch = []
+        for index in range(start, min(start + BULK_BATCH_SIZE, len(items))):
+            try:
+                if not isinstance(items[index], dict):
+                    raise ValidationError({'non_field_errors': ['Expected an object.']})
+                batch.append((index, _activity_document(serializer.run_validation(items[index]))))
+            except ValidationError as exc:
+                results[index] = {'index': index, 'status': 'invalid', 'errors': exc.detail}
+        if not batch:
+            continue
+        teams = get_user_teams({document['user_id'] for _, document in batch}, db=db)
+        for _, document in batch:
+            document['team'] = teams[document['user_id']]
+
+        failed = {}
+        try:
+            db.activities.insert_many([document for _, document in batch], ordered=False)
+        except BulkWriteError as exc:
+            failed = {error['index']: error.get('errmsg') for error in exc.details['writeErrors']}
+        bump_version('activities')
+
+        stored = []
+        for position, (index, document) in enumerate(batch):
+            if position in failed:
+                results[index] = {'index': index, 'status': 'failed', 'errors': failed[position]}
+            else:
+                results[index] = {'index': index, 'status': 'created', 'id': str(document['_id'])}
+                stored.append(document)
+
+        for user_id in schedule_activity_batch(stored):
+            user_profiles.invalidate(user_id)
+
+    return results
@@ -0,0 +1,330 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from bson import ObjectId
+from django.conf import settings
+
+from .buckets import apply_bucket_changes, bucket_changes
+from .leaderboard import add_user_points
+from .monitoring import histogram
+from .mongo import get_db
+from .stats import activity_deltas, activity_totals, apply_activity_deltas
+
+
+logger = logging.getLogger('octofit_tracker.jobs')
+
+# Worker threads per process; overridden by settings.JOB_WORKERS
+JOB_WORKERS = 2
+
+# Pending jobs of one kind handed to a handler at once
+JOB_BATCH_SIZE = 200
+
+# A job waits this long after its first submission, so that a burst of
+# writes to the same key is merged into it before it runs
+JOB_COALESCE_MS = 50
+
+# A failed job is retried, merged with whatever was submitted for its key
+# meanwhile, until it has been attempted this many times. Retry n waits
+# JOB_RETRY_DELAY_MS * 2 ** (n - 1).
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY_MS = 200
+
+# Seconds the queue is given to drain when the process exits
+JOB_DRAIN_TIMEOUT = 10
+
+# Upper bounds, in milliseconds, of the submit-to-applied lag histogram buckets
+JOB_LAG_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 5000, 30000)
+
+ACTIVITY_CHANGE = 'activity_change'
+
+
+class JobQueue:
+    """In-process queue of derived-data updates, applied in batches by worker threads
+
+    A job is a payload submitted for a (kind, key). Submitting a key that
+    is already pending merges the payload into the pending one with the
+    kind's merge function, so a burst of writes to one entity becomes one
+    job. Workers take up to JOB_BATCH_SIZE due jobs of a kind, once they
+    have waited JOB_COALESCE_MS, and pass them to the kind's handler as
+    {key: payload}. With settings.JOB_QUEUE_EAGER the handler runs inline
+    on submit instead.
+
+    The jobs of a failed batch are merged back into the pending ones and
+    retried with exponential backoff; after JOB_MAX_ATTEMPTS they are
+    logged and dropped. A handler must therefore be safe to run again
+    after failing partway through a batch. Pending jobs only live in memory, so those of a
+    killed process are lost too. The rebuild commands recompute everything
+    the queue maintains.
+    """
+
+    def __init__(self, batch_size=JOB_BATCH_SIZE, coalesce_ms=JOB_COALESCE_MS,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_delay_ms=JOB_RETRY_DELAY_MS):
+        self.batch_size = batch_size
+        self.coalesce_ms = coalesce_ms
+        self.max_attempts = max_attempts
+        self.retry_delay_ms = retry_delay_ms
+        self.handlers = {}
+        self.reset()
+
+    def reset(self):
+        """Drop the pending jobs, the workers and the metrics, as in a forked child"""
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # (kind, key) -> [payload, submitted at, due at, failed attempts]
+        self._pending = {}
+        self._workers = []
+        self._running = 0
+        self._draining = 0
+        self._stopped = False
+        self._counts = {
+            'submitted': 0, 'coalesced': 0, 'processed': 0, 'batches': 0, 'failed_batches': 0,
+            'retried': 0, 'dropped': 0,
+        }
+        self._lag_ms = 0.0
+        self._max_lag_ms = 0.0
+        self._lag_buckets = [0] * (len(JOB_LAG_BUCKETS_MS) + 1)
+
+    def register(self, kind, handler, merge):
+        """Set the handler of a kind and how two of its payloads for one key combine"""
+        self.handlers[kind] = (handler, merge)
+
+    def submit(self, kind, key, payload):
+        handler, merge = self.handlers[kind]
+        if getattr(settings, 'JOB_QUEUE_EAGER', False):
+            handler({key: payload})
+            return
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('The job queue is stopped')
+            self._start_workers()
+            self._counts['submitted'] += 1
+            pending = self._pending.get((kind, key))
+            if pending is None:
+                now = time.monotonic()
+                self._pending[(kind, key)] = [payload, now, now + self.coalesce_ms / 1000, 0]
+                self._changed.notify_all()
+            else:
+                pending[0] = merge(pending[0], payload)
+                self._counts['coalesced'] += 1
+
+    def _start_workers(self):
+        if self._workers:
+            return
+        for number in range(getattr(settings, 'JOB_WORKERS', JOB_WORKERS)):
+            worker = threading.Thread(target=self._work, name=f'octofit-jobs-{number}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _take_batch(self):
+        """Wait for a batch that is due and remove it from the pending jobs
+
+        Called with the lock held. Returns (kind, {key: pending job}), or
+        None once the queue is stopped and empty. Draining ignores the
+        coalescing and retry delays.
+        """
+        while True:
+            if self._pending:
+                kind, _ = first = min(self._pending, key=lambda job: self._pending[job][2])
+                now = time.monotonic()
+                wait = self._pending[first][2] - now
+                if wait <= 0 or self._draining or self._stopped:
+                    due = sorted(
+                        (job for job in self._pending if job[0] == kind and (
+                            self._pending[job][2] <= now or self._draining or self._stopped
+                        )),
+                        key=lambda job: self._pending[job][2],
+                    )
+                    self._running += 1
+                    return kind, {job[1]: self._pending.pop(job) for job in due[:self.batch_size]}
+                self._changed.wait(wait)
+            elif self._stopped:
+                return None
+            else:
+                self._changed.wait()
+
+    def _retry(self, kind, batch):
+        """Merge the jobs of a failed batch back into the pending ones; called with the lock held"""
+        _, merge = self.handlers[kind]
+        for key, (payload, submitted_at, _, attempts) in batch.items():
+            attempts += 1
+            if attempts >= self.max_attempts:
+                logger.error('Dropped %s job %r after %d attempts', kind, key, attempts)
+                self._counts['dropped'] += 1
+                continue
+            due_at = time.monotonic() + self.retry_delay_ms * 2 ** (attempts - 1) / 1000
+            pending = self._pending.get((kind, key))
+            if pending is None:
+                self._pending[(kind, key)] = [payload, submitted_at, due_at, attempts]
+            else:
+                # The failed payload came first, so it is merged in front
+                self._pending[(kind, key)] = [
+                    merge(payload, pending[0]), submitted_at, min(due_at, pending[2]), max(attempts, pending[3]),
+                ]
+            self._counts['retried'] += 1
+
+    def _work(self):
+        while True:
+            with self._lock:
+                taken = self._take_batch()
+            if taken is None:
+                return
+            kind, batch = taken
+            handler, _ = self.handlers[kind]
+            try:
+                handler({key: job[0] for key, job in batch.items()})
+                failed = False
+            except Exception:
+                logger.exception('Job batch of %d %s jobs failed', len(batch), kind)
+                failed = True
+            finished_at = time.monotonic()
+            with self._lock:
+                self._running -= 1
+                self._counts['batches'] += 1
+                if failed:
+                    self._counts['failed_batches'] += 1
+                    self._retry(kind, batch)
+                else:
+                    self._counts['processed'] += len(batch)
+                    for _, submitted_at, _, _ in batch.values():
+                        lag_ms = (finished_at - submitted_at) * 1000
+                        self._lag_ms += lag_ms
+                        self._max_lag_ms = max(self._max_lag_ms, lag_ms)
+                        self._lag_buckets[bisect_left(JOB_LAG_BUCKETS_MS, lag_ms)] += 1
+                self._changed.notify_all()
+
+    def flush(self, timeout=None):
+        """Run every pending job now and wait for them; returns False on timeout
+
+        Jobs that keep failing are retried without delay until dropped.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._draining += 1
+            self._changed.notify_all()
+            try:
+                while self._pending or self._running:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._changed.wait(remaining)
+                return True
+            finally:
+                self._draining -= 1
+
+    def stop(self, timeout=JOB_DRAIN_TIMEOUT):
+        """Apply the pending jobs and stop the workers, as the process exits"""
+        with self._lock:
+            self._stopped = True
+            self._changed.notify_all()
+            workers = self._workers
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+    def stats(self):
+        """Return the queue depth, throughput and lag of this process"""
+        with self._lock:
+            oldest = min((job[1] for job in self._pending.values()), default=None)
+            processed = self._counts['processed']
+            return {
+                'workers': len(self._workers),
+                'depth': len(self._pending),
+                'running_batches': self._running,
+                'oldest_pending_ms': round((time.monotonic() - oldest) * 1000, 3) if oldest is not None else 0.0,
+                **self._counts,
+                'mean_lag_ms': round(self._lag_ms / processed, 3) if processed else 0.0,
+                'max_lag_ms': round(self._max_lag_ms, 3),
+                'lag_histogram_ms': histogram(JOB_LAG_BUCKETS_MS, self._lag_buckets),
+            }
+
+
+def _merge_activity_changes(pending, payload):
+    """Combine two lists of activity changes of one user
+
+    A change attempted by a failed batch carries the job_id its writes are
+    marked with. It is kept apart from the changes submitted after it, as
+    summing them would make a retry skip the new ones wherever the failed
+    attempt got through.
+    """
+    if not pending or not payload or 'job_id' in pending[-1] or 'job_id' in payload[0]:
+        return pending + payload
+    last, first = pending[-1], payload[0]
+    deltas = dict(last['deltas'])
+    for field, value in first['deltas'].items():
+        deltas[field] = deltas.get(field, 0) + value
+    merged = {'deltas': deltas, 'bucket_changes': last['bucket_changes'] + first['bucket_changes']}
+    return pending[:-1] + [merged] + payload[1:]
+
+
+def _apply_activity_changes(batch):
+    """Apply the activity changes of a batch of users
+
+    Each change is given a job_id on its first attempt and every document
+    it writes is marked with it, so a retried batch skips the rollups,
+    points and buckets that the failed attempt already applied. Users with
+    more than one change, which only happens after a failure, have them
+    applied in order, one round each. The rollups and the buckets of a
+    round are written with one bulk_write each; each user's points are
+    credited to the leaderboard.
+    """
+    db = get_db()
+    for position in range(max(len(changes) for changes in batch.values())):
+        jobs = {user_id: changes[position] for user_id, changes in batch.items() if position < len(changes)}
+        for job in jobs.values():
+            job.setdefault('job_id', ObjectId())
+        job_ids = {user_id: job['job_id'] for user_id, job in jobs.items()}
+        apply_activity_deltas({user_id: job['deltas'] for user_id, job in jobs.items()}, db=db, job_ids=job_ids)
+        for user_id, job in jobs.items():
+            add_user_points(user_id, job['deltas'].get('total_points', 0), db=db, job_id=job['job_id'])
+        apply_bucket_changes(
+            [change for job in jobs.values() for change in job['bucket_changes']], db=db, job_ids=job_ids,
+        )
+
+
+job_queue = JobQueue()
+job_queue.register(ACTIVITY_CHANGE, _apply_activity_changes, _merge_activity_changes)
+os.register_at_fork(after_in_child=job_queue.reset)
+atexit.register(job_queue.stop)
+
+
+def schedule_activity_change(previous=None, current=None):
+    """Queue the rollup, bucket and leaderboard updates of an activity write
+
+    previous is the activity_snapshot taken before an update or delete and
+    current is the activity after a create or update. Returns the ids of
+    the users whose derived data changes.
+    """
+    jobs = {
+        user_id: {'deltas': user_deltas, 'bucket_changes': []}
+        for user_id, user_deltas in activity_deltas(previous, current).items()
+    }
+    for change in bucket_changes(previous, current):
+        jobs.setdefault(change[0], {'deltas': {}, 'bucket_changes': []})['bucket_changes'].append(change)
+    for user_id, job in jobs.items():
+        job_queue.submit(ACTIVITY_CHANGE, user_id, [job])
+    return list(jobs)
+
+
+def schedule_activity_batch(activities):
+    """Queue the rollup, bucket and leaderboard updates of many new activity documents
+
+    The changes are merged per user before they are submitted, as bulk
+    ingest stores many activities of each user at once. Returns the ids of
+    the users whose derived data changes.
+    """
+    jobs = {}
+    for activity in activities:
+        user_id = str(activity['user_id'])
+        totals = activity_totals(activity)
+        job = jobs.setdefault(user_id, {'deltas': {}, 'bucket_changes': []})
+        for field, value in totals.items():
+            job['deltas'][field] = job['deltas'].get(field, 0) + value
+        job['bucket_changes'].append((user_id, activity.get('team'), activity.get('date'), totals, 1))
+    for user_id, job in jobs.items():
+        job['deltas'] = {field: value for field, value in job['deltas'].items() if value}
+        job_queue.submit(ACTIVITY_CHANGE, user_id, [job])
+    return list(jobs)
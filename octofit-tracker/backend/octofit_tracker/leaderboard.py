@@ -0,0 +1,396 @@
+import bisect
+import threading
+import time
+
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+from .cache import bump_version
+from .indexes import create_indexes
+from .mongo import apply_once, get_db, id_variants
+from .teams import move_team_member
+
+
+INDIVIDUAL = 'individual'
+TEAM = 'team'
+LEADERBOARD_TYPES = (INDIVIDUAL, TEAM)
+
+# Entries are ordered by points (highest first) and then by entity_id, so
+# every entity has exactly one position and ranks never tie.
+RANK_ORDER = [('points', DESCENDING), ('entity_id', ASCENDING)]
+REVERSE_RANK_ORDER = [('points', ASCENDING), ('entity_id', DESCENDING)]
+
+REBUILD_CHUNK_SIZE = 5000
+
+# Rank shifts are serialized per leaderboard type within this process;
+# rebuild_leaderboard repairs any drift caused by writers in other processes.
+_locks = {entry_type: threading.Lock() for entry_type in LEADERBOARD_TYPES}
+
+# Writes made by other processes reach the in-memory index only when it is
+# reloaded, so it is dropped after this many seconds.
+INDEX_MAX_AGE = 60
+
+
+def entity_key(entity_id):
+    """Return the form every leaderboard entry stores its entity_id in
+
+    Ties are broken on entity_id, and Mongo orders values of different BSON
+    types by type before value, so a user's ObjectId and a string id would
+    not interleave the way LeaderboardIndex sorts them. Every writer, and
+    the rebuild, stores it as a string.
+    """
+    return str(entity_id)
+
+
+class LeaderboardIndex:
+    """In-memory ranking of one leaderboard type
+
+    Keeps the entries in a sorted list keyed on (-points, entity_id), the
+    same order as RANK_ORDER, so rank lookups are a binary search and top-K
+    and "around me" queries are slices.
+    """
+
+    def __init__(self, entry_type):
+        self.entry_type = entry_type
+        self.loaded_at = None
+        self._keys = []
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > INDEX_MAX_AGE
+
+    def load(self, db=None):
+        """Replace the index contents with the stored leaderboard"""
+        db = db if db is not None else get_db()
+        entries = {}
+        for doc in db.leaderboard.find({'type': self.entry_type}, {'entity_id': 1, 'name': 1, 'points': 1}):
+            entries[entity_key(doc['entity_id'])] = (doc.get('points') or 0, doc.get('name', ''))
+        keys = sorted((-points, entity_id) for entity_id, (points, _) in entries.items())
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, entity_id, name, points):
+        entity_id = entity_key(entity_id)
+        with self._lock:
+            previous = self._entries.get(entity_id)
+            if previous is not None:
+                del self._keys[bisect.bisect_left(self._keys, (-previous[0], entity_id))]
+            bisect.insort(self._keys, (-points, entity_id))
+            self._entries[entity_id] = (points, name)
+
+    def remove(self, entity_id):
+        entity_id = entity_key(entity_id)
+        with self._lock:
+            previous = self._entries.pop(entity_id, None)
+            if previous is not None:
+                del self._keys[bisect.bisect_left(self._keys, (-previous[0], entity_id))]
+
+    def _entry(self, position):
+        points, entity_id = self._keys[position]
+        return {
+            'type': self.entry_type,
+            'entity_id': entity_id,
+            'name': self._entries[entity_id][1],
+            'points': -points,
+            'rank': position + 1,
+        }
+
+    def rank(self, entity_id):
+        """Return the entry of an entity with its 1-based rank, or None"""
+        entity_id = entity_key(entity_id)
+        with self._lock:
+            current = self._entries.get(entity_id)
+            if current is None:
+                return None
+            return self._entry(bisect.bisect_left(self._keys, (-current[0], entity_id)))
+
+    def top(self, k):
+        with self._lock:
+            return [self._entry(position) for position in range(min(k, len(self._keys)))]
+
+    def around(self, entity_id, window):
+        """Return up to window entries on each side of an entity, or None"""
+        entity_id = entity_key(entity_id)
+        with self._lock:
+            current = self._entries.get(entity_id)
+            if current is None:
+                return None
+            position = bisect.bisect_left(self._keys, (-current[0], entity_id))
+            start = max(position - window, 0)
+            stop = min(position + window + 1, len(self._keys))
+            return [self._entry(index) for index in range(start, stop)]
+
+
+_indexes = {entry_type: LeaderboardIndex(entry_type) for entry_type in LEADERBOARD_TYPES}
+
+
+def get_index(entry_type, db=None):
+    """Return the in-memory index of a leaderboard type, loading it if needed"""
+    index = _indexes[entry_type]
+    if index.is_stale():
+        index.load(db=db)
+    return index
+
+
+def reset_indexes():
+    """Drop the in-memory indexes so the next read reloads them"""
+    for index in _indexes.values():
+        index.loaded_at = None
+
+
+def _ranked_ahead_of(points, entity_id):
+    return {'$or': [
+        {'points': {'$gt': points}},
+        {'points': points, 'entity_id': {'$lt': entity_id}},
+    ]}
+
+
+def _ranked_behind(points, entity_id):
+    return {'$or': [
+        {'points': {'$lt': points}},
+        {'points': points, 'entity_id': {'$gt': entity_id}},
+    ]}
+
+
+def update_entry(entry_type, entity_id, name, points, db=None):
+    """Insert or move a leaderboard entry and return its new rank
+
+    Only the entries between the old and the new position have their rank
+    shifted, with a single update_many, so a small change in points touches
+    a handful of documents however large the leaderboard is.
+    """
+    db = db if db is not None else get_db()
+    entity_id = entity_key(entity_id)
+    collection = db.leaderboard
+
+    with _locks[entry_type]:
+        entry = collection.find_one(
+            {'type': entry_type, 'entity_id': {'$in': id_variants([entity_id])}},
+            {'rank': 1, 'points': 1},
+        )
+
+        if entry is None:
+            below = collection.find_one(
+                {'type': entry_type, **_ranked_behind(points, entity_id)},
+                {'rank': 1}, sort=RANK_ORDER,
+            )
+            if below is not None:
+                new_rank = below['rank']
+                collection.update_many(
+                    {'type': entry_type, 'rank': {'$gte': new_rank}},
+                    {'$inc': {'rank': 1}},
+                )
+            else:
+                last = collection.find_one({'type': entry_type}, {'rank': 1}, sort=[('rank', DESCENDING)])
+                new_rank = last['rank'] + 1 if last else 1
+            collection.insert_one({
+                'type': entry_type,
+                'entity_id': entity_id,
+                'name': name,
+                'points': points,
+                'rank': new_rank,
+                'updated_at': timezone.now(),
+            })
+            _indexes[entry_type].update(entity_id, name, points)
+            bump_version('leaderboard')
+            return new_rank
+
+        old_rank = entry['rank']
+        new_rank = old_rank
+        if points > entry['points']:
+            # Moving up: everyone we overtook drops one place
+            passed = collection.find_one(
+                {'type': entry_type, 'rank': {'$lt': old_rank}, **_ranked_behind(points, entity_id)},
+                {'rank': 1}, sort=RANK_ORDER,
+            )
+            if passed is not None:
+                new_rank = passed['rank']
+                collection.update_many(
+                    {'type': entry_type, 'rank': {'$gte': new_rank, '$lt': old_rank}},
+                    {'$inc': {'rank': 1}},
+                )
+        elif points < entry['points']:
+            # Moving down: everyone who overtook us climbs one place
+            passed = collection.find_one(
+                {'type': entry_type, 'rank': {'$gt': old_rank}, **_ranked_ahead_of(points, entity_id)},
+                {'rank': 1}, sort=REVERSE_RANK_ORDER,
+            )
+            if passed is not None:
+                new_rank = passed['rank']
+                collection.update_many(
+                    {'type': entry_type, 'rank': {'$gt': old_rank, '$lte': new_rank}},
+                    {'$inc': {'rank': -1}},
+                )
+
+        collection.update_one({'_id': entry['_id']}, {'$set': {
+            'entity_id': entity_id,
+            'name': name,
+            'points': points,
+            'rank': new_rank,
+            'updated_at': timezone.now(),
+        }})
+        _indexes[entry_type].update(entity_id, name, points)
+        bump_version('leaderboard')
+        return new_rank
+
+
+def remove_entry(entry_type, entity_id, db=None):
+    """Remove an entity from a leaderboard and close the gap it leaves"""
+    db = db if db is not None else get_db()
+    collection = db.leaderboard
+
+    with _locks[entry_type]:
+        entry = collection.find_one_and_delete(
+            {'type': entry_type, 'entity_id': {'$in': id_variants([entity_id])}},
+            projection={'rank': 1},
+        )
+        if entry is not None:
+            collection.update_many(
+                {'type': entry_type, 'rank': {'$gt': entry['rank']}},
+                {'$inc': {'rank': -1}},
+            )
+        _indexes[entry_type].remove(entity_id)
+        bump_version('leaderboard')
+
+
+def add_team_points(team_name, delta, db=None, job_id=None):
+    """Add delta points to a team, found by name, and re-rank it
+
+    With a job_id, a team the job was already applied to is only re-ranked
+    (see apply_once).
+    """
+    if not team_name or not delta:
+        return
+    db = db if db is not None else get_db()
+    team = db.teams.find_one_and_update(
+        *apply_once(job_id, {'name': team_name}, {'$inc': {'total_points': delta}}),
+        projection={'name': 1, 'total_points': 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if team is None and job_id is not None:
+        team = db.teams.find_one({'name': team_name}, {'name': 1, 'total_points': 1})
+    bump_version('teams')
+    if team is not None:
+        update_entry(TEAM, team['_id'], team['name'], team['total_points'], db=db)
+
+
+def add_user_points(user_id, delta, db=None, job_id=None):
+    """Add delta points to a user and their team and re-rank both
+
+    With a job_id, a user or team the job was already applied to is only
+    re-ranked (see apply_once), so a retried job credits the points once.
+    """
+    if not delta:
+        return
+    db = db if db is not None else get_db()
+    query = {'_id': {'$in': id_variants([user_id])}}
+    projection = {'name': 1, 'team': 1, 'total_points': 1}
+    user = db.users.find_one_and_update(
+        *apply_once(job_id, query, {'$inc': {'total_points': delta}}),
+        projection=projection,
+        return_document=ReturnDocument.AFTER,
+    )
+    if user is None and job_id is not None:
+        user = db.users.find_one(query, projection)
+    bump_version('users')
+    if user is not None:
+        update_entry(INDIVIDUAL, user['_id'], user['name'], user['total_points'], db=db)
+        add_team_points(user.get('team'), delta, db=db, job_id=job_id)
+
+
+def user_snapshot(user):
+    """Capture the leaderboard-relevant fields of a user before it changes"""
+    return {'id': str(user._id), 'team': user.team, 'total_points': user.total_points or 0}
+
+
+def apply_user_change(previous=None, current=None, db=None):
+    """Re-rank a user, and move their points and membership between teams
+
+    previous is a user_snapshot taken before an update or delete and current
+    is the saved User after a create or update.
+    """
+    db = db if db is not None else get_db()
+    if current is not None:
+        update_entry(INDIVIDUAL, current._id, current.name, current.total_points or 0, db=db)
+    elif previous is not None:
+        remove_entry(INDIVIDUAL, previous['id'], db=db)
+
+    team_deltas = {}
+    if previous is not None and previous['team']:
+        team_deltas[previous['team']] = team_deltas.get(previous['team'], 0) - previous['total_points']
+    if current is not None and current.team:
+        team_deltas[current.team] = team_deltas.get(current.team, 0) + (current.total_points or 0)
+    for team_name, delta in team_deltas.items():
+        add_team_points(team_name, delta, db=db)
+
+    user_id = current._id if current is not None else previous['id']
+    move_team_member(
+        user_id,
+        previous['team'] if previous is not None else None,
+        current.team if current is not None else None,
+        db=db,
+    )
+
+
+def apply_team_change(team=None, team_id=None, db=None):
+    """Re-rank a team after a write, or drop it when it was deleted"""
+    if team is not None:
+        update_entry(TEAM, team._id, team.name, team.total_points or 0, db=db)
+    elif team_id is not None:
+        remove_entry(TEAM, team_id, db=db)
+
+
+def rebuild_leaderboard(db=None):
+    """Recompute every leaderboard entry from users and teams
+
+    Entities are streamed from Mongo already sorted by points and _id (an
+    ObjectId sorts like its hex string, so this matches RANK_ORDER) and are
+    written in chunks to a staging collection, which then replaces
+    leaderboard in a single rename. Memory use does not grow with the
+    number of users, and readers never see a partial board. Returns the
+    number of entries written per leaderboard type.
+    """
+    db = db if db is not None else get_db()
+    staging = db['leaderboard_rebuild']
+    staging.drop()
+
+    sources = {INDIVIDUAL: db.users, TEAM: db.teams}
+    counts = {}
+    updated_at = timezone.now()
+    for entry_type, source in sources.items():
+        ranked = source.aggregate([
+            {'$project': {'name': 1, 'points': {'$ifNull': ['$total_points', 0]}}},
+            {'$sort': {'points': -1, '_id': 1}},
+        ], allowDiskUse=True)
+        chunk = []
+        rank = 0
+        for rank, doc in enumerate(ranked, 1):
+            chunk.append({
+                'type': entry_type,
+                'entity_id': entity_key(doc['_id']),
+                'name': doc.get('name', ''),
+                'points': doc['points'],
+                'rank': rank,
+                'updated_at': updated_at,
+            })
+            if len(chunk) >= REBUILD_CHUNK_SIZE:
+                staging.insert_many(chunk, ordered=False)
+                chunk = []
+        if chunk:
+            staging.insert_many(chunk, ordered=False)
+        counts[entry_type] = rank
+
+    create_indexes(staging, 'leaderboard')
+    if sum(counts.values()):
+        staging.rename('leaderboard', dropTarget=True)
+    else:
+        db.leaderboard.delete_many({})
+    reset_indexes()
+    bump_version('leaderboard')
+    return counts
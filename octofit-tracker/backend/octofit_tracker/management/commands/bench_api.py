@@ -0,0 +1,196 @@
+import io
+import json
+import math
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from octofit_tracker.leaderboard import reset_indexes
+from octofit_tracker.mongo import get_db
+from octofit_tracker.monitoring import record_commands
+from octofit_tracker.urls import router
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, math.ceil(percent / 100 * len(values)) - 1)
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark every GET route of the API router at several dataset sizes '
+        'and write latency, Mongo command and memory figures as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+            help='Numbers of users to seed, one benchmark round per size',
+        )
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per endpoint')
+        parser.add_argument('--activities-per-user', type=int, default=10)
+        parser.add_argument('--workers', type=int, default=1, help='Processes used to seed data')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--database-name', default='octofit_bench',
+            help='Database to seed and benchmark; it is overwritten',
+        )
+        parser.add_argument('--output', default='bench_results.json', help='Where to write the results')
+        parser.add_argument('--baseline', help='Results file to compare against')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Allowed relative p95 slowdown before a result counts as a regression',
+        )
+        parser.add_argument('--keep-data', action='store_true', help='Do not drop the benchmark database')
+
+    def handle(self, *args, **options):
+        connection = connections['default']
+        original_name = connection.settings_dict['NAME']
+        if options['database_name'] == original_name:
+            raise CommandError('Refusing to benchmark against the main database; pick another --database-name')
+
+        results = {}
+        connection.close()
+        connection.settings_dict['NAME'] = options['database_name']
+        try:
+            for size in options['sizes']:
+                self.stdout.write(f'Seeding {size} users...')
+                call_command(
+                    'populate_db',
+                    users=size,
+                    teams=max(1, size // 100),
+                    activities_per_user=options['activities_per_user'],
+                    seed=options['seed'],
+                    workers=options['workers'],
+                    stdout=io.StringIO(),
+                )
+                reset_indexes()
+                results[str(size)] = self.bench_endpoints(options['requests'])
+                self.write_table(size, results[str(size)])
+            if not options['keep_data']:
+                get_db().client.drop_database(options['database_name'])
+        finally:
+            connection.close()
+            connection.settings_dict['NAME'] = original_name
+
+        report = {
+            'meta': {
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'requests': options['requests'],
+                'activities_per_user': options['activities_per_user'],
+                'seed': options['seed'],
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = self.compare(json.load(baseline)['results'], results, options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def get_endpoints(self, client):
+        """Return (name, url) for every GET route registered on the router
+
+        Detail routes are pointed at the first object of the matching list
+        route; extra detail actions on the leaderboard take its entity_id.
+        """
+        endpoints = []
+        for prefix, viewset, basename in router.registry:
+            list_url = reverse(f'{basename}-list')
+            endpoints.append((f'{basename}-list', list_url))
+            response = client.get(list_url, {'page_size': 1})
+            rows = response.json().get('results', []) if response.status_code == 200 else []
+            sample = rows[0] if rows else None
+            if sample is not None:
+                endpoints.append((f'{basename}-detail', reverse(f'{basename}-detail', args=[sample['id']])))
+
+            for action in viewset.get_extra_actions():
+                if 'get' not in action.mapping:
+                    continue
+                name = f'{basename}-{action.url_name}'
+                if not action.detail:
+                    endpoints.append((name, reverse(name)))
+                elif sample is not None:
+                    endpoints.append((name, reverse(name, args=[sample.get('entity_id', sample['id'])])))
+        return endpoints
+
+    def bench_endpoints(self, requests):
+        client = Client(SERVER_NAME='localhost')
+        results = {}
+        for name, url in self.get_endpoints(client):
+            # Warm caches and lazily loaded indexes before timing
+            client.get(url)
+
+            latencies = []
+            commands = []
+            status_code = None
+            for _ in range(requests):
+                with record_commands() as recording:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                commands.append(len(recording))
+                status_code = response.status_code
+
+            tracemalloc.start()
+            client.get(url)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            latencies.sort()
+            results[name] = {
+                'url': url,
+                'status': status_code,
+                'p50_ms': round(_percentile(latencies, 50), 3),
+                'p95_ms': round(_percentile(latencies, 95), 3),
+                'p99_ms': round(_percentile(latencies, 99), 3),
+                'mean_ms': round(statistics.fmean(latencies), 3),
+                'mongo_commands': max(commands),
+                'peak_memory_kib': round(peak / 1024, 1),
+            }
+        return results
+
+    def write_table(self, size, results):
+        self.stdout.write(f'\n{size} users')
+        self.stdout.write(f'{"endpoint":<24}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"cmds":>6}{"peak KiB":>11}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<24}{result["p50_ms"]:>10.2f}{result["p95_ms"]:>10.2f}{result["p99_ms"]:>10.2f}'
+                f'{result["mongo_commands"]:>6}{result["peak_memory_kib"]:>11.1f}'
+            )
+
+    def compare(self, baseline, results, tolerance):
+        """List the endpoints that got slower or issue more Mongo commands"""
+        regressions = []
+        for size, endpoints in results.items():
+            for name, result in endpoints.items():
+                previous = baseline.get(size, {}).get(name)
+                if previous is None:
+                    continue
+                if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                    regressions.append(
+                        f'{name} @ {size} users: p95 {previous["p95_ms"]:.2f} ms -> {result["p95_ms"]:.2f} ms'
+                    )
+                if result['mongo_commands'] > previous['mongo_commands']:
+                    regressions.append(
+                        f'{name} @ {size} users: {previous["mongo_commands"]} -> '
+                        f'{result["mongo_commands"]} Mongo commands'
+                    )
+        return regressions
@@ -0,0 +1,115 @@
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from octofit_tracker.fast_serializers import FastSerializer
+from octofit_tracker.renderers import FastJSONRenderer
+from octofit_tracker.serializers import ActivitySerializer, UserSerializer, WorkoutSerializer
+
+
+def _activity_rows(count, rng):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [{
+        '_id': ObjectId(),
+        'user_id': str(ObjectId()),
+        'type': rng.choice(['Running', 'Cycling', 'Yoga', 'Swimming']),
+        'duration': rng.randint(10, 120),
+        'distance': round(rng.uniform(1, 40), 2) if rng.random() < 0.7 else None,
+        'calories_burned': rng.randint(50, 1200),
+        'points': rng.randint(10, 300),
+        'date': start + timedelta(minutes=rng.randint(0, 500000)),
+        'notes': rng.choice([None, 'Felt great', 'Hard session', 'Recovery pace']),
+    } for _ in range(count)]
+
+
+def _user_rows(count, rng):
+    return [{
+        '_id': ObjectId(),
+        'username': f'user{index}',
+        'email': f'user{index}@example.com',
+        'name': f'User {index}',
+        'alias': None,
+        'team': rng.choice(['Team Marvel', 'Team DC']),
+        'total_points': rng.randint(0, 50000),
+        'created_at': datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=index),
+    } for index in range(count)]
+
+
+def _workout_rows(count, rng):
+    return [{
+        '_id': ObjectId(),
+        'name': f'Workout {index}',
+        'description': 'Intervals',
+        'type': rng.choice(['HIIT', 'Cardio', 'Yoga']),
+        'duration': rng.randint(15, 60),
+        'difficulty': rng.choice(['Beginner', 'Intermediate', 'Advanced']),
+        'exercises': [{'name': 'Burpees', 'sets': 3, 'reps': 15}],
+        'created_at': datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=index),
+    } for index in range(count)]
+
+
+CASES = [
+    ('activities', ActivitySerializer, _activity_rows),
+    ('users', UserSerializer, _user_rows),
+    ('workouts', WorkoutSerializer, _workout_rows),
+]
+
+
+def _time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare ModelSerializer + JSONRenderer with FastSerializer + FastJSONRenderer '
+        'on in-memory rows; no database is needed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[50, 500, 5000], help='Rows per list')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per measurement')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Also write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        renderer = JSONRenderer()
+        fast_renderer = FastJSONRenderer()
+        results = {}
+
+        self.stdout.write(f'{"case":<18}{"rows":>7}{"drf ms":>10}{"fast ms":>10}{"speedup":>9}')
+        for name, serializer_class, make_rows in CASES:
+            for count in options['rows']:
+                rows = make_rows(count, rng)
+                drf_ms, expected = _time(
+                    lambda: renderer.render(serializer_class(rows, many=True).data), options['repeat'],
+                )
+                fast_ms, actual = _time(
+                    lambda: fast_renderer.render(FastSerializer(serializer_class(), rows, many=True).data),
+                    options['repeat'],
+                )
+                if actual != expected:
+                    raise CommandError(f'{name}: fast output differs from the ModelSerializer output')
+                speedup = drf_ms / fast_ms if fast_ms else float('inf')
+                results.setdefault(name, {})[str(count)] = {
+                    'drf_ms': round(drf_ms, 3),
+                    'fast_ms': round(fast_ms, 3),
+                    'speedup': round(speedup, 2),
+                }
+                self.stdout.write(f'{name:<18}{count:>7}{drf_ms:>10.2f}{fast_ms:>10.2f}{speedup:>8.1f}x')
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
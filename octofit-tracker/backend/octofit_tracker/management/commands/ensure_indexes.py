@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker.indexes import ensure_indexes, explain_query_shapes
+
+
+class Command(BaseCommand):
+    help = 'Create the indexes the API queries need and verify none of them does a collection scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--skip-build', action='store_true',
+            help='Only run the explain-plan verification',
+        )
+        parser.add_argument(
+            '--skip-explain', action='store_true',
+            help='Only build the indexes',
+        )
+
+    def handle(self, *args, **options):
+        if not options['skip_build']:
+            self.stdout.write('Creating indexes...')
+            for collection, names in ensure_indexes().items():
+                self.stdout.write(self.style.SUCCESS(f'{collection}: {", ".join(names)}'))
+
+        if options['skip_explain']:
+            return
+
+        self.stdout.write('Verifying query plans...')
+        scans = []
+        for description, stages in explain_query_shapes():
+            plan = ' <- '.join(stages)
+            if 'COLLSCAN' in stages:
+                scans.append(description)
+                self.stdout.write(self.style.ERROR(f'{description}: {plan}'))
+            else:
+                self.stdout.write(f'{description}: {plan}')
+
+        if scans:
+            raise CommandError(f'{len(scans)} query shapes still do a COLLSCAN: {", ".join(scans)}')
+        self.stdout.write(self.style.SUCCESS('Every query shape is served by an index'))
@@ -1,16 +1,162 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import UpdateOne
 from datetime import datetime, timedelta
+import multiprocessing
+import os
 import random
+import time
+
+import django
+
+from octofit_tracker.buckets import ACTIVITY_BUCKETS, rebuild_activity_buckets
+from octofit_tracker.cache import bump_version
+from octofit_tracker.indexes import ensure_indexes
+from octofit_tracker.leaderboard import rebuild_leaderboard
+from octofit_tracker.mongo import get_client
+from octofit_tracker.scoring import score_activity
+from octofit_tracker.stats import rebuild_user_activity_stats
+
+
+INSERT_BATCH_SIZE = 5000
+
+# type: (min minutes, max minutes, km per minute or None); points and
+# calories come from the scoring rules
+ACTIVITY_PROFILES = {
+    'Running': (20, 90, 0.16),
+    'Cycling': (30, 180, 0.4),
+    'Swimming': (20, 60, 0.04),
+    'Weightlifting': (30, 90, None),
+    'Yoga': (20, 75, None),
+    'Boxing': (20, 60, None),
+    'CrossFit': (20, 60, None),
+}
+ACTIVITY_TYPES = list(ACTIVITY_PROFILES)
+# Most people stick to a couple of favourite activities
+ACTIVITY_WEIGHTS = [30, 20, 10, 15, 10, 5, 10]
+
+FIRST_NAMES = [
+    'Ada', 'Alan', 'Amara', 'Bruno', 'Chen', 'Diego', 'Elena', 'Farah', 'Grace', 'Hiro',
+    'Ines', 'Jonas', 'Kofi', 'Lena', 'Mateo', 'Nadia', 'Omar', 'Priya', 'Quinn', 'Rosa',
+    'Sven', 'Tara', 'Umar', 'Vera', 'Wei', 'Ximena', 'Yusuf', 'Zoe',
+]
+LAST_NAMES = [
+    'Almeida', 'Brown', 'Costa', 'Dubois', 'Eriksen', 'Fischer', 'Garcia', 'Haddad', 'Ito',
+    'Jensen', 'Kim', 'Lopez', 'Moreau', 'Nakamura', 'Okafor', 'Petrov', 'Rossi', 'Silva',
+    'Tanaka', 'Novak', 'Walsh', 'Yilmaz', 'Zhang',
+]
+NOTES = [
+    'Great workout session!', 'Felt strong today', 'Tough one', 'Easy recovery pace',
+    'New personal best', None, None, None,
+]
+
+
+def _database_name():
+    return settings.DATABASES['default']['NAME']
+
+
+def _synthetic_activity(rng, user_id, team, favourites, now):
+    activity_type = rng.choice(favourites) if rng.random() < 0.8 else rng.choice(ACTIVITY_TYPES)
+    min_minutes, max_minutes, km_per_minute = ACTIVITY_PROFILES[activity_type]
+    duration = rng.randint(min_minutes, max_minutes)
+    intensity = rng.uniform(0.8, 1.2)
+    activity = {
+        'user_id': user_id,
+        'team': team or '',
+        'type': activity_type,
+        'duration': duration,
+        'distance': round(duration * km_per_minute * intensity, 2) if km_per_minute else None,
+        'date': now - timedelta(minutes=rng.randint(0, 365 * 24 * 60)),
+        'notes': rng.choice(NOTES),
+    }
+    activity.update(score_activity(activity))
+    return activity
+
+
+def _init_worker(settings_module):
+    """Set Django up in a spawned worker, which starts from a bare interpreter"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+
+
+def generate_chunk(task):
+    """Generate and insert one chunk of synthetic users and their activities
+
+    Runs in a worker process, on that process's shared MongoClient. The
+    random stream is seeded from (seed, start), so the generated data does
+    not depend on the number of workers. Documents are flushed every INSERT_BATCH_SIZE so
+    memory stays flat. Returns the number of users and activities created.
+    """
+    rng = random.Random(f"{task['seed']}:{task['start']}")
+    db = get_client()[task['db_name']]
+    now = datetime.now()
+    per_user = task['activities_per_user']
+    teams = task['teams']
+
+    users = []
+    activities = []
+    activities_count = 0
+    for number in range(task['start'], task['start'] + task['count']):
+        user_id = ObjectId()
+        team = teams[number % len(teams)] if teams else None
+        favourites = rng.choices(ACTIVITY_TYPES, weights=ACTIVITY_WEIGHTS, k=2)
+        total_points = 0
+        for _ in range(rng.randint(per_user // 2, per_user + per_user // 2)):
+            activity = _synthetic_activity(rng, str(user_id), team, favourites, now)
+            total_points += activity['points']
+            activities.append(activity)
+            if len(activities) >= INSERT_BATCH_SIZE:
+                db.activities.insert_many(activities, ordered=False)
+                activities_count += len(activities)
+                activities = []
+
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        users.append({
+            '_id': user_id,
+            'username': f'{first_name.lower()}_{last_name.lower()}_{number}',
+            'email': f'user{number}@octofit.example',
+            'name': f'{first_name} {last_name}',
+            'alias': None,
+            'team': team,
+            'total_points': total_points,
+            'created_at': now - timedelta(days=rng.randint(30, 730)),
+        })
+        if len(users) >= INSERT_BATCH_SIZE:
+            db.users.insert_many(users, ordered=False)
+            users = []
+
+    if activities:
+        db.activities.insert_many(activities, ordered=False)
+        activities_count += len(activities)
+    if users:
+        db.users.insert_many(users, ordered=False)
+    return task['count'], activities_count
 
 
 class Command(BaseCommand):
     help = 'Populate the octofit_db database with test data'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=0,
+            help='Generate this many synthetic users instead of the default heroes',
+        )
+        parser.add_argument('--teams', type=int, default=10, help='Number of synthetic teams')
+        parser.add_argument(
+            '--activities-per-user', type=int, default=10,
+            help='Average number of synthetic activities per user',
+        )
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible data')
+        parser.add_argument('--workers', type=int, default=1, help='Number of generator processes')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users generated per worker task')
+
     def handle(self, *args, **options):
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+
         # Connect to MongoDB
-        client = MongoClient('localhost', 27017)
-        db = client['octofit_db']
+        db = get_client()[_database_name()]
 
         self.stdout.write(self.style.SUCCESS('Connected to MongoDB'))
 
@@ -21,11 +167,118 @@ class Command(BaseCommand):
         db.activities.delete_many({})
         db.leaderboard.delete_many({})
         db.workouts.delete_many({})
+        db.user_activity_stats.delete_many({})
+        db[ACTIVITY_BUCKETS].delete_many({})
+
+        # Create the unique index on email and the indexes the API queries need
+        ensure_indexes(db)
+        self.stdout.write(self.style.SUCCESS('Created indexes'))
 
-        # Create unique index on email
-        db.users.create_index([('email', 1)], unique=True)
-        self.stdout.write(self.style.SUCCESS('Created unique index on email field'))
+        if options['users']:
+            self.populate_synthetic(db, options)
+        else:
+            self.populate_heroes(db)
+
+        # Build per-user activity rollups
+        rollup_count = rebuild_user_activity_stats(db)
+        self.stdout.write(self.style.SUCCESS(f'Built activity stats for {rollup_count} users'))
+        bucket_counts = rebuild_activity_buckets(db)
+        self.stdout.write(self.style.SUCCESS(f'Built {sum(bucket_counts.values())} activity buckets'))
+
+        # Create leaderboard entries
+        self.stdout.write('Creating leaderboard entries...')
+        leaderboard_counts = rebuild_leaderboard(db)
+        self.stdout.write(self.style.SUCCESS(f'Created {sum(leaderboard_counts.values())} leaderboard entries'))
 
+        # Create workout suggestions
+        self.stdout.write('Creating workout suggestions...')
+        workouts = [
+            {
+                'name': 'Morning Power Workout',
+                'description': 'High-intensity interval training to kickstart your day',
+                'type': 'HIIT',
+                'duration': 30,
+                'difficulty': 'Intermediate',
+                'exercises': [
+                    {'name': 'Burpees', 'sets': 3, 'reps': 15},
+                    {'name': 'Push-ups', 'sets': 3, 'reps': 20},
+                    {'name': 'Mountain Climbers', 'sets': 3, 'reps': 30},
+                ],
+                'created_at': datetime.now(),
+            },
+            {
+                'name': 'Superhero Strength Training',
+                'description': 'Build strength like a superhero',
+                'type': 'Strength',
+                'duration': 45,
+                'difficulty': 'Advanced',
+                'exercises': [
+                    {'name': 'Deadlifts', 'sets': 4, 'reps': 8},
+                    {'name': 'Bench Press', 'sets': 4, 'reps': 10},
+                    {'name': 'Squats', 'sets': 4, 'reps': 12},
+                ],
+                'created_at': datetime.now(),
+            },
+            {
+                'name': 'Cardio Blast',
+                'description': 'Improve endurance and burn calories',
+                'type': 'Cardio',
+                'duration': 40,
+                'difficulty': 'Beginner',
+                'exercises': [
+                    {'name': 'Running', 'duration': 20},
+                    {'name': 'Jump Rope', 'duration': 10},
+                    {'name': 'Jumping Jacks', 'sets': 3, 'reps': 50},
+                ],
+                'created_at': datetime.now(),
+            },
+            {
+                'name': 'Flexibility & Recovery',
+                'description': 'Yoga-inspired stretching routine',
+                'type': 'Yoga',
+                'duration': 25,
+                'difficulty': 'Beginner',
+                'exercises': [
+                    {'name': 'Sun Salutations', 'sets': 3},
+                    {'name': 'Warrior Pose', 'duration': 2},
+                    {'name': 'Child Pose', 'duration': 3},
+                ],
+                'created_at': datetime.now(),
+            },
+            {
+                'name': 'Hero Endurance Challenge',
+                'description': 'Test your limits with this endurance workout',
+                'type': 'CrossFit',
+                'duration': 60,
+                'difficulty': 'Advanced',
+                'exercises': [
+                    {'name': 'Box Jumps', 'sets': 5, 'reps': 15},
+                    {'name': 'Kettlebell Swings', 'sets': 5, 'reps': 20},
+                    {'name': 'Pull-ups', 'sets': 5, 'reps': 10},
+                ],
+                'created_at': datetime.now(),
+            },
+        ]
+        db.workouts.insert_many(workouts)
+        self.stdout.write(self.style.SUCCESS(f'Created {len(workouts)} workout suggestions'))
+
+        # Drop responses cached from the old data when run in-process
+        bump_version(
+            'users', 'teams', 'activities', 'leaderboard', 'workouts', 'user_activity_stats', ACTIVITY_BUCKETS,
+        )
+
+        # Summary
+        self.stdout.write(self.style.SUCCESS('\n' + '='*50))
+        self.stdout.write(self.style.SUCCESS('Database population completed!'))
+        self.stdout.write(self.style.SUCCESS('='*50))
+        self.stdout.write(f'Users: {db.users.estimated_document_count()}')
+        self.stdout.write(f'Teams: {db.teams.estimated_document_count()}')
+        self.stdout.write(f'Activities: {db.activities.estimated_document_count()}')
+        self.stdout.write(f'Leaderboard entries: {db.leaderboard.estimated_document_count()}')
+        self.stdout.write(f'Workouts: {db.workouts.estimated_document_count()}')
+
+    def populate_heroes(self, db):
+        """Create the default dataset of Marvel and DC heroes"""
         # Marvel superheroes data
         marvel_heroes = [
             {'name': 'Iron Man', 'email': 'tony.stark@marvel.com', 'alias': 'Tony Stark'},
@@ -52,9 +305,8 @@ class Command(BaseCommand):
 
         # Insert users
         self.stdout.write('Creating users...')
-        marvel_user_ids = []
-        for hero in marvel_heroes:
-            user_data = {
+        marvel_users = [
+            {
                 'username': hero['name'].lower().replace(' ', '_'),
                 'email': hero['email'],
                 'name': hero['name'],
@@ -63,12 +315,12 @@ class Command(BaseCommand):
                 'total_points': random.randint(500, 2000),
                 'created_at': datetime.now() - timedelta(days=random.randint(30, 180)),
             }
-            result = db.users.insert_one(user_data)
-            marvel_user_ids.append(result.inserted_id)
+            for hero in marvel_heroes
+        ]
+        marvel_user_ids = db.users.insert_many(marvel_users).inserted_ids
 
-        dc_user_ids = []
-        for hero in dc_heroes:
-            user_data = {
+        dc_users = [
+            {
                 'username': hero['name'].lower().replace(' ', '_'),
                 'email': hero['email'],
                 'name': hero['name'],
@@ -77,8 +329,9 @@ class Command(BaseCommand):
                 'total_points': random.randint(500, 2000),
                 'created_at': datetime.now() - timedelta(days=random.randint(30, 180)),
             }
-            result = db.users.insert_one(user_data)
-            dc_user_ids.append(result.inserted_id)
+            for hero in dc_heroes
+        ]
+        dc_user_ids = db.users.insert_many(dc_users).inserted_ids
 
         self.stdout.write(self.style.SUCCESS(f'Created {len(marvel_user_ids) + len(dc_user_ids)} users'))
 
@@ -89,164 +342,130 @@ class Command(BaseCommand):
             'description': 'Earth\'s Mightiest Heroes',
             'captain_id': marvel_user_ids[0],
             'member_ids': marvel_user_ids,
-            'total_points': sum([db.users.find_one({'_id': uid})['total_points'] for uid in marvel_user_ids]),
+            'total_points': sum(user['total_points'] for user in marvel_users),
             'created_at': datetime.now() - timedelta(days=180),
         }
-        team_marvel_result = db.teams.insert_one(team_marvel)
-
         team_dc = {
             'name': 'Team DC',
             'description': 'Justice League United',
             'captain_id': dc_user_ids[0],
             'member_ids': dc_user_ids,
-            'total_points': sum([db.users.find_one({'_id': uid})['total_points'] for uid in dc_user_ids]),
+            'total_points': sum(user['total_points'] for user in dc_users),
             'created_at': datetime.now() - timedelta(days=180),
         }
-        team_dc_result = db.teams.insert_one(team_dc)
+        db.teams.insert_many([team_marvel, team_dc])
 
         self.stdout.write(self.style.SUCCESS('Created 2 teams'))
 
         # Insert activities
         self.stdout.write('Creating activities...')
         activity_types = ['Running', 'Cycling', 'Swimming', 'Weightlifting', 'Yoga', 'Boxing', 'CrossFit']
-        all_user_ids = marvel_user_ids + dc_user_ids
-        
-        activities_count = 0
-        for user_id in all_user_ids:
+        all_user_teams = [(user_id, 'Team Marvel') for user_id in marvel_user_ids] + [
+            (user_id, 'Team DC') for user_id in dc_user_ids
+        ]
+
+        activities = []
+        for user_id, team in all_user_teams:
             # Create 5-15 random activities for each user
             num_activities = random.randint(5, 15)
             for _ in range(num_activities):
-                activity_data = {
+                activity = {
                     'user_id': user_id,
+                    'team': team,
                     'type': random.choice(activity_types),
                     'duration': random.randint(15, 120),  # minutes
                     'distance': round(random.uniform(1, 15), 2) if random.choice([True, False]) else None,
-                    'calories_burned': random.randint(50, 800),
-                    'points': random.randint(10, 100),
                     'date': datetime.now() - timedelta(days=random.randint(0, 90)),
                     'notes': 'Great workout session!',
                 }
-                db.activities.insert_one(activity_data)
-                activities_count += 1
+                activity.update(score_activity(activity))
+                activities.append(activity)
+        db.activities.insert_many(activities)
+        activities_count = len(activities)
 
         self.stdout.write(self.style.SUCCESS(f'Created {activities_count} activities'))
 
-        # Create leaderboard entries
-        self.stdout.write('Creating leaderboard entries...')
-        leaderboard_entries = []
-        
-        # Individual leaderboard
-        all_users = list(db.users.find({}))
-        all_users.sort(key=lambda x: x['total_points'], reverse=True)
-        for rank, user in enumerate(all_users, 1):
-            leaderboard_entries.append({
-                'type': 'individual',
-                'entity_id': user['_id'],
-                'name': user['name'],
-                'points': user['total_points'],
-                'rank': rank,
-                'updated_at': datetime.now(),
-            })
-
-        # Team leaderboard
-        teams = [
-            {'id': team_marvel_result.inserted_id, 'name': 'Team Marvel', 'points': team_marvel['total_points']},
-            {'id': team_dc_result.inserted_id, 'name': 'Team DC', 'points': team_dc['total_points']},
-        ]
-        teams.sort(key=lambda x: x['points'], reverse=True)
-        for rank, team in enumerate(teams, 1):
-            leaderboard_entries.append({
-                'type': 'team',
-                'entity_id': team['id'],
-                'name': team['name'],
-                'points': team['points'],
-                'rank': rank,
-                'updated_at': datetime.now(),
-            })
-
-        db.leaderboard.insert_many(leaderboard_entries)
-        self.stdout.write(self.style.SUCCESS(f'Created {len(leaderboard_entries)} leaderboard entries'))
+    def populate_synthetic(self, db, options):
+        """Generate a large synthetic dataset across worker processes"""
+        num_users = options['users']
+        num_teams = options['teams']
+        chunk_size = options['chunk_size']
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        self.stdout.write(
+            f'Generating {num_users} users in {num_teams} teams with about '
+            f'{options["activities_per_user"]} activities each (seed {seed})...'
+        )
 
-        # Create workout suggestions
-        self.stdout.write('Creating workout suggestions...')
-        workouts = [
-            {
-                'name': 'Morning Power Workout',
-                'description': 'High-intensity interval training to kickstart your day',
-                'type': 'HIIT',
-                'duration': 30,
-                'difficulty': 'Intermediate',
-                'exercises': [
-                    {'name': 'Burpees', 'sets': 3, 'reps': 15},
-                    {'name': 'Push-ups', 'sets': 3, 'reps': 20},
-                    {'name': 'Mountain Climbers', 'sets': 3, 'reps': 30},
-                ],
-                'created_at': datetime.now(),
-            },
-            {
-                'name': 'Superhero Strength Training',
-                'description': 'Build strength like a superhero',
-                'type': 'Strength',
-                'duration': 45,
-                'difficulty': 'Advanced',
-                'exercises': [
-                    {'name': 'Deadlifts', 'sets': 4, 'reps': 8},
-                    {'name': 'Bench Press', 'sets': 4, 'reps': 10},
-                    {'name': 'Squats', 'sets': 4, 'reps': 12},
-                ],
-                'created_at': datetime.now(),
-            },
-            {
-                'name': 'Cardio Blast',
-                'description': 'Improve endurance and burn calories',
-                'type': 'Cardio',
-                'duration': 40,
-                'difficulty': 'Beginner',
-                'exercises': [
-                    {'name': 'Running', 'duration': 20},
-                    {'name': 'Jump Rope', 'duration': 10},
-                    {'name': 'Jumping Jacks', 'sets': 3, 'reps': 50},
-                ],
-                'created_at': datetime.now(),
-            },
-            {
-                'name': 'Flexibility & Recovery',
-                'description': 'Yoga-inspired stretching routine',
-                'type': 'Yoga',
-                'duration': 25,
-                'difficulty': 'Beginner',
-                'exercises': [
-                    {'name': 'Sun Salutations', 'sets': 3},
-                    {'name': 'Warrior Pose', 'duration': 2},
-                    {'name': 'Child Pose', 'duration': 3},
-                ],
-                'created_at': datetime.now(),
-            },
+        team_names = [f'Team {number}' for number in range(1, num_teams + 1)]
+        if team_names:
+            db.teams.insert_many([
+                {
+                    'name': name,
+                    'description': f'Synthetic team {name}',
+                    'captain_id': None,
+                    'member_ids': [],
+                    'total_points': 0,
+                    'created_at': datetime.now() - timedelta(days=365),
+                }
+                for name in team_names
+            ])
+
+        tasks = [
             {
-                'name': 'Hero Endurance Challenge',
-                'description': 'Test your limits with this endurance workout',
-                'type': 'CrossFit',
-                'duration': 60,
-                'difficulty': 'Advanced',
-                'exercises': [
-                    {'name': 'Box Jumps', 'sets': 5, 'reps': 15},
-                    {'name': 'Kettlebell Swings', 'sets': 5, 'reps': 20},
-                    {'name': 'Pull-ups', 'sets': 5, 'reps': 10},
-                ],
-                'created_at': datetime.now(),
-            },
+                'db_name': _database_name(),
+                'seed': seed,
+                'start': start,
+                'count': min(chunk_size, num_users - start),
+                'teams': team_names,
+                'activities_per_user': options['activities_per_user'],
+            }
+            for start in range(0, num_users, chunk_size)
         ]
-        db.workouts.insert_many(workouts)
-        self.stdout.write(self.style.SUCCESS(f'Created {len(workouts)} workout suggestions'))
 
-        # Summary
-        self.stdout.write(self.style.SUCCESS('\n' + '='*50))
-        self.stdout.write(self.style.SUCCESS('Database population completed!'))
-        self.stdout.write(self.style.SUCCESS('='*50))
-        self.stdout.write(f'Users: {db.users.count_documents({})}')
-        self.stdout.write(f'Teams: {db.teams.count_documents({})}')
-        self.stdout.write(f'Activities: {db.activities.count_documents({})}')
-        self.stdout.write(f'Leaderboard entries: {db.leaderboard.count_documents({})}')
-        self.stdout.write(f'Workouts: {db.workouts.count_documents({})}')
+        started = time.monotonic()
+        users_count = activities_count = 0
+        workers = max(1, options['workers'])
+        if workers > 1:
+            # Spawned workers do not inherit this process's MongoClient; each
+            # one sets Django up and builds its own from the same settings
+            pool = multiprocessing.get_context('spawn').Pool(
+                workers, initializer=_init_worker, initargs=(os.environ['DJANGO_SETTINGS_MODULE'],),
+            )
+            with pool:
+                for chunk_users, chunk_activities in pool.imap_unordered(generate_chunk, tasks):
+                    users_count += chunk_users
+                    activities_count += chunk_activities
+        else:
+            for task in tasks:
+                chunk_users, chunk_activities = generate_chunk(task)
+                users_count += chunk_users
+                activities_count += chunk_activities
+        elapsed = max(time.monotonic() - started, 1e-9)
 
-        client.close()
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {users_count} users and {activities_count} activities in {elapsed:.1f}s '
+            f'({(users_count + activities_count) / elapsed:,.0f} docs/sec with {workers} workers)'
+        ))
+
+        # Derive team captains and totals from the generated users. Members
+        # are not listed on the team: membership comes from User.team, and
+        # the ids of millions of users would not fit in one document.
+        self.stdout.write('Aggregating team totals...')
+        team_updates = [
+            UpdateOne({'name': row['_id']}, {'$set': {
+                'captain_id': row['captain_id'],
+                'total_points': row['total_points'],
+            }})
+            for row in db.users.aggregate([
+                {'$match': {'team': {'$in': team_names}}},
+                {'$sort': {'total_points': -1}},
+                {'$group': {
+                    '_id': '$team',
+                    'captain_id': {'$first': '$_id'},
+                    'total_points': {'$sum': '$total_points'},
+                }},
+            ], allowDiskUse=True)
+        ]
+        if team_updates:
+            db.teams.bulk_write(team_updates, ordered=False)
+        self.stdout.write(self.style.SUCCESS(f'Created {len(team_names)} teams'))
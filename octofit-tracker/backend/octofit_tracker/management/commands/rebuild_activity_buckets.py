@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.buckets import rebuild_activity_buckets
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the day, week and month activity buckets in activity_buckets from scratch'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding activity buckets...')
+        counts = rebuild_activity_buckets()
+        summary = ', '.join(f'{count} {granularity}' for granularity, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt activity buckets: {summary}'))
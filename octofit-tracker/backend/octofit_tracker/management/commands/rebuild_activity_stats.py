@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.stats import rebuild_user_activity_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-user activity rollups in user_activity_stats from scratch'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding user activity stats...')
+        count = rebuild_user_activity_stats()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt activity stats for {count} users'))
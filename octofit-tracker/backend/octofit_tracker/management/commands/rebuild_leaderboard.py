@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.leaderboard import rebuild_leaderboard
+from octofit_tracker.teams import rebuild_team_totals
+
+
+class Command(BaseCommand):
+    help = 'Recompute team totals, then the individual and team leaderboards from users and teams'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Recomputing team totals...')
+        team_count = rebuild_team_totals()
+        self.stdout.write(self.style.SUCCESS(f'Recomputed {team_count} teams with members'))
+        self.stdout.write('Rebuilding leaderboard...')
+        counts = rebuild_leaderboard()
+        for entry_type, count in counts.items():
+            self.stdout.write(self.style.SUCCESS(f'Ranked {count} {entry_type} entries'))
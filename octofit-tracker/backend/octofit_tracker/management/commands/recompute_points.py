@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.scoring import RECOMPUTE_CHUNK_SIZE, recompute_points
+
+
+class Command(BaseCommand):
+    help = 'Rescore the points and calories of every activity with the current scoring rules'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=RECOMPUTE_CHUNK_SIZE,
+            help='Activities scored and written per bulk_write',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Count the changes without writing them')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        def progress(scanned):
+            rate = scanned / max(time.perf_counter() - started, 1e-9)
+            self.stdout.write(f'  {scanned} activities scanned ({rate:.0f}/s)')
+
+        self.stdout.write('Rescoring activities...')
+        result = recompute_points(chunk_size=options['chunk_size'], dry_run=options['dry_run'], progress=progress)
+        verb = 'Would change' if options['dry_run'] else 'Changed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {result['changed']} of {result['scanned']} activities and the points of "
+            f"{result['users']} users in {time.perf_counter() - started:.1f}s"
+        ))
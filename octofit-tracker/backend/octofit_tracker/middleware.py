@@ -0,0 +1,101 @@
+import json
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .monitoring import query_shape, record_commands, request_timer, route_metrics
+
+
+logger = logging.getLogger('octofit_tracker.performance')
+
+# Requests slower than this are logged with their query shapes, unless
+# settings.SLOW_REQUEST_MS overrides it
+SLOW_REQUEST_MS = 500
+
+# Shapes listed per slow request, most expensive first
+SLOW_REQUEST_MAX_SHAPES = 10
+
+
+def _route(request):
+    match = getattr(request, 'resolver_match', None)
+    return f'{request.method} {match.view_name if match else "unmatched"}'
+
+
+def _shapes(commands):
+    """Group commands by (command, collection, query shape), costliest first"""
+    groups = {}
+    for command in commands:
+        shape = json.dumps(query_shape(command['query']), sort_keys=True) if command['query'] is not None else ''
+        key = (command['command'], command['collection'], shape)
+        group = groups.setdefault(key, [0, 0.0])
+        group[0] += 1
+        group[1] += command['duration_ms']
+    return sorted(groups.items(), key=lambda item: item[1][1], reverse=True)
+
+
+class PerformanceMiddleware:
+    """Measure each request: Mongo commands, DB time and the timed() phases
+
+    The breakdown is returned in a Server-Timing header, which browser dev
+    tools display, and added to the per-route metrics served by
+    /api/_metrics/. Requests slower than SLOW_REQUEST_MS are logged together
+    with the shapes of the queries they ran. Listed first in MIDDLEWARE so
+    that the total covers the other middleware too. Both sync and async
+    capable, so it does not force an async chain onto a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_ms = getattr(settings, 'SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+        # Under ASGI the chain stays async, so the async views are not run
+        # on a thread through async_to_sync
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with record_commands() as commands, request_timer.record() as timings:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            total_ms = (time.perf_counter() - started) * 1000
+        return self.process_timings(request, response, total_ms, commands, timings)
+
+    async def __acall__(self, request):
+        with record_commands() as commands, request_timer.record() as timings:
+            started = time.perf_counter()
+            response = await self.get_response(request)
+            total_ms = (time.perf_counter() - started) * 1000
+        return self.process_timings(request, response, total_ms, commands, timings)
+
+    def process_timings(self, request, response, total_ms, commands, timings):
+        db_ms = sum(command['duration_ms'] for command in commands)
+        response['Server-Timing'] = self.server_timing(total_ms, db_ms, len(commands), timings)
+
+        route = _route(request)
+        route_metrics.record(route, response.status_code, total_ms, commands, timings)
+        if total_ms >= self.slow_request_ms:
+            self.log_slow_request(request, route, total_ms, db_ms, commands)
+        return response
+
+    def server_timing(self, total_ms, db_ms, command_count, timings):
+        metrics = [f'db;dur={db_ms:.2f};desc="{command_count} Mongo commands"']
+        metrics += [f'{name};dur={duration:.2f}' for name, duration in timings.items()]
+        metrics.append(f'total;dur={total_ms:.2f}')
+        return ', '.join(metrics)
+
+    def log_slow_request(self, request, route, total_ms, db_ms, commands):
+        shapes = '\n'.join(
+            f'  {count}x {command} {collection} {shape} {duration:.1f} ms'
+            for (command, collection, shape), (count, duration) in _shapes(commands)[:SLOW_REQUEST_MAX_SHAPES]
+        )
+        logger.warning(
+            'Slow request %s %s (%s): %.1f ms, %d Mongo commands taking %.1f ms\n%s',
+            request.method, request.get_full_path(), route, total_ms, len(commands), db_ms, shapes,
+        )
@@ -47,6 +47,9 @@ class Activity(models.Model):
     points = models.IntegerField(default=0)
     date = models.DateTimeField()
     notes = models.TextField(blank=True, null=True)
+    # The user's team when the activity was logged, '' for none; its team
+    # buckets stay with that team, see buckets.bucket_changes
+    team = models.CharField(max_length=200, blank=True, null=True)
 
     class Meta:
         db_table = 'activities'
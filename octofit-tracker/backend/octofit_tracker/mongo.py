@@ -0,0 +1,170 @@
+import asyncio
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:  # pragma: no cover - motor is listed in requirements.txt
+    AsyncIOMotorClient = None
+
+
+# One MongoClient, and so one connection pool, per set of client options
+# and process. A client must not be used across a fork, so children start
+# over.
+_clients = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+# Documents updated by a job of octofit_tracker.jobs record its id in this
+# field, so that a retry of the job skips the documents the failed attempt
+# already reached. Only the latest APPLIED_JOBS_KEPT ids are kept: a job is
+# retried within seconds, long before its id is pushed out.
+APPLIED_JOBS = 'applied_jobs'
+APPLIED_JOBS_KEPT = 100
+
+DUPLICATE_KEY = 11000
+
+# Motor clients are bound to the event loop they were created on. Under ASGI
+# there is one loop per worker; under WSGI every async view gets its own,
+# and close_async_clients() closes its clients when the view returns.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _reset_clients():
+    global _clients_pid, _clients_lock
+    # The parent's clients are dropped, not closed: closing them would tear
+    # down sockets and monitor threads that still belong to the parent
+    _clients.clear()
+    _async_clients.clear()
+    _clients_pid = os.getpid()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def client_options(alias='default'):
+    """Return the MongoClient keyword arguments of a database alias
+
+    These are the CLIENT settings of the alias: host and port plus the pool
+    size, timeout and compression options configured in settings.py.
+    """
+    return dict(connections[alias].settings_dict.get('CLIENT', {}))
+
+
+def _options_key(options):
+    return tuple(sorted((name, repr(value)) for name, value in options.items()))
+
+
+def get_client(alias='default', options=None):
+    """Return the process-wide MongoClient of a database alias
+
+    options are the MongoClient keyword arguments, client_options(alias)
+    by default. Clients are shared by every connection with the same
+    options, such as the one Django's test runner opens, under an alias
+    missing from settings, to create the test database. Shared by djongo
+    (see octofit_tracker.djongo_backend) and by every native query, so the
+    process has a single pool sized by maxPoolSize. Safe to call after a
+    fork, including forks that bypass os.register_at_fork: a client created
+    in another process is replaced.
+    """
+    options = client_options(alias) if options is None else dict(options)
+    key = _options_key(options)
+    client = _clients.get(key)
+    if client is not None and _clients_pid == os.getpid():
+        return client
+    if _clients_pid != os.getpid():
+        _reset_clients()
+    with _clients_lock:
+        if key not in _clients:
+            # djongo expects documents as OrderedDicts
+            _clients[key] = MongoClient(**options, document_class=OrderedDict, connect=False)
+        return _clients[key]
+
+
+def get_db(alias='default'):
+    """Return the pymongo Database behind the djongo connection"""
+    connection = connections[alias]
+    connection.ensure_connection()
+    return connection.connection
+
+
+def get_async_db(alias='default'):
+    """Return a motor Database for the running event loop
+
+    Connects with the same client_options as get_client, and returns
+    timezone-aware datetimes like the synchronous read path.
+    """
+    if AsyncIOMotorClient is None:
+        raise ImproperlyConfigured('The async read path requires the motor package')
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if alias not in clients:
+        clients[alias] = AsyncIOMotorClient(**client_options(alias), tz_aware=True)
+    return clients[alias][connections[alias].settings_dict['NAME']]
+
+
+def close_async_clients():
+    """Close and forget the motor clients of the running event loop"""
+    for client in _async_clients.pop(asyncio.get_running_loop(), {}).values():
+        client.close()
+
+
+def id_variants(ids):
+    """Return every stored form of the given ids (string and ObjectId)
+
+    Documents written by populate_db keep references as ObjectId while the
+    API writes them as strings, so lookups have to match both forms.
+    """
+    variants = []
+    for value in ids:
+        if value is None:
+            continue
+        variants.append(str(value))
+        if ObjectId.is_valid(str(value)):
+            variants.append(ObjectId(str(value)))
+    return variants
+
+
+def apply_once(job_id, query, update):
+    """Narrow an update to the documents job_id has not been applied to, and mark them
+
+    A job_id of None leaves query and update unchanged.
+    """
+    if job_id is None:
+        return query, update
+    return (
+        {**query, APPLIED_JOBS: {'$ne': job_id}},
+        {**update, '$push': {APPLIED_JOBS: {'$each': [job_id], '$slice': -APPLIED_JOBS_KEPT}}},
+    )
+
+
+def bulk_upsert_once(collection, upserts):
+    """Run (query, update, job_id) upserts with one unordered bulk_write
+
+    The queries must match on a unique key. An upsert whose document
+    already carries its job_id then fails with a duplicate key error rather
+    than adding a second document; it is ignored once that document is
+    found. Any other error is raised.
+    """
+    upserts = list(upserts)
+    if not upserts:
+        return
+    try:
+        collection.bulk_write([
+            UpdateOne(*apply_once(job_id, query, update), upsert=True) for query, update, job_id in upserts
+        ], ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details['writeErrors']:
+            query, _, job_id = upserts[error['index']]
+            if error['code'] != DUPLICATE_KEY or job_id is None:
+                raise
+            if collection.count_documents({**query, APPLIED_JOBS: job_id}, limit=1) == 0:
+                raise
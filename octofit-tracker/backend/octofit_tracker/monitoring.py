@@ -0,0 +1,317 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+
+# Command arguments holding the filter of a command, in the order looked up
+_QUERY_ARGUMENTS = ('filter', 'query', 'pipeline', 'updates', 'deletes')
+
+
+def query_shape(value):
+    """Return a filter, pipeline or write statement with its values blanked
+
+    Keys and operators are kept and every value becomes '?', so queries
+    differing only in their values have the same shape.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [query_shape(item) for item in value]
+        return ['?'] if value else []
+    return '?'
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Collect the Mongo commands issued in the current context
+
+    pymongo publishes command events on the thread that runs the operation,
+    in the context of the code that called it: a request's thread, its
+    event loop task, or the executor thread motor hands the call to with a
+    copy of that context. Recordings opened with record_commands() are kept
+    in a context variable, so they only see their own commands even when
+    several requests are served at once, by threads or by one event loop.
+    """
+
+    def __init__(self):
+        self._recordings = ContextVar('recordings', default=())
+        # request_id -> (collection, query) of commands started while recording
+        self._pending = {}
+
+    def started(self, event):
+        if self._recordings.get():
+            collection = event.command.get(event.command_name)
+            query = next((event.command[name] for name in _QUERY_ARGUMENTS if name in event.command), None)
+            self._pending[event.request_id] = (collection if isinstance(collection, str) else None, query)
+
+    def _finished(self, event, failed):
+        collection, query = self._pending.pop(event.request_id, (None, None))
+        recordings = self._recordings.get()
+        if not recordings:
+            return
+        # query is kept as sent; query_shape() is only applied when needed
+        command = {
+            'command': event.command_name,
+            'collection': collection,
+            'query': query,
+            'duration_ms': event.duration_micros / 1000,
+            'failed': failed,
+        }
+        for recording in recordings:
+            recording.append(command)
+
+    def succeeded(self, event):
+        self._finished(event, failed=False)
+
+    def failed(self, event):
+        self._finished(event, failed=True)
+
+    @contextmanager
+    def record(self):
+        recording = []
+        token = self._recordings.set(self._recordings.get() + (recording,))
+        try:
+            yield recording
+        finally:
+            self._recordings.reset(token)
+
+
+# Upper bounds, in milliseconds, of the checkout wait histogram buckets
+POOL_WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def histogram(bounds, counts):
+    """Label the bucket counts of a histogram with their upper bounds"""
+    return dict(zip([f'<={bound}' for bound in bounds] + [f'>{bounds[-1]}'], counts))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Count connections and time checkouts for every pool of the process
+
+    Checkout events are published on the thread asking for a connection, so
+    the wait is measured from a thread-local start time. A checkout that
+    waits means every connection was in use: the pool is too small for the
+    worker's concurrency, or queries hold connections too long.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pools = {}
+
+    def _pool(self, address):
+        if address not in self._pools:
+            self._pools[address] = {
+                'open': 0,
+                'in_use': 0,
+                'max_in_use': 0,
+                'checkouts': 0,
+                'failed_checkouts': 0,
+                'wait_ms_total': 0.0,
+                'wait_ms_max': 0.0,
+                'wait_buckets': [0] * (len(POOL_WAIT_BUCKETS_MS) + 1),
+                'cleared': 0,
+            }
+        return self._pools[address]
+
+    def _wait_ms(self):
+        started = getattr(self._local, 'started', None)
+        self._local.started = None
+        return (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+    def _record_wait(self, pool, wait_ms):
+        pool['wait_ms_total'] += wait_ms
+        pool['wait_ms_max'] = max(pool['wait_ms_max'], wait_ms)
+        pool['wait_buckets'][bisect_left(POOL_WAIT_BUCKETS_MS, wait_ms)] += 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait_ms = self._wait_ms()
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['checkouts'] += 1
+            pool['in_use'] += 1
+            pool['max_in_use'] = max(pool['max_in_use'], pool['in_use'])
+            self._record_wait(pool, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        wait_ms = self._wait_ms()
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['failed_checkouts'] += 1
+            self._record_wait(pool, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)['in_use'] -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)['open'] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event.address)['open'] -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address)['cleared'] += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def stats(self):
+        """Return the counters of every pool, keyed by 'host:port'"""
+        with self._lock:
+            pools = {}
+            for (host, port), pool in self._pools.items():
+                attempts = pool['checkouts'] + pool['failed_checkouts']
+                pools[f'{host}:{port}'] = {
+                    **{name: value for name, value in pool.items() if name != 'wait_buckets'},
+                    'wait_ms_total': round(pool['wait_ms_total'], 3),
+                    'wait_ms_max': round(pool['wait_ms_max'], 3),
+                    'wait_ms_mean': round(pool['wait_ms_total'] / attempts, 3) if attempts else 0.0,
+                    'wait_histogram_ms': histogram(POOL_WAIT_BUCKETS_MS, pool['wait_buckets']),
+                }
+            return pools
+
+
+# Registered globally so that every MongoClient created from now on, including
+# djongo's, reports to them. OctofitTrackerConfig.ready() imports this module
+# before the first connection is opened.
+command_recorder = CommandRecorder()
+monitoring.register(command_recorder)
+pool_metrics = PoolMetrics()
+monitoring.register(pool_metrics)
+# A forked child starts with new pools, see mongo.get_client
+os.register_at_fork(after_in_child=pool_metrics.reset)
+
+
+def record_commands():
+    """Context manager yielding the list of Mongo commands run inside it"""
+    return command_recorder.record()
+
+
+class RequestTimer:
+    """Accumulate named durations, in milliseconds, for the current context
+
+    The performance middleware opens a recording per request; code on the
+    request path wraps its phases in timed(), which costs nothing when no
+    recording is open. Recordings are kept in a context variable, so async
+    requests sharing a thread each get their own.
+    """
+
+    def __init__(self):
+        self._timings = ContextVar('timings', default=None)
+
+    @contextmanager
+    def record(self):
+        timings = {}
+        token = self._timings.set(timings)
+        try:
+            yield timings
+        finally:
+            self._timings.reset(token)
+
+    @contextmanager
+    def timed(self, name):
+        timings = self._timings.get()
+        if timings is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+
+request_timer = RequestTimer()
+
+
+def timed(name):
+    """Context manager adding the time spent inside to the request's timing name"""
+    return request_timer.timed(name)
+
+
+# Upper bounds, in milliseconds, of the request duration histogram buckets
+REQUEST_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class RouteMetrics:
+    """Per-route request counts, latency histograms and Mongo totals"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, status_code, total_ms, commands, timings):
+        db_ms = sum(command['duration_ms'] for command in commands)
+        with self._lock:
+            if route not in self._routes:
+                self._routes[route] = {
+                    'count': 0,
+                    'errors': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'db_ms': 0.0,
+                    'commands': 0,
+                    'max_commands': 0,
+                    'timings_ms': {},
+                    'buckets': [0] * (len(REQUEST_BUCKETS_MS) + 1),
+                }
+            metrics = self._routes[route]
+            metrics['count'] += 1
+            metrics['errors'] += status_code >= 500
+            metrics['total_ms'] += total_ms
+            metrics['max_ms'] = max(metrics['max_ms'], total_ms)
+            metrics['db_ms'] += db_ms
+            metrics['commands'] += len(commands)
+            metrics['max_commands'] = max(metrics['max_commands'], len(commands))
+            for name, duration in timings.items():
+                metrics['timings_ms'][name] = metrics['timings_ms'].get(name, 0.0) + duration
+            metrics['buckets'][bisect_left(REQUEST_BUCKETS_MS, total_ms)] += 1
+
+    def stats(self):
+        """Return the metrics of every route, with means per request"""
+        with self._lock:
+            routes = {}
+            for route, metrics in sorted(self._routes.items()):
+                count = metrics['count']
+                routes[route] = {
+                    'count': count,
+                    'errors': metrics['errors'],
+                    'mean_ms': round(metrics['total_ms'] / count, 3),
+                    'max_ms': round(metrics['max_ms'], 3),
+                    'mean_db_ms': round(metrics['db_ms'] / count, 3),
+                    'mean_commands': round(metrics['commands'] / count, 2),
+                    'max_commands': metrics['max_commands'],
+                    'mean_timings_ms': {
+                        name: round(duration / count, 3) for name, duration in metrics['timings_ms'].items()
+                    },
+                    'histogram_ms': histogram(REQUEST_BUCKETS_MS, metrics['buckets']),
+                }
+            return routes
+
+
+route_metrics = RouteMetrics()
+os.register_at_fork(after_in_child=route_metrics.reset)
@@ -0,0 +1,136 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .repository import DocumentQuery, get_field_value
+
+
+def _encode_value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination over a unique, stable ordering
+
+    Each viewset declares its sort keys in keyset_ordering, ending with _id
+    so that every row has a distinct position. The cursor holds the sort key
+    values of the last row served; the next page is read with a range filter
+    on those keys and a LIMIT of page_size + 1. No count() is ever issued,
+    so a deep page costs the same as the first one.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 500
+    default_ordering = ('-_id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = tuple(getattr(view, 'keyset_ordering', self.default_ordering))
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request, queryset.model)
+        if cursor is not None:
+            if isinstance(queryset, DocumentQuery):
+                queryset = queryset.filter(self.get_mongo_keyset_filter(cursor))
+            else:
+                queryset = queryset.filter(self.get_keyset_filter(cursor))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_keyset_filter(self, cursor):
+        """Build the filter matching every row that sorts after the cursor
+
+        For an ordering (a, b, c) this is
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z),
+        with > swapped for < on descending keys.
+        """
+        keyset_filter = Q()
+        equal_so_far = Q()
+        for field, value in zip(self.ordering, cursor):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            keyset_filter |= equal_so_far & Q(**{f'{name}__{lookup}': value})
+            equal_so_far &= Q(**{name: value})
+        return keyset_filter
+
+    def get_mongo_keyset_filter(self, cursor):
+        """The same filter as get_keyset_filter, as a native Mongo query"""
+        clauses = []
+        equal_so_far = {}
+        for field, value in zip(self.ordering, cursor):
+            name = field.lstrip('-')
+            operator = '$lt' if field.startswith('-') else '$gt'
+            clauses.append({**equal_so_far, name: {operator: value}})
+            equal_so_far[name] = value
+        return {'$or': clauses}
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError(encoded)
+            return [
+                model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (TypeError, ValueError, UnicodeError, binascii.Error, InvalidId, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, item):
+        values = [_encode_value(get_field_value(item, field.lstrip('-'))) for field in self.ordering]
+        encoded = base64.urlsafe_b64encode(json.dumps(values).encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
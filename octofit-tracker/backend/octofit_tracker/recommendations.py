@@ -0,0 +1,281 @@
+import threading
+import time
+
+import numpy as np
+
+from .cache import get_version
+from .models import Workout
+from .mongo import get_db, id_variants
+from .repository import DocumentQuery
+
+
+# Columns of the feature vectors: the share of each workout type, then the
+# typical duration and the intensity
+WORKOUT_TYPES = ('Cardio', 'Strength', 'HIIT', 'Yoga', 'CrossFit')
+DURATION = len(WORKOUT_TYPES)
+INTENSITY = DURATION + 1
+FEATURES = INTENSITY + 1
+
+# Workout type trained by each activity type; other activity types count
+# towards the workout type of the same name, if there is one
+ACTIVITY_WORKOUT_TYPES = {
+    'Running': 'Cardio',
+    'Cycling': 'Cardio',
+    'Swimming': 'Cardio',
+    'Weightlifting': 'Strength',
+    'Boxing': 'HIIT',
+}
+
+DIFFICULTY_INTENSITY = {'Beginner': 0.0, 'Intermediate': 0.5, 'Advanced': 1.0}
+
+# Durations are in units of DURATION_SCALE minutes, capped at MAX_DURATION
+DURATION_SCALE = 60
+MAX_DURATION = 3.0
+
+# Calories burned per minute at intensity 0 and 1
+CALORIES_PER_MINUTE_RANGE = (4, 13)
+
+# A workout's score is the type match minus the weighted duration and
+# intensity gaps
+DURATION_WEIGHT = 0.3
+INTENSITY_WEIGHT = 0.5
+
+# Profile of a user without activities: no preferred type, short and easy
+DEFAULT_PROFILE = np.array([1 / len(WORKOUT_TYPES)] * len(WORKOUT_TYPES) + [0.5, 0.0])
+
+RECOMMENDATION_LIMIT = 5
+RECOMMENDATION_MAX_LIMIT = 50
+
+# Profiles are rebuilt from every activity this often; users whose
+# activities change in this process are recomputed on their next request.
+PROFILE_MAX_AGE = 600
+CATALOG_MAX_AGE = 60
+
+
+def _activity_pipeline(match=None):
+    return ([{'$match': match}] if match else []) + [
+        {'$group': {
+            '_id': {'user_id': {'$toString': '$user_id'}, 'type': '$type'},
+            'count': {'$sum': 1},
+            'duration': {'$sum': {'$ifNull': ['$duration', 0]}},
+            'calories': {'$sum': {'$ifNull': ['$calories_burned', 0]}},
+        }},
+    ]
+
+
+def build_profiles(rows):
+    """Turn per (user, activity type) totals into one feature vector per user
+
+    rows are the output of _activity_pipeline. Returns the user ids and a
+    matrix holding their vectors, one row per user in the same order.
+    """
+    user_rows = {}
+    positions, type_columns, totals = [], [], []
+    for row in rows:
+        positions.append(user_rows.setdefault(row['_id']['user_id'], len(user_rows)))
+        workout_type = ACTIVITY_WORKOUT_TYPES.get(row['_id']['type'], row['_id']['type'])
+        type_columns.append(WORKOUT_TYPES.index(workout_type) if workout_type in WORKOUT_TYPES else -1)
+        totals.append((row['count'], row['duration'], row['calories']))
+    if not user_rows:
+        return [], np.empty((0, FEATURES))
+
+    positions = np.array(positions)
+    type_columns = np.array(type_columns)
+    counts, durations, calories = np.array(totals, dtype=float).T
+    users = len(user_rows)
+
+    profiles = np.zeros((users, FEATURES))
+    known = type_columns >= 0
+    np.add.at(profiles, (positions[known], type_columns[known]), durations[known])
+    minutes = profiles[:, :DURATION].sum(axis=1, keepdims=True)
+    profiles[:, :DURATION] = np.where(
+        minutes > 0, profiles[:, :DURATION] / np.maximum(minutes, 1), DEFAULT_PROFILE[:DURATION]
+    )
+
+    user_counts = np.bincount(positions, weights=counts, minlength=users)
+    user_durations = np.bincount(positions, weights=durations, minlength=users)
+    user_calories = np.bincount(positions, weights=calories, minlength=users)
+    typical_durations = user_durations / np.maximum(user_counts, 1) / DURATION_SCALE
+    profiles[:, DURATION] = np.clip(typical_durations, 0, MAX_DURATION)
+    low, high = CALORIES_PER_MINUTE_RANGE
+    calories_per_minute = user_calories / np.maximum(user_durations, 1)
+    profiles[:, INTENSITY] = np.clip((calories_per_minute - low) / (high - low), 0, 1)
+    return list(user_rows), profiles
+
+
+def workout_vectors(workouts):
+    """Return the feature matrix of workout documents, one row per workout"""
+    vectors = np.zeros((len(workouts), FEATURES))
+    for row, workout in enumerate(workouts):
+        if workout.get('type') in WORKOUT_TYPES:
+            vectors[row, WORKOUT_TYPES.index(workout['type'])] = 1
+        vectors[row, DURATION] = min((workout.get('duration') or 0) / DURATION_SCALE, MAX_DURATION)
+        vectors[row, INTENSITY] = DIFFICULTY_INTENSITY.get(workout.get('difficulty'), 0.5)
+    return vectors
+
+
+def score_workouts(profiles, workouts):
+    """Score every workout for every profile in one pass
+
+    profiles is a (users, FEATURES) matrix and workouts a (workouts,
+    FEATURES) one; returns the (users, workouts) scores. The type match is
+    a matrix product and the gaps are broadcast differences.
+    """
+    type_match = profiles[:, :DURATION] @ workouts[:, :DURATION].T
+    duration_gap = np.abs(profiles[:, DURATION, None] - workouts[None, :, DURATION])
+    intensity_gap = np.abs(profiles[:, INTENSITY, None] - workouts[None, :, INTENSITY])
+    return type_match - DURATION_WEIGHT * duration_gap - INTENSITY_WEIGHT * intensity_gap
+
+
+class UserProfiles:
+    """Feature vectors of every user, kept in memory
+
+    load() builds them all from one aggregation over the activities.
+    Users missing from the last load, or invalidated since, are computed
+    on demand with an aggregation over their own activities. A vector
+    computed from activities read before its user was invalidated is never
+    stored.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.loaded_at = None
+            self._vectors = {}
+            # Sequence number of each user's last invalidation
+            self._sequence = 0
+            self._invalidated = {}
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > PROFILE_MAX_AGE
+
+    def ensure_loaded(self, db=None):
+        """Load the profiles when stale, with one aggregation however many requests ask
+
+        Requests wait for the first load; a later refresh is run by one
+        request while the others keep using the previous profiles.
+        """
+        if not self.is_stale():
+            return
+        if not self._load_lock.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            if self.is_stale():
+                self._load(db)
+        finally:
+            self._load_lock.release()
+
+    def load(self, db=None):
+        with self._load_lock:
+            self._load(db)
+
+    def _load(self, db):
+        db = db if db is not None else get_db()
+        with self._lock:
+            started = self._sequence
+        user_ids, profiles = build_profiles(db.activities.aggregate(_activity_pipeline(), allowDiskUse=True))
+        with self._lock:
+            self._vectors = {
+                user_id: profile for user_id, profile in zip(user_ids, profiles)
+                if self._invalidated.get(user_id, 0) <= started
+            }
+            self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._sequence += 1
+            self._invalidated[str(user_id)] = self._sequence
+            self._vectors.pop(str(user_id), None)
+
+    def get(self, user_ids, db=None):
+        """Return the (users, FEATURES) profile matrix of user_ids, in order"""
+        user_ids = [str(user_id) for user_id in user_ids]
+        with self._lock:
+            missing = [user_id for user_id in user_ids if user_id not in self._vectors]
+            started = self._sequence
+        computed = {}
+        if missing:
+            db = db if db is not None else get_db()
+            computed = dict(zip(*build_profiles(db.activities.aggregate(
+                _activity_pipeline({'user_id': {'$in': id_variants(missing)}})
+            ))))
+            computed = {user_id: computed.get(user_id, DEFAULT_PROFILE) for user_id in missing}
+        with self._lock:
+            for user_id, profile in computed.items():
+                if self._invalidated.get(user_id, 0) <= started:
+                    self._vectors[user_id] = profile
+            return np.array([
+                self._vectors.get(user_id, computed.get(user_id, DEFAULT_PROFILE)) for user_id in user_ids
+            ])
+
+
+class WorkoutCatalog:
+    """The workout documents and their feature matrix, reloaded on writes"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.loaded_at = None
+        self.version = None
+        # The documents and their vectors are swapped in as one tuple, so
+        # readers never pair them across loads
+        self.snapshot = ([], np.empty((0, FEATURES)))
+
+    def is_stale(self):
+        return (
+            self.loaded_at is None
+            or self.version != get_version('workouts')
+            or time.monotonic() - self.loaded_at > CATALOG_MAX_AGE
+        )
+
+    def load(self):
+        version = get_version('workouts')
+        workouts = list(DocumentQuery(Workout))
+        self.snapshot = (workouts, workout_vectors(workouts))
+        self.loaded_at = time.monotonic()
+        self.version = version
+
+
+user_profiles = UserProfiles()
+workout_catalog = WorkoutCatalog()
+
+
+def get_recommendations(user_ids, limit=RECOMMENDATION_LIMIT, db=None):
+    """Return the best workouts for each user as [(workout, score)], keyed by user_id
+
+    All users are scored against the whole catalog with one matrix
+    operation.
+    """
+    user_profiles.ensure_loaded(db=db)
+    if workout_catalog.is_stale():
+        workout_catalog.load()
+    workouts, vectors = workout_catalog.snapshot
+    user_ids = [str(user_id) for user_id in user_ids]
+    if not workouts:
+        return {user_id: [] for user_id in user_ids}
+
+    scores = score_workouts(user_profiles.get(user_ids, db=db), vectors)
+    best = np.argsort(-scores, axis=1, kind='stable')[:, :limit]
+    return {
+        user_id: [(workouts[column], round(float(scores[row, column]), 4)) for column in best[row]]
+        for row, user_id in enumerate(user_ids)
+    }
+
+
+def describe_profile(profile):
+    """Render a profile vector for the API"""
+    return {
+        'type_mix': {
+            workout_type: round(float(share), 4) for workout_type, share in zip(WORKOUT_TYPES, profile[:DURATION])
+        },
+        'typical_duration': round(float(profile[DURATION]) * DURATION_SCALE, 1),
+        'intensity': round(float(profile[INTENSITY]), 4),
+    }
@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import re
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .monitoring import timed
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is listed in requirements.txt
+    orjson = None
+
+
+# A float that json writes in exponent notation but orjson does not, or not
+# the same way: orjson writes 1e16 and 0.00001 where json writes 1e+16 and
+# 1e-05. It can also match inside a string; that only costs a fallback.
+_EXPONENT = re.compile(rb'[:,\[]-?(?:\d+(?:\.\d+)?[eE][-+]?\d+|0\.0000\d*)[,\]}]')
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer that encodes with orjson, producing the same bytes
+
+    Compact output is encoded by orjson, with types it does not handle
+    natively (including datetimes, whose format differs) passed to the DRF
+    encoder. Anything orjson rejects, indented output for the browsable API,
+    and documents holding a float in exponent notation go through the
+    stock json-based renderer. Unlike the stock renderer, NaN and infinity
+    are written as null instead of raising.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('render'):
+            return self._dumps(data, accepted_media_type, renderer_context)
+
+    def _dumps(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if orjson is None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS,
+            )
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if _EXPONENT.search(ret):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Same escaping as JSONRenderer, keeping the output a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Render a list as newline-delimited JSON, one object per line"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.render_rows(rows))
+
+    def render_rows(self, rows):
+        json_renderer = FastJSONRenderer()
+        for row in rows:
+            yield json_renderer._dumps(row) + b'\n'
+
+
+class CSVRenderer(BaseRenderer):
+    """Render a list of flat objects as CSV with a header row"""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        if not rows:
+            return b''
+        return ''.join(self.render_rows(rows, list(rows[0]))).encode(self.charset)
+
+    def render_rows(self, rows, fields, header=True):
+        """Yield CSV text for rows, one string per row; None becomes empty"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(fields)
+            yield _take(buffer)
+        for row in rows:
+            writer.writerow([
+                json.dumps(value) if isinstance(value, (dict, list)) else value
+                for value in (row.get(field) for field in fields)
+            ])
+            yield _take(buffer)
+
+
+def _take(buffer):
+    """Return and clear what was written to a StringIO"""
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
@@ -0,0 +1,147 @@
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidId
+
+from .mongo import get_db
+
+
+# Datetimes come back timezone-aware in UTC, as djongo returns them
+CODEC_OPTIONS = CodecOptions(tz_aware=True)
+
+
+def get_field_value(item, name):
+    """Read a field from a model instance or from a raw document"""
+    if isinstance(item, dict):
+        return item.get(name)
+    return getattr(item, name)
+
+
+class DocumentQuery:
+    """Lazily evaluated native find() over the collection of one model
+
+    Supports the subset of the QuerySet API used by the viewsets and by
+    KeysetPagination (filter, order_by, only, slicing, iteration and get), but
+    runs a single pymongo query with a projection instead of going through
+    djongo's SQL translation, and yields plain dicts with every model field
+    present, missing ones set to None. only() narrows the projection, like
+    QuerySet.only, and the dicts then hold just those fields.
+    """
+
+    def __init__(self, model, query=None, ordering=(), fields=None):
+        self.model = model
+        self.query = query or {}
+        self.ordering = tuple(ordering)
+        self.fields = fields or [field.column for field in model._meta.concrete_fields]
+
+    def _clone(self, query=None, ordering=None, fields=None):
+        return DocumentQuery(
+            self.model,
+            self.query if query is None else query,
+            self.ordering if ordering is None else ordering,
+            self.fields if fields is None else fields,
+        )
+
+    def filter(self, query=None, **kwargs):
+        """Return a query narrowed by a Mongo filter and/or field=value pairs"""
+        clauses = [clause for clause in (self.query, query, self._lookup(kwargs)) if clause]
+        if len(clauses) <= 1:
+            return self._clone(query=clauses[0] if clauses else {})
+        return self._clone(query={'$and': clauses})
+
+    def order_by(self, *ordering):
+        return self._clone(ordering=ordering)
+
+    def only(self, *names):
+        """Return a query loading only the named fields and the primary key"""
+        names = set(names) | {self.model._meta.pk.name}
+        return self._clone(fields=[
+            field.column for field in self.model._meta.concrete_fields if field.name in names
+        ])
+
+    def _lookup(self, kwargs):
+        query = {}
+        for name, value in kwargs.items():
+            field = self.model._meta.pk if name == 'pk' else self.model._meta.get_field(name)
+            query[field.column] = field.to_python(value)
+        return query
+
+    def _cursor(self):
+        collection = get_db().get_collection(self.model._meta.db_table, codec_options=CODEC_OPTIONS)
+        cursor = collection.find(self.query, {name: 1 for name in self.fields})
+        if self.ordering:
+            cursor = cursor.sort([
+                (field.lstrip('-'), -1 if field.startswith('-') else 1) for field in self.ordering
+            ])
+        return cursor
+
+    def _document(self, raw):
+        return {name: raw.get(name) for name in self.fields}
+
+    def __iter__(self):
+        return (self._document(raw) for raw in self._cursor())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise TypeError('DocumentQuery does not support slice steps')
+            cursor = self._cursor()
+            start = item.start or 0
+            if start:
+                cursor = cursor.skip(start)
+            if item.stop is not None:
+                if item.stop <= start:
+                    return []
+                cursor = cursor.limit(item.stop - start)
+            return [self._document(raw) for raw in cursor]
+        documents = self[item:item + 1]
+        if not documents:
+            raise IndexError('DocumentQuery index out of range')
+        return documents[0]
+
+    def first(self):
+        documents = self[:1]
+        return documents[0] if documents else None
+
+    def get(self, **kwargs):
+        """Return the single document matching field=value pairs
+
+        Raises the model's DoesNotExist, like QuerySet.get, so DRF's
+        get_object turns a miss or a malformed ObjectId into a 404.
+        """
+        try:
+            documents = self.filter(**kwargs)[:2]
+        except InvalidId:
+            raise self.model.DoesNotExist(f'{self.model.__name__} matching query does not exist.')
+        if not documents:
+            raise self.model.DoesNotExist(f'{self.model.__name__} matching query does not exist.')
+        if len(documents) > 1:
+            raise self.model.MultipleObjectsReturned(f'get() returned more than one {self.model.__name__}')
+        return documents[0]
+
+
+class NativeReadMixin:
+    """Serve the read-only actions of a ModelViewSet from native queries
+
+    Viewsets define get_filters(), returning equality filters taken from
+    the query parameters. list and retrieve get a DocumentQuery yielding
+    plain dicts, projected to get_read_fields() when it is not None; every
+    other action keeps using the djongo queryset, so writes still go
+    through model instances.
+    """
+    native_actions = ('list', 'retrieve')
+
+    def get_filters(self):
+        return {}
+
+    def get_read_fields(self):
+        """Return the model fields list and retrieve must load, or None for all"""
+        return None
+
+    def get_queryset(self):
+        model = self.queryset.model
+        ordering = getattr(self, 'keyset_ordering', ())
+        if self.action in self.native_actions:
+            queryset = DocumentQuery(model).filter(**self.get_filters()).order_by(*ordering)
+            read_fields = self.get_read_fields()
+            return queryset if read_fields is None else queryset.only(*read_fields)
+        return model.objects.filter(**self.get_filters()).order_by(*ordering)
+
@@ -0,0 +1,172 @@
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from pymongo import UpdateOne
+
+from .buckets import rebuild_activity_buckets
+from .cache import bump_version
+from .leaderboard import rebuild_leaderboard
+from .mongo import get_db, id_variants
+from .stats import rebuild_user_activity_stats
+from .teams import rebuild_team_totals
+
+
+# Per activity type: points per minute and per km, and calories burned per
+# minute. Overridden by settings.ACTIVITY_SCORING_RULES.
+DEFAULT_SCORING_RULES = {
+    'Running': {'points_per_minute': 1.0, 'points_per_km': 2.0, 'calories_per_minute': 11},
+    'Cycling': {'points_per_minute': 0.6, 'points_per_km': 0.5, 'calories_per_minute': 8},
+    'Swimming': {'points_per_minute': 1.2, 'points_per_km': 10.0, 'calories_per_minute': 10},
+    'Weightlifting': {'points_per_minute': 0.9, 'points_per_km': 0.0, 'calories_per_minute': 6},
+    'Yoga': {'points_per_minute': 0.6, 'points_per_km': 0.0, 'calories_per_minute': 4},
+    'Boxing': {'points_per_minute': 1.2, 'points_per_km': 0.0, 'calories_per_minute': 12},
+    'CrossFit': {'points_per_minute': 1.3, 'points_per_km': 0.0, 'calories_per_minute': 13},
+}
+
+# Applied to activity types without a rule
+DEFAULT_RULE = {'points_per_minute': 0.8, 'points_per_km': 0.0, 'calories_per_minute': 7}
+
+RECOMPUTE_CHUNK_SIZE = 5000
+
+SCORED_FIELDS = ('type', 'duration', 'distance')
+
+
+class ScoringEngine:
+    """Derive points and calories_burned from type, duration and distance
+
+    points = duration * points_per_minute + distance * points_per_km and
+    calories_burned = duration * calories_per_minute, both rounded half to
+    even. score() handles one activity and score_many() whole arrays with
+    NumPy; they give the same results.
+    """
+
+    def __init__(self, rules, default_rule=DEFAULT_RULE):
+        self.rules = rules
+        self.default_rule = default_rule
+        self.type_rows = {activity_type: row for row, activity_type in enumerate(rules)}
+        table = list(rules.values()) + [default_rule]
+        self.points_per_minute = np.array([rule['points_per_minute'] for rule in table], dtype=float)
+        self.points_per_km = np.array([rule['points_per_km'] for rule in table], dtype=float)
+        self.calories_per_minute = np.array([rule['calories_per_minute'] for rule in table], dtype=float)
+
+    def score(self, activity_type, duration, distance=None):
+        """Return (points, calories_burned) for one activity"""
+        rule = self.rules.get(activity_type, self.default_rule)
+        duration = float(duration or 0)
+        points = duration * rule['points_per_minute'] + float(distance or 0) * rule['points_per_km']
+        return int(round(points)), int(round(duration * rule['calories_per_minute']))
+
+    def score_many(self, types, durations, distances):
+        """Return (points, calories_burned) integer arrays for parallel sequences
+
+        Missing durations and distances count as 0.
+        """
+        rows = np.fromiter(
+            (self.type_rows.get(activity_type, len(self.rules)) for activity_type in types),
+            dtype=np.intp, count=len(types),
+        )
+        durations = np.nan_to_num(np.array(durations, dtype=float))
+        distances = np.nan_to_num(np.array(distances, dtype=float))
+        points = durations * self.points_per_minute[rows] + distances * self.points_per_km[rows]
+        calories = durations * self.calories_per_minute[rows]
+        return np.rint(points).astype(np.int64), np.rint(calories).astype(np.int64)
+
+
+_engine = None
+
+
+def get_engine():
+    """Return the engine for the configured rules, rebuilt when they change"""
+    global _engine
+    rules = getattr(settings, 'ACTIVITY_SCORING_RULES', DEFAULT_SCORING_RULES)
+    if _engine is None or _engine.rules is not rules:
+        _engine = ScoringEngine(rules)
+    return _engine
+
+
+def score_activity(data):
+    """Return the points and calories_burned of an activity as a dict
+
+    data is validated serializer data or an activities document.
+    """
+    points, calories = get_engine().score(data.get('type'), data.get('duration'), data.get('distance'))
+    return {'points': points, 'calories_burned': calories}
+
+
+def _recompute_chunk(chunk, engine, collection, user_deltas, dry_run):
+    """Rescore a chunk of activities, writing only the ones that change"""
+    points, calories = engine.score_many(
+        [activity.get('type') for activity in chunk],
+        [activity.get('duration') for activity in chunk],
+        [activity.get('distance') for activity in chunk],
+    )
+    old_points = np.array([activity.get('points') or 0 for activity in chunk], dtype=np.int64)
+    old_calories = np.array([activity.get('calories_burned') or 0 for activity in chunk], dtype=np.int64)
+    changed = np.flatnonzero((points != old_points) | (calories != old_calories))
+
+    operations = []
+    for position in changed:
+        activity = chunk[position]
+        delta = int(points[position] - old_points[position])
+        if delta:
+            user_deltas[str(activity.get('user_id'))] += delta
+        operations.append(UpdateOne(
+            {'_id': activity['_id']},
+            {'$set': {'points': int(points[position]), 'calories_burned': int(calories[position])}},
+        ))
+    if operations and not dry_run:
+        collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def recompute_points(db=None, chunk_size=RECOMPUTE_CHUNK_SIZE, dry_run=False, progress=None):
+    """Rescore every stored activity with the current rules
+
+    Activities are streamed in chunks of chunk_size, scored with
+    score_many() and written back with one unordered bulk_write per chunk,
+    holding only the activities whose points or calories changed. The
+    point differences are then added to the users' total_points, keeping
+    any points not earned through activities, and the team totals, rollups,
+    buckets and leaderboard are rebuilt from the new values. Writes made
+    while it runs may be counted with either set of rules.
+
+    progress, if given, is called with the number of activities scanned
+    after each chunk. Returns the number of activities scanned and changed
+    and of users whose points changed.
+    """
+    db = db if db is not None else get_db()
+    engine = get_engine()
+    user_deltas = defaultdict(int)
+    scanned = changed = 0
+
+    projection = {'user_id': 1, 'points': 1, 'calories_burned': 1, **dict.fromkeys(SCORED_FIELDS, 1)}
+    chunk = []
+    for activity in db.activities.find({}, projection, batch_size=chunk_size):
+        chunk.append(activity)
+        if len(chunk) >= chunk_size:
+            changed += _recompute_chunk(chunk, engine, db.activities, user_deltas, dry_run)
+            scanned += len(chunk)
+            chunk = []
+            if progress is not None:
+                progress(scanned)
+    if chunk:
+        changed += _recompute_chunk(chunk, engine, db.activities, user_deltas, dry_run)
+        scanned += len(chunk)
+        if progress is not None:
+            progress(scanned)
+
+    user_deltas = {user_id: delta for user_id, delta in user_deltas.items() if delta}
+    if not dry_run and changed:
+        operations = [
+            UpdateOne({'_id': {'$in': id_variants([user_id])}}, {'$inc': {'total_points': delta}})
+            for user_id, delta in user_deltas.items()
+        ]
+        for start in range(0, len(operations), chunk_size):
+            db.users.bulk_write(operations[start:start + chunk_size], ordered=False)
+        bump_version('activities', 'users')
+        rebuild_team_totals(db)
+        rebuild_user_activity_stats(db)
+        rebuild_activity_buckets(db)
+        rebuild_leaderboard(db)
+    return {'scanned': scanned, 'changed': changed, 'users': len(user_deltas)}
@@ -0,0 +1,201 @@
+import bisect
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+
+from rest_framework.exceptions import ValidationError
+
+from .cache import get_version
+from .indexes import WORKOUT_FIELD_WEIGHTS
+from .models import Workout
+from .mongo import get_db
+from .repository import CODEC_OPTIONS
+
+
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# A query word also matches the indexed words it is a prefix of, scored at
+# this fraction of an exact match and expanded to at most this many words
+PREFIX_MATCH_WEIGHT = 0.5
+PREFIX_MAX_EXPANSIONS = 50
+
+# Catalogs larger than this are searched through the text index instead
+WORKOUT_INDEX_MAX_DOCUMENTS = 10000
+
+# Like the leaderboard index, writes made by other processes are picked
+# up only when the index is reloaded
+WORKOUT_INDEX_MAX_AGE = 60
+
+_WORD = re.compile(r'\w+')
+
+
+def parse_search_params(params):
+    """Read q and limit from the query string of a search action"""
+    query = params.get('q', '').strip()
+    if not query:
+        raise ValidationError({'q': 'This parameter is required.'})
+    try:
+        limit = int(params.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        raise ValidationError({'limit': 'Must be an integer'})
+    return query, max(1, min(limit, SEARCH_MAX_LIMIT))
+
+
+def tokenize(text):
+    """Split text into lowercase words"""
+    return _WORD.findall(text.lower()) if text else []
+
+
+def _model_document(model, raw):
+    """Return raw with every field of model present, missing ones None, like DocumentQuery"""
+    return {field.column: raw.get(field.column) for field in model._meta.concrete_fields}
+
+
+def _field_texts(document, path):
+    """Yield the strings at a dotted path, descending into lists"""
+    values = [document]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(part) for item in value if isinstance(item, dict)]
+                next_values.extend(value)
+            elif isinstance(value, dict):
+                next_values.append(value.get(part))
+        values = next_values
+    for value in values:
+        if isinstance(value, list):
+            yield from (item for item in value if isinstance(item, str))
+        elif isinstance(value, str):
+            yield value
+
+
+class WorkoutSearchIndex:
+    """In-memory inverted index over the workout catalog
+
+    Maps every word of the weighted fields to the workouts holding it,
+    and keeps the vocabulary sorted so the words starting with a prefix are
+    a bisect range. All query words must match, the last one also as a
+    prefix, so partial input typed into a search box already finds results.
+    Workouts are ranked by the sum of field weight times idf of their
+    matches.
+    """
+
+    def __init__(self):
+        self.loaded_at = None
+        self.version = None
+        self.available = False
+        self._documents = []
+        self._postings = {}
+        self._terms = []
+        self._lock = threading.Lock()
+
+    def is_stale(self):
+        return (
+            self.loaded_at is None
+            or self.version != get_version('workouts')
+            or time.monotonic() - self.loaded_at > WORKOUT_INDEX_MAX_AGE
+        )
+
+    def load(self, db=None):
+        """Rebuild the index from the workouts collection
+
+        A catalog of more than WORKOUT_INDEX_MAX_DOCUMENTS workouts is not
+        indexed and available is set to False until the next load.
+        """
+        db = db if db is not None else get_db()
+        version = get_version('workouts')
+        collection = db.get_collection('workouts', codec_options=CODEC_OPTIONS)
+        documents = [
+            _model_document(Workout, raw) for raw in collection.find().limit(WORKOUT_INDEX_MAX_DOCUMENTS + 1)
+        ]
+        available = len(documents) <= WORKOUT_INDEX_MAX_DOCUMENTS
+        if not available:
+            documents = []
+
+        postings = defaultdict(dict)
+        for position, document in enumerate(documents):
+            for path, weight in WORKOUT_FIELD_WEIGHTS.items():
+                for text in _field_texts(document, path):
+                    for word in tokenize(text):
+                        postings[word][position] = postings[word].get(position, 0) + weight
+        with self._lock:
+            self._documents = documents
+            self._postings = dict(postings)
+            self._terms = sorted(postings)
+            self.available = available
+            self.loaded_at = time.monotonic()
+            self.version = version
+
+    def __len__(self):
+        return len(self._documents)
+
+    def _matches(self, word, prefix):
+        """Return [(term, factor)] for the indexed words a query word matches"""
+        matches = [(word, 1)] if word in self._postings else []
+        if prefix:
+            start = bisect.bisect_right(self._terms, word)
+            for term in self._terms[start:start + PREFIX_MAX_EXPANSIONS]:
+                if not term.startswith(word):
+                    break
+                matches.append((term, PREFIX_MATCH_WEIGHT))
+        return matches
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return up to limit (document, score) pairs, best first"""
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._lock:
+            total = len(self._documents)
+            scores = None
+            for position, word in enumerate(words):
+                word_scores = {}
+                for term, factor in self._matches(word, prefix=position == len(words) - 1):
+                    documents = self._postings[term]
+                    idf = math.log(1 + total / len(documents))
+                    for document, weight in documents.items():
+                        score = weight * idf * factor
+                        if score > word_scores.get(document, 0):
+                            word_scores[document] = score
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {
+                        document: score + word_scores[document]
+                        for document, score in scores.items() if document in word_scores
+                    }
+                if not scores:
+                    return []
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            return [(self._documents[document], round(score, 4)) for document, score in ranked]
+
+
+_workout_index = WorkoutSearchIndex()
+
+
+def get_workout_index(db=None):
+    """Return the loaded workout index, or None when the catalog is too large"""
+    if _workout_index.is_stale():
+        _workout_index.load(db=db)
+    return _workout_index if _workout_index.available else None
+
+
+def text_search(model, query, filters=None, limit=SEARCH_LIMIT, db=None):
+    """Run a $text query and return up to limit (document, score) pairs, best first
+
+    Uses the text index of the model's collection; equality filters are
+    applied to the text matches.
+    """
+    db = db if db is not None else get_db()
+    collection = db.get_collection(model._meta.db_table, codec_options=CODEC_OPTIONS)
+    cursor = collection.find(
+        {'$text': {'$search': query}, **(filters or {})},
+        {'score': {'$meta': 'textScore'}},
+        sort=[('score', {'$meta': 'textScore'})],
+        limit=limit,
+    )
+    return [(_model_document(model, raw), round(raw['score'], 4)) for raw in cursor]
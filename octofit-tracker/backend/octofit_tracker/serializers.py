@@ -1,5 +1,8 @@
 from rest_framework import serializers
 from .models import User, Team, Activity, Leaderboard, Workout
+from .mongo import get_db
+from .repository import get_field_value
+from .stats import get_leaderboard_stats
 from bson import ObjectId
 
 
@@ -21,44 +24,62 @@ class ObjectIdField(serializers.Field):
 class UserSerializer(serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
     
+    # Model fields read by the method fields, for ?fields= projections
+    method_field_sources = {'id': ('_id',)}
+    
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'name', 'alias', 'team', 'total_points', 'created_at']
     
     def get_id(self, obj):
-        return str(obj._id)
+        return str(get_field_value(obj, '_id'))
 
 
 class TeamSerializer(serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
     captain_id = serializers.CharField()
-    member_ids = serializers.ListField(child=serializers.CharField())
+    # Derived from User.team, see teams.refresh_team_total
+    member_ids = serializers.ListField(child=serializers.CharField(), read_only=True)
     member_count = serializers.SerializerMethodField()
     
+    method_field_sources = {'id': ('_id',), 'member_count': ('member_ids',)}
+    
     class Meta:
         model = Team
         fields = ['id', 'name', 'description', 'captain_id', 'member_ids', 'member_count', 'total_points', 'created_at']
+        # Derived from the members' points, see teams.refresh_team_total
+        read_only_fields = ['total_points']
     
     def get_id(self, obj):
-        return str(obj._id)
+        return str(get_field_value(obj, '_id'))
     
     def get_member_count(self, obj):
         """Return the count of members in the team"""
-        if hasattr(obj, 'member_ids') and obj.member_ids:
-            return len(obj.member_ids)
-        return 0
+        member_ids = get_field_value(obj, 'member_ids')
+        return len(member_ids) if member_ids else 0
+    
+    def validate_name(self, value):
+        """Reject the name of another team: users, activities and buckets refer to teams by name"""
+        team = get_db().teams.find_one({'name': value}, {'_id': 1})
+        if team is not None and (self.instance is None or str(team['_id']) != str(self.instance._id)):
+            raise serializers.ValidationError('A team with this name already exists.')
+        return value
 
 
 class ActivitySerializer(serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
     user_id = serializers.CharField()
     
+    method_field_sources = {'id': ('_id',)}
+    
     class Meta:
         model = Activity
         fields = ['id', 'user_id', 'type', 'duration', 'distance', 'calories_burned', 'points', 'date', 'notes']
+        # Derived from type, duration and distance, see scoring.score_activity
+        read_only_fields = ['calories_burned', 'points']
     
     def get_id(self, obj):
-        return str(obj._id)
+        return str(get_field_value(obj, '_id'))
 
 
 class LeaderboardSerializer(serializers.ModelSerializer):
@@ -72,6 +93,17 @@ class LeaderboardSerializer(serializers.ModelSerializer):
     total_calories = serializers.SerializerMethodField()
     total_points = serializers.SerializerMethodField()
     
+    # Fields computed from the users, teams and activity rollups; the list
+    # view only looks them up when one of them is requested
+    stats_fields = ('user_name', 'team_name', 'activity_count', 'total_duration', 'total_distance',
+                    'total_calories')
+    method_field_sources = {
+        'id': ('_id',),
+        'total_points': ('points',),
+        'user_name': ('type', 'entity_id', 'name'),
+        **dict.fromkeys(stats_fields[1:], ('type', 'entity_id')),
+    }
+    
     class Meta:
         model = Leaderboard
         fields = ['id', 'type', 'entity_id', 'name', 'user_name', 'team_name', 
@@ -79,84 +111,61 @@ class LeaderboardSerializer(serializers.ModelSerializer):
                   'total_distance', 'total_calories', 'updated_at']
     
     def get_id(self, obj):
-        return str(obj._id)
+        return str(get_field_value(obj, '_id'))
+    
+    def _get_entity_stats(self, obj):
+        """Return the precomputed stats for this entry
+
+        The list view passes stats for the whole page in the context; on
+        other paths they are computed for this single entry.
+        """
+        entity_id = get_field_value(obj, 'entity_id')
+        if get_field_value(obj, 'type') != 'individual' or not entity_id:
+            return {}
+        stats = self.context.get('leaderboard_stats')
+        if stats is None:
+            stats = get_leaderboard_stats([obj])
+            self.context['leaderboard_stats'] = stats
+        return stats.get(str(entity_id), {})
     
     def get_user_name(self, obj):
         """Get the user name from the entity_id"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                user = User.objects.filter(_id=obj.entity_id).first()
-                return user.name if user else obj.name
-            except:
-                return obj.name
-        return obj.name
+        return self._get_entity_stats(obj).get('user_name') or get_field_value(obj, 'name')
     
     def get_team_name(self, obj):
         """Get the team name for the user"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                user = User.objects.filter(_id=obj.entity_id).first()
-                if user and user.team:
-                    team = Team.objects.filter(name=user.team).first()
-                    return team.name if team else user.team
-            except:
-                pass
-        return None
+        return self._get_entity_stats(obj).get('team_name')
     
     def get_total_points(self, obj):
         """Return the points field as total_points"""
-        return obj.points
+        return get_field_value(obj, 'points')
     
     def get_activity_count(self, obj):
         """Get the count of activities for this entity"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                return Activity.objects.filter(user_id=str(obj.entity_id)).count()
-            except:
-                pass
-        return 0
+        return self._get_entity_stats(obj).get('activity_count', 0)
     
     def get_total_duration(self, obj):
         """Get the total duration of activities for this entity"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                activities = Activity.objects.filter(user_id=str(obj.entity_id))
-                total = sum(activity.duration for activity in activities)
-                return total
-            except:
-                pass
-        return 0
+        return self._get_entity_stats(obj).get('total_duration', 0)
     
     def get_total_distance(self, obj):
         """Get the total distance of activities for this entity"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                activities = Activity.objects.filter(user_id=str(obj.entity_id))
-                total = sum(activity.distance or 0 for activity in activities)
-                return round(total, 2)
-            except:
-                pass
-        return 0
+        return self._get_entity_stats(obj).get('total_distance', 0)
     
     def get_total_calories(self, obj):
         """Get the total calories burned for this entity"""
-        if obj.type == 'individual' and obj.entity_id:
-            try:
-                activities = Activity.objects.filter(user_id=str(obj.entity_id))
-                total = sum(activity.calories_burned or 0 for activity in activities)
-                return total
-            except:
-                pass
-        return 0
+        return self._get_entity_stats(obj).get('total_calories', 0)
 
 
 class WorkoutSerializer(serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
     exercises = serializers.JSONField()
     
+    method_field_sources = {'id': ('_id',)}
+    
     class Meta:
         model = Workout
         fields = ['id', 'name', 'description', 'type', 'duration', 'difficulty', 'exercises', 'created_at']
     
     def get_id(self, obj):
-        return str(obj._id)
+        return str(get_field_value(obj, '_id'))
@@ -54,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings include the rest of the stack
+    'octofit_tracker.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -66,6 +68,20 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'octofit_tracker.urls'
 
+# Requests slower than this, in milliseconds, are logged with their query
+# shapes; unset, the middleware's SLOW_REQUEST_MS default applies
+if os.environ.get('SLOW_REQUEST_MS'):
+    SLOW_REQUEST_MS = int(os.environ['SLOW_REQUEST_MS'])
+
+# Threads applying the queued rollup, bucket and leaderboard updates of
+# activity writes. JOB_QUEUE_EAGER applies them inline instead, before the
+# response is sent.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_EAGER = os.environ.get('JOB_QUEUE_EAGER') == '1'
+
+# Clients allowed to read /api/_metrics/
+INTERNAL_IPS = ['127.0.0.1', '::1']
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -88,14 +104,29 @@ WSGI_APPLICATION = 'octofit_tracker.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# Comma-separated wire compressors, e.g. 'zstd,zlib'; worth it for remote
+# clusters, not for a local mongod
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS')
+
 DATABASES = {
     'default': {
-        'ENGINE': 'djongo',
+        # djongo, sharing the process-wide MongoClient of octofit_tracker.mongo
+        'ENGINE': 'octofit_tracker.djongo_backend',
         'NAME': 'octofit_db',
         'ENFORCE_SCHEMA': False,
         'CLIENT': {
             'host': 'localhost',
             'port': 27017,
+            # Connection pool, per process: size it for the worker's threads
+            'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+            'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+            'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+            # Fail fast instead of queueing forever when the pool is exhausted
+            'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+            'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+            'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+            **({'compressors': MONGO_COMPRESSORS} if MONGO_COMPRESSORS else {}),
         }
     }
 }
@@ -142,6 +173,16 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Django REST framework
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'octofit_tracker.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
+    'DEFAULT_RENDERER_CLASSES': [
+        'octofit_tracker.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_METHODS = [
@@ -0,0 +1,191 @@
+from .cache import bump_version
+from .mongo import APPLIED_JOBS, bulk_upsert_once, get_db, id_variants
+from .repository import get_field_value
+
+
+USER_ACTIVITY_STATS = 'user_activity_stats'
+
+EMPTY_ACTIVITY_STATS = {
+    'activity_count': 0,
+    'total_duration': 0,
+    'total_distance': 0,
+    'total_calories': 0,
+}
+
+
+def activity_totals(activity):
+    """Return the rollup fields contributed by a single activity
+
+    Accepts an Activity instance or a raw activity document.
+    """
+    if isinstance(activity, dict):
+        get = activity.get
+    else:
+        def get(field):
+            return getattr(activity, field, None)
+    return {
+        'activity_count': 1,
+        'total_duration': get('duration') or 0,
+        'total_distance': get('distance') or 0,
+        'total_calories': get('calories_burned') or 0,
+        'total_points': get('points') or 0,
+    }
+
+
+def activity_snapshot(activity):
+    """Capture what an activity contributes before it is modified"""
+    return {
+        'user_id': str(activity.user_id),
+        'team': activity.team,
+        'date': activity.date,
+        'totals': activity_totals(activity),
+    }
+
+
+def activity_deltas(previous=None, current=None):
+    """Return what an activity write changes in user_activity_stats, keyed by user_id
+
+    previous is the snapshot taken before an update or delete and current
+    is the activity after a create or update. Fields left unchanged are
+    dropped.
+    """
+    deltas = {}
+    if previous is not None:
+        user_deltas = deltas.setdefault(previous['user_id'], {})
+        for field, value in previous['totals'].items():
+            user_deltas[field] = user_deltas.get(field, 0) - value
+    if current is not None:
+        user_deltas = deltas.setdefault(str(current.user_id), {})
+        for field, value in activity_totals(current).items():
+            user_deltas[field] = user_deltas.get(field, 0) + value
+    return {
+        user_id: {field: value for field, value in user_deltas.items() if value}
+        for user_id, user_deltas in deltas.items()
+    }
+
+
+def apply_activity_deltas(deltas, db=None, job_ids=None):
+    """Add per-user deltas to user_activity_stats
+
+    Written with one unordered bulk_write of atomic $inc upserts, so a
+    batch costs one round-trip however many users it holds and concurrent
+    writes never lose counts. job_ids, keyed by user_id, mark the rollups
+    so that a retried job does not add its deltas twice (see
+    bulk_upsert_once). Returns the applied deltas keyed by user_id.
+    """
+    deltas = {user_id: user_deltas for user_id, user_deltas in deltas.items() if user_deltas}
+    if deltas:
+        db = db if db is not None else get_db()
+        job_ids = job_ids or {}
+        bulk_upsert_once(db[USER_ACTIVITY_STATS], [
+            ({'_id': user_id}, {'$inc': user_deltas}, job_ids.get(user_id))
+            for user_id, user_deltas in deltas.items()
+        ])
+        bump_version(USER_ACTIVITY_STATS)
+    return deltas
+
+
+def apply_activity_change(previous=None, current=None, db=None):
+    """Keep user_activity_stats in step with an activity write
+
+    Returns the applied deltas keyed by user_id.
+    """
+    return apply_activity_deltas(activity_deltas(previous, current), db=db)
+
+
+def rebuild_user_activity_stats(db=None):
+    """Recompute user_activity_stats from the activities collection
+
+    The aggregation writes its result with $out, which swaps the collection
+    in atomically once the new rollups are complete.
+    """
+    db = db if db is not None else get_db()
+    db.activities.aggregate([
+        {'$group': {
+            '_id': {'$toString': '$user_id'},
+            'activity_count': {'$sum': 1},
+            'total_duration': {'$sum': {'$ifNull': ['$duration', 0]}},
+            'total_distance': {'$sum': {'$ifNull': ['$distance', 0]}},
+            'total_calories': {'$sum': {'$ifNull': ['$calories_burned', 0]}},
+            'total_points': {'$sum': {'$ifNull': ['$points', 0]}},
+        }},
+        {'$out': USER_ACTIVITY_STATS},
+    ])
+    bump_version(USER_ACTIVITY_STATS)
+    return db[USER_ACTIVITY_STATS].count_documents({})
+
+
+def format_activity_stats(rows):
+    """Key user_activity_stats rows by user_id, with distances rounded"""
+    stats = {}
+    for row in rows:
+        user_id = row.pop('_id')
+        row.pop(APPLIED_JOBS, None)
+        row['total_distance'] = round(row.get('total_distance', 0), 2)
+        stats[user_id] = row
+    return stats
+
+
+def get_user_activity_stats(user_ids, db=None):
+    """Read the activity rollups of many users with a single $in lookup"""
+    db = db if db is not None else get_db()
+    query = {'_id': {'$in': [str(user_id) for user_id in user_ids]}}
+    return format_activity_stats(db[USER_ACTIVITY_STATS].find(query))
+
+
+def leaderboard_user_ids(entries):
+    """Return the user ids behind the individual entries of a leaderboard page"""
+    return [str(get_field_value(entry, 'entity_id')) for entry in entries
+            if get_field_value(entry, 'type') == 'individual' and get_field_value(entry, 'entity_id')]
+
+
+def merge_leaderboard_stats(user_ids, users, teams, activity_stats):
+    """Combine looked-up users, teams and rollups into per-entity stats
+
+    users is keyed by str(_id) and teams by name, as read by
+    get_leaderboard_stats.
+    """
+    stats = {}
+    for user_id in user_ids:
+        user = users.get(user_id)
+        entry_stats = dict(EMPTY_ACTIVITY_STATS)
+        entry_stats.update({
+            field: value for field, value in activity_stats.get(user_id, {}).items()
+            if field in EMPTY_ACTIVITY_STATS
+        })
+        entry_stats['user_name'] = user['name'] if user else None
+        entry_stats['team_name'] = None
+        if user and user.get('team'):
+            team = teams.get(user['team'])
+            entry_stats['team_name'] = team['name'] if team else user['team']
+        stats[user_id] = entry_stats
+    return stats
+
+
+def get_leaderboard_stats(entries):
+    """Compute the per-entity fields of LeaderboardSerializer for many entries
+
+    Entries may be Leaderboard instances or raw documents. Uses one $in
+    lookup on users, one on teams and one on the activity rollups, however
+    many entries are passed in. Returns a dict keyed by str(entity_id).
+    """
+    user_ids = leaderboard_user_ids(entries)
+    if not user_ids:
+        return {}
+
+    db = get_db()
+    users = {
+        str(user['_id']): user
+        for user in db.users.find({'_id': {'$in': id_variants(user_ids)}}, {'name': 1, 'team': 1})
+    }
+
+    team_names = {user['team'] for user in users.values() if user.get('team')}
+    teams = {}
+    if team_names:
+        teams = {
+            team['name']: team
+            for team in db.teams.find({'name': {'$in': list(team_names)}}, {'name': 1})
+        }
+
+    activity_stats = get_user_activity_stats(user_ids, db=db)
+    return merge_leaderboard_stats(user_ids, users, teams, activity_stats)
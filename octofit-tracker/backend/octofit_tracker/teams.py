@@ -0,0 +1,123 @@
+from collections import defaultdict
+
+from pymongo import UpdateMany
+
+from .buckets import ACTIVITY_BUCKETS, TEAM
+from .cache import bump_version
+from .mongo import get_db, id_variants
+
+
+# Fields of each user listed by ?expand=members
+MEMBER_FIELDS = ('username', 'name', 'alias', 'total_points')
+
+# Teams with more members than this are recomputed with an empty member_ids:
+# their ids would not fit in one document. Membership comes from User.team.
+MEMBER_IDS_MAX = 10000
+
+
+def get_team_members(member_ids, db=None):
+    """Read the users behind many teams' member_ids with a single $in lookup
+
+    Returns a dict of member summaries keyed by str(_id); ids that match no
+    user are left out.
+    """
+    member_ids = {str(member_id) for member_id in member_ids if member_id}
+    if not member_ids:
+        return {}
+    db = db if db is not None else get_db()
+    members = {}
+    for user in db.users.find({'_id': {'$in': id_variants(member_ids)}}, dict.fromkeys(MEMBER_FIELDS, 1)):
+        user_id = str(user['_id'])
+        members[user_id] = {'id': user_id, **{field: user.get(field) for field in MEMBER_FIELDS}}
+    return members
+
+
+def move_team_member(user_id, previous_team=None, current_team=None, db=None):
+    """Keep member_ids in step when a user joins, leaves or changes team"""
+    if previous_team == current_team:
+        return
+    db = db if db is not None else get_db()
+    if previous_team:
+        db.teams.update_one({'name': previous_team}, {'$pull': {'member_ids': {'$in': id_variants([user_id])}}})
+    if current_team:
+        db.teams.update_one({'name': current_team}, {'$addToSet': {'member_ids': str(user_id)}})
+    bump_version('teams')
+
+
+def refresh_team_total(team_name, db=None):
+    """Set a team's total_points and member_ids from its members and return the total
+
+    One aggregation over the users index on team, plus one lookup of the
+    member ids when there are any; used when a team is created or renamed,
+    as member changes are applied incrementally.
+    """
+    db = db if db is not None else get_db()
+    totals = list(db.users.aggregate([
+        {'$match': {'team': team_name}},
+        {'$group': {
+            '_id': None,
+            'total_points': {'$sum': {'$ifNull': ['$total_points', 0]}},
+            'member_count': {'$sum': 1},
+        }},
+    ]))
+    total = totals[0]['total_points'] if totals else 0
+    member_ids = []
+    if totals and totals[0]['member_count'] <= MEMBER_IDS_MAX:
+        member_ids = [str(user['_id']) for user in db.users.find({'team': team_name}, {'_id': 1})]
+    db.teams.update_many({'name': team_name}, {'$set': {'total_points': total, 'member_ids': member_ids}})
+    bump_version('teams')
+    return total
+
+
+def rename_team(previous_name, name, db=None):
+    """Move the members, activities and activity buckets of a renamed team to its new name
+
+    They all refer to teams by name, so without this the members would be
+    left in a team that no longer exists.
+    """
+    if previous_name == name:
+        return
+    db = db if db is not None else get_db()
+    db.users.update_many({'team': previous_name}, {'$set': {'team': name}})
+    db.activities.update_many({'team': previous_name}, {'$set': {'team': name}})
+    db[ACTIVITY_BUCKETS].update_many(
+        {'entity_type': TEAM, 'entity_id': previous_name}, {'$set': {'entity_id': name}},
+    )
+    bump_version('users', 'activities', ACTIVITY_BUCKETS)
+
+
+def rebuild_team_totals(db=None):
+    """Recompute total_points and member_ids of every team from the users
+
+    Repairs any drift left by writes from other processes or direct edits.
+    Teams of more than MEMBER_IDS_MAX members get an empty member_ids.
+    Returns the number of teams with at least one member.
+    """
+    db = db if db is not None else get_db()
+    rows = list(db.users.aggregate([
+        {'$match': {'team': {'$nin': [None, '']}}},
+        {'$group': {
+            '_id': '$team',
+            'member_count': {'$sum': 1},
+            'total_points': {'$sum': {'$ifNull': ['$total_points', 0]}},
+        }},
+    ], allowDiskUse=True))
+    listed = [row['_id'] for row in rows if row['member_count'] <= MEMBER_IDS_MAX]
+    member_ids = defaultdict(list)
+    if listed:
+        for user in db.users.find({'team': {'$in': listed}}, {'team': 1}):
+            member_ids[user['team']].append(str(user['_id']))
+    db.teams.bulk_write([
+        UpdateMany(
+            {'name': {'$nin': [row['_id'] for row in rows]}},
+            {'$set': {'member_ids': [], 'total_points': 0}},
+        ),
+    ] + [
+        UpdateMany(
+            {'name': row['_id']},
+            {'$set': {'member_ids': member_ids.get(row['_id'], []), 'total_points': row['total_points']}},
+        )
+        for row in rows
+    ])
+    bump_version('teams')
+    return len(rows)
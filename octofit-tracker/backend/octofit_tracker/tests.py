@@ -1,10 +1,81 @@
-from django.test import TestCase
+from django.contrib import admin
+from django.contrib.auth.models import User as AuthUser
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
+from django.http import HttpResponse
 from django.urls import reverse
 from .models import User, Team, Activity, Leaderboard, Workout
+from .admin import ActivityAdmin, EstimatedCountPaginator, UserAdmin, get_facet_counts
+from .buckets import ACTIVITY_BUCKETS, DAY, TEAM, USER, apply_bucket_changes, get_activity_buckets
+from .cache import bump_version, response_cache
+from .fast_serializers import FastSerializer
+from .indexes import create_indexes
+from .jobs import JobQueue, job_queue
+from .leaderboard import INDIVIDUAL, get_index, rebuild_leaderboard, reset_indexes, update_entry
+from .mongo import get_client, get_db
+from .recommendations import UserProfiles, user_profiles, workout_catalog
+from .middleware import PerformanceMiddleware
+from .monitoring import pool_metrics, record_commands, timed
+from .renderers import FastJSONRenderer
+from .scoring import ScoringEngine, get_engine, recompute_points
+from .serializers import (
+    UserSerializer,
+    TeamSerializer,
+    ActivitySerializer,
+    LeaderboardSerializer,
+    WorkoutSerializer
+)
+from .stats import USER_ACTIVITY_STATS, get_user_activity_stats, rebuild_user_activity_stats
+from .views import WorkoutViewSet
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timezone
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from contextlib import contextmanager
+from itertools import count
+from unittest import mock
+import asyncio
+import json
+import threading
+
+
+# Activity writes apply their derived data inline, so tests read it straight
+# after the request; JobQueueTest runs the queue in the background instead
+_eager_jobs = override_settings(JOB_QUEUE_EAGER=True)
+
+
+def setUpModule():
+    _eager_jobs.enable()
+
+
+def tearDownModule():
+    _eager_jobs.disable()
+
+
+class CleanCollectionsMixin:
+    """Start every test from empty collections
+    
+    The models are unmanaged and djongo has no transactions, so what one
+    test writes is still there for the next. setUp empties the collections
+    and drops the in-memory state built from them.
+    """
+    
+    clean_collections = (
+        'users', 'teams', 'activities', 'leaderboard', 'workouts', USER_ACTIVITY_STATS, ACTIVITY_BUCKETS,
+    )
+    
+    def setUp(self):
+        super().setUp()
+        db = get_db()
+        for collection in self.clean_collections:
+            db[collection].delete_many({})
+        bump_version(*self.clean_collections)
+        response_cache.clear()
+        reset_indexes()
+        user_profiles.reset()
+        workout_catalog.reset()
 
 
 class UserModelTest(TestCase):
@@ -71,10 +142,11 @@ class ActivityModelTest(TestCase):
         self.assertEqual(activity.points, 50)
 
 
-class UserAPITest(APITestCase):
+class UserAPITest(CleanCollectionsMixin, APITestCase):
     """Test cases for User API endpoints"""
     
     def setUp(self):
+        super().setUp()
         self.client = APIClient()
         self.user_url = reverse('user-list')
     
@@ -92,25 +164,171 @@ class UserAPITest(APITestCase):
         self.assertIn('activities', response.data)
         self.assertIn('leaderboard', response.data)
         self.assertIn('workouts', response.data)
+    
+    def test_async_user_detail(self):
+        """Test the async user detail matches the DRF one and expands stats and rank"""
+        response = self.client.post(self.user_url, {
+            'username': 'async_user',
+            'email': 'async@example.com',
+            'name': 'Async User',
+            'total_points': 30
+        }, format='json')
+        user_id = response.data['id']
+        get_db().user_activity_stats.insert_one({'_id': user_id, 'activity_count': 3, 'total_points': 30})
+        
+        expected = self.client.get(reverse('user-detail', args=[user_id])).json()
+        response = self.client.get(reverse('async-user-detail', args=[user_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected)
+        
+        response = self.client.get(reverse('async-user-detail', args=[user_id]), {'expand': 'stats,rank'})
+        self.assertEqual(response.json()['activity_stats']['activity_count'], 3)
+        self.assertEqual(response.json()['rank'], 1)
+        
+        response = self.client.get(reverse('async-user-detail', args=[str(ObjectId())]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_recommended_workouts(self):
+        """Test recommendations follow the user's activities as they are logged"""
+        for name, workout_type, duration, difficulty in [
+            ('Easy Stretch', 'Yoga', 20, 'Beginner'),
+            ('Tempo Intervals', 'Cardio', 45, 'Intermediate'),
+            ('Heavy Lifts', 'Strength', 60, 'Advanced'),
+        ]:
+            Workout.objects.create(name=name, type=workout_type, duration=duration, difficulty=difficulty)
+        user = User.objects.create(username='recommend_me', email='recommend@example.com', name='Recommend Me')
+        url = reverse('user-recommended-workouts', args=[str(user._id)])
+        
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['profile']['intensity'], 0)
+        self.assertEqual(response.data['results'][0]['name'], 'Easy Stretch')
+        
+        for _ in range(3):
+            self.client.post(reverse('activity-list'), {
+                'user_id': str(user._id),
+                'type': 'Running',
+                'duration': 45,
+                'date': '2024-01-01T07:00:00Z'
+            }, format='json')
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(response.data['profile']['type_mix']['Cardio'], 1)
+        self.assertEqual(response.data['profile']['typical_duration'], 45)
+        self.assertEqual([workout['name'] for workout in response.data['results']][0], 'Tempo Intervals')
+        self.assertEqual(len(response.data['results']), 2)
+        
+        response = self.client.get(reverse('user-recommended-workouts', args=[str(ObjectId())]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
-class TeamAPITest(APITestCase):
+class TeamAPITest(CleanCollectionsMixin, APITestCase):
     """Test cases for Team API endpoints"""
     
     def setUp(self):
+        super().setUp()
         self.client = APIClient()
         self.team_url = reverse('team-list')
+        response_cache.clear()
     
     def test_get_teams_list(self):
         """Test retrieving list of teams"""
         response = self.client.get(self.team_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_team_members_and_derived_totals(self):
+        """Test team totals follow member writes and ?expand=members lists them"""
+        response = self.client.post(self.team_url, {
+            'name': 'Team Derived',
+            'captain_id': str(ObjectId()),
+            'member_ids': [],
+            'total_points': 999
+        }, format='json')
+        self.assertEqual(response.data['total_points'], 0)
+        team_id = response.data['id']
+        
+        user_ids = []
+        for index, points in enumerate([10, 25]):
+            response = self.client.post(reverse('user-list'), {
+                'username': f'member{index}',
+                'email': f'member{index}@example.com',
+                'name': f'Member {index}',
+                'team': 'Team Derived',
+                'total_points': points
+            }, format='json')
+            user_ids.append(response.data['id'])
+        self.client.patch(reverse('user-detail', args=[user_ids[0]]), {'total_points': 15}, format='json')
+        
+        response = self.client.get(reverse('team-detail', args=[team_id]), {'expand': 'members'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_points'], 40)
+        self.assertEqual([member['id'] for member in response.data['members']], user_ids)
+        self.assertEqual(response.data['members'][0]['total_points'], 15)
+        
+        response = self.client.get(self.team_url, {'expand': 'members'})
+        teams = {team['name']: team for team in response.data['results']}
+        self.assertEqual(len(teams['Team Derived']['members']), 2)
+        
+        response = self.client.get(self.team_url, {'expand': 'captain'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_team_rename_keeps_members(self):
+        """Test renaming a team moves its members and keeps its total"""
+        response = self.client.post(self.team_url, {
+            'name': 'Team Before',
+            'captain_id': str(ObjectId()),
+            'member_ids': [str(ObjectId())]
+        }, format='json')
+        team_id = response.data['id']
+        self.assertEqual(response.data['member_ids'], [])
+        response = self.client.post(reverse('user-list'), {
+            'username': 'renamed_member',
+            'email': 'renamed.member@example.com',
+            'name': 'Renamed Member',
+            'team': 'Team Before',
+            'total_points': 30
+        }, format='json')
+        user_id = response.data['id']
+        
+        response = self.client.patch(reverse('team-detail', args=[team_id]), {'name': 'Team After'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_points'], 30)
+        response = self.client.get(reverse('team-detail', args=[team_id]), {'expand': 'members'})
+        self.assertEqual([member['id'] for member in response.data['members']], [user_id])
+        self.assertEqual(get_db().users.find_one({'_id': ObjectId(user_id)})['team'], 'Team After')
+    
+    def test_team_names_are_unique(self):
+        """Test a team cannot be created or renamed with the name of another team"""
+        team_ids = []
+        for name in ['Team Taken', 'Team Free']:
+            response = self.client.post(self.team_url, {'name': name, 'captain_id': str(ObjectId())},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            team_ids.append(response.data['id'])
+        self.client.post(reverse('user-list'), {
+            'username': 'taken_member', 'email': 'taken.member@example.com', 'name': 'Taken Member',
+            'team': 'Team Taken', 'total_points': 10
+        }, format='json')
+        
+        response = self.client.post(self.team_url, {'name': 'Team Taken', 'captain_id': str(ObjectId())},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('name', response.data)
+        rename = {'name': 'Team Taken'}
+        response = self.client.patch(reverse('team-detail', args=[team_ids[1]]), rename, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(get_db().users.find_one({'username': 'taken_member'})['team'], 'Team Taken')
+        self.assertEqual(get_db().teams.count_documents({'name': 'Team Taken'}), 1)
+        
+        response = self.client.patch(reverse('team-detail', args=[team_ids[0]]), rename, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_points'], 10)
 
 
-class ActivityAPITest(APITestCase):
+class ActivityAPITest(CleanCollectionsMixin, APITestCase):
     """Test cases for Activity API endpoints"""
     
     def setUp(self):
+        super().setUp()
         self.client = APIClient()
         self.activity_url = reverse('activity-list')
     
@@ -118,14 +336,196 @@ class ActivityAPITest(APITestCase):
         """Test retrieving list of activities"""
         response = self.client.get(self.activity_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_activities_cursor_pagination(self):
+        """Test walking the activity feed page by page with cursors"""
+        user_id = str(ObjectId())
+        get_db().activities.insert_many([
+            {'user_id': user_id, 'type': 'Running', 'duration': 10 + day, 'points': 1,
+             'date': datetime(2024, 1, 1 + day % 3)}
+            for day in range(5)
+        ])
+        
+        seen = []
+        url = self.activity_url + f'?user_id={user_id}&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(activity['id'] for activity in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+    
+    def test_search_activity_notes(self):
+        """Test searching notes through the text index, filtered by user"""
+        create_indexes(get_db().activities)
+        user_id = str(ObjectId())
+        get_db().activities.insert_many([
+            {'user_id': user_id, 'type': 'Running', 'duration': 30, 'date': datetime(2024, 1, 1),
+             'notes': 'Hill repeats in the rain'},
+            {'user_id': user_id, 'type': 'Cycling', 'duration': 60, 'date': datetime(2024, 1, 2),
+             'notes': 'Flat loop around the lake'},
+            {'user_id': str(ObjectId()), 'type': 'Running', 'duration': 20, 'date': datetime(2024, 1, 3),
+             'notes': 'Hill sprints'},
+        ])
+        
+        response = self.client.get(reverse('activity-search'), {'q': 'hill', 'user_id': user_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([activity['notes'] for activity in response.data['results']], ['Hill repeats in the rain'])
+        self.assertGreater(response.data['results'][0]['score'], 0)
+        
+        response = self.client.get(reverse('activity-search'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_invalid_cursor(self):
+        """Test an undecodable cursor is rejected"""
+        response = self.client.get(self.activity_url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_export_activities(self):
+        """Test streaming a user's activities as NDJSON and CSV"""
+        user_id = str(ObjectId())
+        get_db().activities.insert_many([
+            {'user_id': user_id, 'type': 'Running', 'duration': 10 + day, 'distance': None, 'calories_burned': 100,
+             'points': 1,
+             'date': datetime(2024, 1, 1 + day), 'notes': 'Easy, "slow"'}
+            for day in range(4)
+        ] + [{'user_id': str(ObjectId()), 'type': 'Running', 'duration': 5, 'date': datetime(2024, 1, 2)}])
+        export_url = reverse('activity-export')
+        
+        response = self.client.get(export_url, {'user_id': user_id, 'since': '2024-01-02'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['duration'] for row in rows], [11, 12, 13])
+        self.assertEqual(rows[0]['date'], '2024-01-02T00:00:00Z')
+        
+        response = self.client.get(export_url, {'user_id': user_id, 'until': '2024-01-03', 'format': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,type,duration,distance,calories_burned,points,date,notes')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(',10,,100,1,2024-01-01T00:00:00Z,"Easy, ""slow"""'))
+        
+        response = self.client.get(export_url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_bulk_create_activities(self):
+        """Test bulk ingestion reports a result for every item"""
+        user_id = str(ObjectId())
+        activity = {'user_id': user_id, 'type': 'Running', 'duration': 10, 'date': datetime.now().isoformat()}
+        response = self.client.post(reverse('activity-bulk'), [activity, {'type': 'Running'}, activity],
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['created', 'invalid', 'created'])
+        stats = get_user_activity_stats([user_id])[user_id]
+        self.assertEqual(stats['activity_count'], 2)
+        self.assertEqual(stats['total_points'], 20)
+    
+    def test_bulk_create_activities_ndjson(self):
+        """Test bulk ingestion accepts newline-delimited JSON"""
+        line = json.dumps({'user_id': str(ObjectId()), 'type': 'Yoga', 'duration': 20,
+                           'date': datetime.now().isoformat()})
+        response = self.client.post(reverse('activity-bulk'), f'{line}\n{line}\n',
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+    
+    def test_activity_writes_update_user_stats(self):
+        """Test create, update and delete keep user_activity_stats current"""
+        user_id = str(ObjectId())
+        response = self.client.post(self.activity_url, {
+            'user_id': user_id,
+            'type': 'Running',
+            'duration': 30,
+            'distance': 5.0,
+            'date': datetime.now().isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        stats = get_user_activity_stats([user_id])[user_id]
+        self.assertEqual(stats['activity_count'], 1)
+        self.assertEqual(stats['total_points'], 40)
+        
+        detail_url = reverse('activity-detail', args=[response.data['id']])
+        response = self.client.patch(detail_url, {'duration': 45}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = get_user_activity_stats([user_id])[user_id]
+        self.assertEqual(stats['activity_count'], 1)
+        self.assertEqual(stats['total_duration'], 45)
+        self.assertEqual(stats['total_points'], 55)
+        
+        response = self.client.delete(detail_url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        stats = get_user_activity_stats([user_id])[user_id]
+        self.assertEqual(stats['activity_count'], 0)
+        self.assertEqual(stats['total_points'], 0)
+    
+    def test_activity_stats_buckets(self):
+        """Test weekly buckets follow activity writes and are skipped once empty"""
+        user_id = str(ObjectId())
+        created = []
+        for day, minutes in ((1, 10), (3, 20), (9, 5)):
+            response = self.client.post(self.activity_url, {
+                'user_id': user_id,
+                'type': 'Running',
+                'duration': minutes,
+                'date': datetime(2024, 1, day, tzinfo=timezone.utc).isoformat(),
+            }, format='json')
+            created.append(response.data['id'])
+        stats_url = reverse('activity-stats')
+        
+        response = self.client.get(stats_url, {'user_id': user_id, 'granularity': 'week'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(bucket['bucket_start'], bucket['activity_count'], bucket['total_points'])
+             for bucket in response.json()['results']],
+            [('2024-01-01T00:00:00Z', 2, 30), ('2024-01-08T00:00:00Z', 1, 5)],
+        )
+        
+        self.client.delete(reverse('activity-detail', args=[created[2]]))
+        response = self.client.get(stats_url, {'user_id': user_id, 'since': '2024-01-02'})
+        self.assertEqual([bucket['total_points'] for bucket in response.data['results']], [30])
+        
+        response = self.client.get(stats_url, {'user_id': user_id, 'granularity': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_team_buckets_stay_with_the_logging_team(self):
+        """Test an activity is removed from the team it was logged in after its user moves"""
+        user = User.objects.create(
+            username='team_mover', email='team.mover@example.com', name='Team Mover', team='Bucket Team A'
+        )
+        response = self.client.post(self.activity_url, {
+            'user_id': str(user._id),
+            'type': 'Running',
+            'duration': 10,
+            'date': '2024-01-02T08:00:00Z',
+        }, format='json')
+        activity_id = response.data['id']
+        self.client.patch(reverse('user-detail', args=[str(user._id)]), {'team': 'Bucket Team B'}, format='json')
+        
+        self.client.patch(reverse('activity-detail', args=[activity_id]), {'duration': 20}, format='json')
+        stats_url = reverse('activity-stats')
+        response = self.client.get(stats_url, {'team': 'Bucket Team A'})
+        self.assertEqual([bucket['total_points'] for bucket in response.data['results']], [20])
+        
+        self.client.delete(reverse('activity-detail', args=[activity_id]))
+        for team in ['Bucket Team A', 'Bucket Team B']:
+            response = self.client.get(stats_url, {'team': team})
+            self.assertEqual(response.data['results'], [])
+        self.assertEqual(get_db().activity_buckets.count_documents({'activity_count': {'$lt': 0}}), 0)
 
 
-class LeaderboardAPITest(APITestCase):
+class LeaderboardAPITest(CleanCollectionsMixin, APITestCase):
     """Test cases for Leaderboard API endpoints"""
     
     def setUp(self):
+        super().setUp()
         self.client = APIClient()
         self.leaderboard_url = reverse('leaderboard-list')
+        response_cache.clear()
     
     def test_get_leaderboard_list(self):
         """Test retrieving leaderboard"""
@@ -141,16 +541,741 @@ class LeaderboardAPITest(APITestCase):
         """Test retrieving team leaderboard"""
         response = self.client.get(self.leaderboard_url, {'type': 'team'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_leaderboard_stats_are_batched(self):
+        """Test leaderboard rows get their activity stats from one batch"""
+        db = get_db()
+        user_ids = db.users.insert_many([
+            {'name': 'Runner One', 'email': 'one@example.com', 'team': 'Test Team', 'total_points': 20},
+            {'name': 'Runner Two', 'email': 'two@example.com', 'team': 'Test Team', 'total_points': 10},
+        ]).inserted_ids
+        db.teams.insert_one({'name': 'Test Team', 'member_ids': user_ids, 'total_points': 30})
+        db.activities.insert_many([
+            {'user_id': user_ids[0], 'type': 'Running', 'duration': 30, 'distance': 5.0,
+             'calories_burned': 300, 'points': 15, 'date': datetime.now()},
+            {'user_id': str(user_ids[0]), 'type': 'Cycling', 'duration': 20, 'distance': None,
+             'calories_burned': 200, 'points': 5, 'date': datetime.now()},
+        ])
+        rebuild_user_activity_stats()
+        db.leaderboard.insert_many([
+            {'type': 'individual', 'entity_id': user_ids[0], 'name': 'Runner One', 'points': 20,
+             'rank': 1, 'updated_at': datetime.now()},
+            {'type': 'individual', 'entity_id': user_ids[1], 'name': 'Runner Two', 'points': 10,
+             'rank': 2, 'updated_at': datetime.now()},
+        ])
+        
+        response = self.client.get(self.leaderboard_url, {'type': 'individual'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = {row['entity_id']: row for row in response.data['results']}
+        first, second = rows[str(user_ids[0])], rows[str(user_ids[1])]
+        self.assertEqual(first['team_name'], 'Test Team')
+        self.assertEqual(first['activity_count'], 2)
+        self.assertEqual(first['total_duration'], 50)
+        self.assertEqual(first['total_distance'], 5.0)
+        self.assertEqual(first['total_calories'], 500)
+        self.assertEqual(second['activity_count'], 0)
+    
+    def test_leaderboard_sparse_fields(self):
+        """Test ?fields= trims the entries and skips the stats lookups"""
+        get_db().leaderboard.insert_many([
+            {'type': 'individual', 'entity_id': str(ObjectId()), 'name': f'Runner {rank}', 'points': 30 - rank,
+             'rank': rank, 'updated_at': datetime.now()}
+            for rank in (1, 2, 3)
+        ])
+        
+        with mock.patch('octofit_tracker.views.get_leaderboard_stats') as get_stats:
+            response = self.client.get(self.leaderboard_url, {'fields': 'name,points,rank', 'page_size': 2})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['results'], [
+                {'name': 'Runner 1', 'points': 29, 'rank': 1},
+                {'name': 'Runner 2', 'points': 28, 'rank': 2},
+            ])
+            response = self.client.get(response.data['next'])
+            self.assertEqual([entry['rank'] for entry in response.data['results']], [3])
+        get_stats.assert_not_called()
+        
+        response = self.client.get(self.leaderboard_url, {'fields': 'name,calories'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_activity_points_update_ranks(self):
+        """Test logging an activity re-ranks the user and their team"""
+        db = get_db()
+        leader_id, chaser_id = db.users.insert_many([
+            {'name': 'Leader', 'email': 'leader@example.com', 'team': 'Rank Team', 'total_points': 100},
+            {'name': 'Chaser', 'email': 'chaser@example.com', 'team': 'Rank Team', 'total_points': 90},
+        ]).inserted_ids
+        db.teams.insert_one({'name': 'Rank Team', 'member_ids': [leader_id, chaser_id], 'total_points': 190})
+        rebuild_leaderboard()
+        
+        response = self.client.post(reverse('activity-list'), {
+            'user_id': str(chaser_id),
+            'type': 'Running',
+            'duration': 20,
+            'date': datetime.now().isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        chaser = db.leaderboard.find_one({'type': 'individual', 'entity_id': str(chaser_id)})
+        leader = db.leaderboard.find_one({'type': 'individual', 'entity_id': str(leader_id)})
+        self.assertEqual(chaser['points'], 110)
+        self.assertLess(chaser['rank'], leader['rank'])
+        team = db.leaderboard.find_one({'type': 'team', 'name': 'Rank Team'})
+        self.assertEqual(team['points'], 210)
+    
+    def test_rank_top_and_around(self):
+        """Test the in-memory rank, top and around endpoints"""
+        db = get_db()
+        user_ids = db.users.insert_many([
+            {'name': f'Index User {points}', 'email': f'index{points}@example.com', 'total_points': points}
+            for points in (5000, 4000, 3000)
+        ]).inserted_ids
+        rebuild_leaderboard()
+        
+        response = self.client.get(reverse('leaderboard-top'), {'k': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['entity_id'], str(user_ids[0]))
+        
+        response = self.client.get(reverse('leaderboard-rank', args=[str(user_ids[1])]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rank'], 2)
+        
+        response = self.client.get(reverse('leaderboard-around', args=[str(user_ids[1])]), {'window': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['entity_id'] for entry in response.data], [str(user_id) for user_id in user_ids])
+        
+        response = self.client.get(reverse('leaderboard-rank', args=[str(ObjectId())]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_tied_entries_rank_like_the_index(self):
+        """Test entity ids are stored as strings, so ties rank the same in Mongo and in the index"""
+        db = get_db()
+        user_ids = db.users.insert_many([
+            {'name': f'Tied User {n}', 'email': f'tied{n}@example.com', 'total_points': 50} for n in range(4)
+        ]).inserted_ids
+        rebuild_leaderboard()
+        update_entry(INDIVIDUAL, user_ids[0], 'Tied User 0', 40)
+        update_entry(INDIVIDUAL, user_ids[0], 'Tied User 0', 50)
+        update_entry(INDIVIDUAL, ObjectId(), 'Tied Newcomer', 50)
+        
+        entries = list(db.leaderboard.find({'type': INDIVIDUAL}).sort('rank', 1))
+        self.assertTrue(all(isinstance(entry['entity_id'], str) for entry in entries))
+        self.assertEqual([entry['rank'] for entry in entries], list(range(1, len(entries) + 1)))
+        index = get_index(INDIVIDUAL)
+        self.assertEqual([entry['entity_id'] for entry in entries], [entry['entity_id'] for entry in index.top(10)])
 
 
-class WorkoutAPITest(APITestCase):
+class WorkoutAPITest(CleanCollectionsMixin, APITestCase):
     """Test cases for Workout API endpoints"""
     
     def setUp(self):
+        super().setUp()
         self.client = APIClient()
         self.workout_url = reverse('workout-list')
+        response_cache.clear()
     
     def test_get_workouts_list(self):
         """Test retrieving list of workouts"""
         response = self.client.get(self.workout_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_retrieve_workout(self):
+        """Test retrieving a workout and missing or malformed ids"""
+        workout = Workout.objects.create(
+            name='Test Workout',
+            type='HIIT',
+            duration=20,
+            difficulty='Beginner',
+            exercises=[{'name': 'Burpees', 'reps': 10}]
+        )
+        response = self.client.get(reverse('workout-detail', args=[str(workout._id)]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], str(workout._id))
+        self.assertEqual(response.data['exercises'], [{'name': 'Burpees', 'reps': 10}])
+        
+        response = self.client.get(reverse('workout-detail', args=[str(ObjectId())]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('workout-detail', args=['not-an-id']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_search_workouts(self):
+        """Test ranked search over names and exercises, with prefix matching"""
+        Workout.objects.create(name='Squat Challenge', type='Strength', duration=30, difficulty='Beginner',
+                               exercises=[{'name': 'Jump Squats'}])
+        Workout.objects.create(name='Leg Day', type='Strength', duration=45, difficulty='Advanced',
+                               description='Finish with squats', exercises=[{'name': 'Lunges'}])
+        Workout.objects.create(name='Yoga Flow', type='Yoga', duration=30, difficulty='Beginner',
+                               exercises=[{'name': 'Warrior Pose'}])
+        
+        response = self.client.get(reverse('workout-search'), {'q': 'squ'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([workout['name'] for workout in response.data['results']], ['Squat Challenge', 'Leg Day'])
+        
+        response = self.client.get(reverse('workout-search'), {'q': 'strength lun', 'fields': 'name'})
+        self.assertEqual([sorted(workout) for workout in response.data['results']], [['name', 'score']])
+        self.assertEqual(response.data['results'][0]['name'], 'Leg Day')
+        
+        response = self.client.get(reverse('workout-search'), {'q': 'pilates'})
+        self.assertEqual(response.data['results'], [])
+    
+    def test_workouts_list_cache_and_etag(self):
+        """Test repeated reads are cached, revalidate with 304 and expire on writes"""
+        response = self.client.get(self.workout_url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        etag = response['ETag']
+        
+        response = self.client.get(self.workout_url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response['ETag'], etag)
+        
+        response = self.client.get(self.workout_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        
+        self.client.post(self.workout_url, {
+            'name': 'New Workout',
+            'type': 'HIIT',
+            'duration': 15,
+            'difficulty': 'Beginner',
+            'exercises': [],
+        }, format='json')
+        response = self.client.get(self.workout_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['name'], 'New Workout')
+    
+    def test_cached_responses_pass_drf_checks(self):
+        """Test cache hits are still authorized and authenticated users are not served shared entries"""
+        response = self.client.get(self.workout_url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        
+        with mock.patch.object(WorkoutViewSet, 'permission_classes', [IsAuthenticated]):
+            response = self.client.get(self.workout_url)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self.assertNotIn('X-Cache', response)
+            
+            self.client.force_authenticate(user=AuthUser(username='coach'))
+            response = self.client.get(self.workout_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('X-Cache', response)
+            self.client.force_authenticate(user=None)
+
+
+class MongoClientTest(TestCase):
+    """Test cases for the shared MongoClient"""
+    
+    def test_djongo_and_native_queries_share_one_pool(self):
+        """Test djongo uses the process-wide client and checkouts are measured"""
+        self.assertIs(get_db().client, get_client())
+        User.objects.create(username='pooled', email='pooled@example.com', name='Pooled')
+        get_db().users.find_one({'username': 'pooled'})
+        pools = pool_metrics.stats()
+        self.assertGreater(sum(pool['checkouts'] for pool in pools.values()), 0)
+        self.assertTrue(all(pool['in_use'] >= 0 for pool in pools.values()))
+
+
+class MongoCommandBudgetMixin:
+    """assertNumQueries for Mongo, counting the commands seen by the command listener"""
+    
+    # Row counts seeded before each measurement; the last exceeds a page
+    budget_sizes = (1, 10, 60)
+    
+    @contextmanager
+    def assertMongoCommands(self, budget):
+        """Fail when the block issues more than budget Mongo commands"""
+        with record_commands() as commands:
+            yield commands
+        self.assertLessEqual(len(commands), budget, 'Mongo commands over budget:\n' + '\n'.join(
+            f"  {command['command']} {command['collection']}" for command in commands
+        ))
+    
+    def assertFlatMongoCommands(self, budget, seed, request):
+        """Assert request() keeps within budget and costs the same at every dataset size
+        
+        seed(count) adds count rows. Each measurement follows an unmeasured
+        warm-up call and starts with an empty response cache.
+        """
+        counts = {}
+        seeded = 0
+        for size in self.budget_sizes:
+            seed(size - seeded)
+            seeded = size
+            request()
+            response_cache.clear()
+            with self.assertMongoCommands(budget) as commands:
+                response = request()
+            self.assertLess(response.status_code, 400, response.data)
+            counts[size] = len(commands)
+        self.assertEqual(len(set(counts.values())), 1, f'Mongo commands per number of rows: {counts}')
+
+
+class QueryBudgetTest(MongoCommandBudgetMixin, APITestCase):
+    """Database round-trip budgets of the list, retrieve and create paths"""
+    
+    def setUp(self):
+        self.db = get_db()
+        self.sequence = count()
+    
+    def seed_users(self, number, team=None):
+        """Insert users ranked above any user created through the API"""
+        return self.db.users.insert_many([
+            {'username': f'budget{n}', 'email': f'budget{n}@example.com', 'name': f'Budget {n}',
+             'team': team, 'total_points': 1000 + n, 'created_at': datetime.now()}
+            for n in (next(self.sequence) for _ in range(number))
+        ]).inserted_ids
+    
+    def test_user_budgets(self):
+        """Test users cost the same number of commands however many there are"""
+        user_id = str(self.seed_users(1)[0])
+        
+        def create():
+            n = next(self.sequence)
+            return self.client.post(reverse('user-list'), {
+                'username': f'created{n}', 'email': f'created{n}@example.com', 'name': f'Created {n}',
+            }, format='json')
+        
+        self.assertFlatMongoCommands(1, self.seed_users, lambda: self.client.get(reverse('user-list')))
+        self.assertFlatMongoCommands(
+            1, self.seed_users, lambda: self.client.get(reverse('user-detail', args=[user_id])),
+        )
+        self.assertFlatMongoCommands(10, self.seed_users, create)
+    
+    def test_team_budgets(self):
+        """Test teams, with and without their members, cost a fixed number of commands"""
+        def seed(number):
+            for _ in range(number):
+                n = next(self.sequence)
+                self.db.teams.insert_one({
+                    'name': f'Budget Team {n}', 'captain_id': str(ObjectId()), 'total_points': n,
+                    'member_ids': [str(user_id) for user_id in self.seed_users(2, f'Budget Team {n}')],
+                    'created_at': datetime.now(),
+                })
+        seed(1)
+        team_id = str(self.db.teams.find_one()['_id'])
+        
+        def create():
+            return self.client.post(reverse('team-list'), {
+                'name': f'Created Team {next(self.sequence)}', 'captain_id': str(ObjectId()), 'member_ids': [],
+            }, format='json')
+        
+        self.assertFlatMongoCommands(2, seed, lambda: self.client.get(reverse('team-list')))
+        self.assertFlatMongoCommands(3, seed, lambda: self.client.get(reverse('team-list'), {'expand': 'members'}))
+        self.assertFlatMongoCommands(2, seed, lambda: self.client.get(reverse('team-detail', args=[team_id])))
+        self.assertFlatMongoCommands(13, seed, create)
+    
+    def test_activity_budgets(self):
+        """Test activities cost a fixed number of commands, including the rollup updates"""
+        user_id = str(self.seed_users(1)[0])
+        
+        def seed(number):
+            self.db.activities.insert_many([
+                {'user_id': user_id, 'type': 'Running', 'duration': 30, 'points': 5, 'date': datetime.now()}
+                for _ in range(number)
+            ])
+        seed(1)
+        activity_id = str(self.db.activities.find_one()['_id'])
+        
+        def create():
+            return self.client.post(reverse('activity-list'), {
+                'user_id': user_id, 'type': 'Running', 'duration': 30, 'date': datetime.now().isoformat(),
+            }, format='json')
+        
+        self.assertFlatMongoCommands(1, seed, lambda: self.client.get(reverse('activity-list')))
+        self.assertFlatMongoCommands(
+            1, seed, lambda: self.client.get(reverse('activity-detail', args=[activity_id])),
+        )
+        self.assertFlatMongoCommands(12, seed, create)
+    
+    def test_leaderboard_budgets(self):
+        """Test leaderboard stats are looked up once per page, not once per entry"""
+        def seed(number):
+            user_ids = self.seed_users(number, 'Budget Team')
+            self.db.leaderboard.insert_many([
+                {'type': 'individual', 'entity_id': str(user_id), 'name': 'Budget', 'points': 1,
+                 'rank': next(self.sequence), 'updated_at': datetime.now()}
+                for user_id in user_ids
+            ])
+        self.db.teams.insert_one({'name': 'Budget Team', 'captain_id': '', 'member_ids': [], 'total_points': 0})
+        seed(1)
+        entry_id = str(self.db.leaderboard.find_one()['_id'])
+        
+        self.assertFlatMongoCommands(4, seed, lambda: self.client.get(reverse('leaderboard-list')))
+        self.assertFlatMongoCommands(
+            4, seed, lambda: self.client.get(reverse('leaderboard-detail', args=[entry_id])),
+        )
+        self.assertFlatMongoCommands(
+            1, seed, lambda: self.client.get(reverse('leaderboard-list'), {'fields': 'name,points,rank'}),
+        )
+    
+    def test_workout_budgets(self):
+        """Test workouts cost a fixed number of commands"""
+        def seed(number):
+            self.db.workouts.insert_many([
+                {'name': 'Budget Workout', 'type': 'HIIT', 'duration': 20, 'difficulty': 'Beginner',
+                 'exercises': [], 'created_at': datetime.now()}
+                for _ in range(number)
+            ])
+        seed(1)
+        workout_id = str(self.db.workouts.find_one()['_id'])
+        
+        def create():
+            return self.client.post(reverse('workout-list'), {
+                'name': 'Created Workout', 'type': 'HIIT', 'duration': 20, 'difficulty': 'Beginner',
+                'exercises': [],
+            }, format='json')
+        
+        self.assertFlatMongoCommands(1, seed, lambda: self.client.get(reverse('workout-list')))
+        self.assertFlatMongoCommands(
+            1, seed, lambda: self.client.get(reverse('workout-detail', args=[workout_id])),
+        )
+        self.assertFlatMongoCommands(3, seed, create)
+
+
+class PerformanceMiddlewareTest(APITestCase):
+    """Test cases for the per-request instrumentation"""
+    
+    def setUp(self):
+        response_cache.clear()
+    
+    def test_server_timing_and_route_metrics(self):
+        """Test a request reports its Mongo commands and shows up in /api/_metrics/"""
+        response = self.client.get(reverse('workout-list'), {'type': 'Timing'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="[1-9]\d* Mongo commands"')
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('render;dur=', timing)
+        
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        route = response.data['routes']['GET workout-list']
+        self.assertGreaterEqual(route['count'], 1)
+        self.assertGreater(route['max_commands'], 0)
+        self.assertEqual(sum(route['histogram_ms'].values()), route['count'])
+        
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_async_requests_are_timed_apart(self):
+        """Test the middleware stays async and keeps the timings of concurrent requests apart"""
+        async def view(request):
+            with timed(request.GET['phase']):
+                await asyncio.sleep(0.01)
+            return HttpResponse()
+        
+        middleware = PerformanceMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        
+        async def serve():
+            return await asyncio.gather(*[
+                middleware(RequestFactory().get('/', {'phase': phase})) for phase in ('first', 'second')
+            ])
+        
+        first, second = async_to_sync(serve)()
+        self.assertIn('first;dur=', first['Server-Timing'])
+        self.assertNotIn('second;dur=', first['Server-Timing'])
+        self.assertIn('second;dur=', second['Server-Timing'])
+        self.assertNotIn('first;dur=', second['Server-Timing'])
+
+
+class ScalableAdminTest(CleanCollectionsMixin, TestCase):
+    """Test cases for the admin changelists of large collections"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(
+            username='admin_runner', email='admin.runner@example.com', name='Admin Runner', team='Admin Team'
+        )
+        for activity_type in ['Running', 'Running', 'Cycling']:
+            Activity.objects.create(
+                user_id=str(self.user._id), type=activity_type, duration=30, date=datetime.now(timezone.utc)
+            )
+        self.request = RequestFactory().get('/admin/')
+    
+    def test_activity_search_and_facets(self):
+        """Test index-backed search, cached facets and the estimated count"""
+        model_admin = ActivityAdmin(Activity, admin.site)
+        queryset, _ = model_admin.get_search_results(self.request, Activity.objects.all(), str(self.user._id))
+        self.assertEqual(queryset.count(), 3)
+        queryset, _ = model_admin.get_search_results(self.request, Activity.objects.all(), 'Run')
+        self.assertEqual(set(queryset.values_list('type', flat=True)), {'Running'})
+        queryset, _ = model_admin.get_search_results(self.request, Activity.objects.all(), 'Run.*')
+        self.assertEqual(queryset.count(), 0)
+        
+        self.assertEqual(get_facet_counts('activities', 'type'), [('Running', 2), ('Cycling', 1)])
+        with record_commands() as commands:
+            get_facet_counts('activities', 'type')
+        self.assertEqual(commands, [])
+        
+        self.assertEqual(EstimatedCountPaginator(Activity.objects.order_by('-date'), 2).count, 3)
+    
+    def test_user_search(self):
+        """Test users are found by exact email or name prefix"""
+        model_admin = UserAdmin(User, admin.site)
+        for term in ['admin.runner@example.com', 'Admin R']:
+            queryset, _ = model_admin.get_search_results(self.request, User.objects.all(), term)
+            self.assertEqual([user.email for user in queryset], ['admin.runner@example.com'])
+        queryset, _ = model_admin.get_search_results(self.request, User.objects.all(), 'runner')
+        self.assertEqual(queryset.count(), 0)
+
+
+class ScoringTest(TestCase):
+    """Test cases for the activity scoring engine"""
+    
+    def test_score_and_score_many_agree(self):
+        """Test the vectorized scores match the per-activity ones, unknown types included"""
+        engine = ScoringEngine({'Running': {'points_per_minute': 1.5, 'points_per_km': 3, 'calories_per_minute': 10}})
+        types = ['Running', 'Running', 'Juggling', None]
+        durations = [30, 25, 45, None]
+        distances = [5.5, None, 2.0, None]
+        points, calories = engine.score_many(types, durations, distances)
+        self.assertEqual(list(zip(points.tolist(), calories.tolist())),
+                         [engine.score(*activity) for activity in zip(types, durations, distances)])
+        self.assertEqual(engine.score('Running', 30, 5.5), (62, 300))
+    
+    def test_recompute_points(self):
+        """Test rescoring rewrites stale activities and carries the difference to users"""
+        db = get_db()
+        user_id = db.users.insert_one(
+            {'name': 'Rescored', 'email': 'rescored@example.com', 'total_points': 500}
+        ).inserted_id
+        db.activities.insert_many([
+            {'user_id': str(user_id), 'type': 'Yoga', 'duration': 50, 'distance': None,
+             'points': 100, 'calories_burned': 0, 'date': datetime.now()}
+            for _ in range(3)
+        ])
+        
+        rules = {'Yoga': {'points_per_minute': 0.5, 'points_per_km': 0, 'calories_per_minute': 4}}
+        with override_settings(ACTIVITY_SCORING_RULES=rules):
+            self.assertEqual(get_engine().rules, rules)
+            result = recompute_points(chunk_size=2)
+            self.assertEqual(result, {'scanned': 3, 'changed': 3, 'users': 1})
+            self.assertEqual(recompute_points(chunk_size=2)['changed'], 0)
+        
+        self.assertEqual({(activity['points'], activity['calories_burned']) for activity in db.activities.find()},
+                         {(25, 200)})
+        self.assertEqual(db.users.find_one({'_id': user_id})['total_points'], 500 - 3 * 75)
+        self.assertEqual(get_user_activity_stats([user_id])[str(user_id)]['total_points'], 75)
+
+
+class JobQueueTest(APITestCase):
+    """Test cases for the background job queue"""
+    
+    def test_bursts_are_coalesced(self):
+        """Test jobs pending for the same key are merged and applied in one batch"""
+        batches = []
+        queue = JobQueue(coalesce_ms=60000)
+        queue.register('sum', batches.append, lambda pending, payload: pending + payload)
+        with override_settings(JOB_QUEUE_EAGER=False):
+            for key, value in [('a', 1), ('b', 10), ('a', 2), ('a', 3)]:
+                queue.submit('sum', key, value)
+            self.assertEqual(queue.stats()['depth'], 2)
+            self.assertTrue(queue.flush(timeout=10))
+        queue.stop()
+        
+        self.assertEqual(batches, [{'a': 6, 'b': 10}])
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['submitted'], stats['coalesced']), (0, 4, 2))
+        self.assertEqual((stats['processed'], stats['batches'], stats['failed_batches']), (2, 1, 0))
+        self.assertEqual(sum(stats['lag_histogram_ms'].values()), 2)
+    
+    def test_failed_jobs_are_retried_then_dropped(self):
+        """Test a failing job is retried a bounded number of times without stopping the workers"""
+        def handler(batch):
+            if 'bad' in batch:
+                raise ValueError('bad job')
+        
+        queue = JobQueue(batch_size=1, max_attempts=3, retry_delay_ms=1)
+        queue.register('check', handler, lambda pending, payload: payload)
+        with override_settings(JOB_QUEUE_EAGER=False), self.assertLogs('octofit_tracker.jobs', 'ERROR') as logs:
+            queue.submit('check', 'bad', None)
+            queue.submit('check', 'good', None)
+            self.assertTrue(queue.flush(timeout=10))
+        queue.stop()
+        stats = queue.stats()
+        self.assertEqual((stats['processed'], stats['batches'], stats['failed_batches']), (1, 4, 3))
+        self.assertEqual((stats['retried'], stats['dropped']), (2, 1))
+        self.assertIn("Dropped check job 'bad' after 3 attempts", logs.output[-1])
+    
+    def test_failed_jobs_are_merged_into_new_submissions(self):
+        """Test a retried job is merged with what was submitted for its key while it failed"""
+        batches = []
+        submitted = threading.Event()
+        
+        def handler(batch):
+            batches.append(batch)
+            if len(batches) == 1:
+                queue.submit('sum', 'a', 2)
+                submitted.set()
+                raise ConnectionError('transient')
+        
+        queue = JobQueue(retry_delay_ms=1)
+        queue.register('sum', handler, lambda pending, payload: pending + payload)
+        # One worker, so the new submission can't run before the failed job is merged into it
+        logs = self.assertLogs('octofit_tracker.jobs', 'ERROR')
+        with override_settings(JOB_QUEUE_EAGER=False, JOB_WORKERS=1), logs:
+            queue.submit('sum', 'a', 1)
+            self.assertTrue(submitted.wait(timeout=10))
+            self.assertTrue(queue.flush(timeout=10))
+        queue.stop()
+        
+        self.assertEqual(batches, [{'a': 1}, {'a': 3}])
+        stats = queue.stats()
+        self.assertEqual((stats['processed'], stats['retried'], stats['dropped']), (1, 1, 0))
+    
+    def test_activity_writes_are_applied_in_background(self):
+        """Test the rollups and points of activity writes land once the queue is flushed"""
+        user = User.objects.create(
+            username='queued_runner', email='queued.runner@example.com', name='Queued Runner', total_points=0
+        )
+        with override_settings(JOB_QUEUE_EAGER=False):
+            for duration in [10, 20, 30]:
+                response = self.client.post(reverse('activity-list'), {
+                    'user_id': str(user._id), 'type': 'Running', 'duration': duration,
+                    'date': '2024-01-02T08:00:00Z',
+                }, format='json')
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertTrue(job_queue.flush(timeout=10))
+        
+        self.assertEqual(get_db().users.find_one({'_id': user._id})['total_points'], 60)
+        stats = get_user_activity_stats([user._id])[str(user._id)]
+        self.assertEqual((stats['activity_count'], stats['total_points']), (3, 60))
+        self.assertGreaterEqual(job_queue.stats()['processed'], 1)
+    
+    def test_retried_batches_apply_their_changes_once(self):
+        """Test a batch failing after its rollups and points landed credits them once on retry"""
+        Team.objects.create(name='Retry Team', description='Retried batches', total_points=0)
+        user = User.objects.create(
+            username='retried_runner', email='retried.runner@example.com', name='Retried Runner',
+            team='Retry Team', total_points=0
+        )
+        attempts = []
+        
+        def flaky_bucket_changes(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise ConnectionError('transient')
+            return apply_bucket_changes(*args, **kwargs)
+        
+        with override_settings(JOB_QUEUE_EAGER=False), \
+                mock.patch('octofit_tracker.jobs.apply_bucket_changes', flaky_bucket_changes), \
+                self.assertLogs('octofit_tracker.jobs', 'ERROR'):
+            response = self.client.post(reverse('activity-list'), {
+                'user_id': str(user._id), 'type': 'Running', 'duration': 25,
+                'date': '2024-01-02T08:00:00Z',
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertTrue(job_queue.flush(timeout=10))
+        
+        self.assertEqual(len(attempts), 2)
+        db = get_db()
+        self.assertEqual(db.users.find_one({'_id': user._id})['total_points'], 25)
+        self.assertEqual(db.teams.find_one({'name': 'Retry Team'})['total_points'], 25)
+        stats = get_user_activity_stats([user._id])[str(user._id)]
+        self.assertEqual((stats['activity_count'], stats['total_points']), (1, 25))
+        for entity_type, entity_id in [(USER, str(user._id)), (TEAM, 'Retry Team')]:
+            buckets = get_activity_buckets(entity_type, entity_id, DAY)
+            self.assertEqual([(bucket['activity_count'], bucket['total_points']) for bucket in buckets], [(1, 25)])
+        entry = db.leaderboard.find_one({'type': 'individual', 'entity_id': str(user._id)})
+        self.assertEqual(entry['points'], 25)
+
+
+class UserProfilesTest(SimpleTestCase):
+    """Test cases for the in-memory recommendation profiles"""
+    
+    row = {'_id': {'user_id': 'runner', 'type': 'Running'}, 'count': 1, 'duration': 30, 'calories': 330}
+    
+    def test_invalidation_during_load_is_kept(self):
+        """Test a profile invalidated while the activities are read is not stored"""
+        profiles = UserProfiles()
+        db = mock.Mock()
+        
+        def aggregate(pipeline, **kwargs):
+            profiles.invalidate('runner')
+            return [self.row]
+        db.activities.aggregate.side_effect = aggregate
+        
+        profiles.load(db=db)
+        self.assertEqual(len(profiles), 0)
+        profiles.get(['runner'], db=db)
+        self.assertEqual(len(profiles), 0)
+        db.activities.aggregate.side_effect = None
+        db.activities.aggregate.return_value = [self.row]
+        profiles.get(['runner'], db=db)
+        self.assertEqual(len(profiles), 1)
+    
+    def test_concurrent_loads_run_once(self):
+        """Test requests arriving together share a single load"""
+        profiles = UserProfiles()
+        db = mock.Mock()
+        loading = threading.Event()
+        
+        def aggregate(pipeline, **kwargs):
+            loading.wait(1)
+            return [self.row]
+        db.activities.aggregate.side_effect = aggregate
+        
+        threads = [threading.Thread(target=profiles.ensure_loaded, kwargs={'db': db}) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        loading.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.activities.aggregate.call_count, 1)
+        self.assertFalse(profiles.is_stale())
+
+
+class FastSerializerTest(SimpleTestCase):
+    """Test the read-only fast path renders exactly what the serializers do"""
+    
+    def assertSameBytes(self, serializer_class, rows, context=None):
+        expected = JSONRenderer().render(serializer_class(rows, many=True, context=context).data)
+        serializer = FastSerializer(serializer_class(context=context), rows, many=True)
+        self.assertEqual(FastJSONRenderer().render(serializer.data), expected)
+        for row in rows:
+            expected = JSONRenderer().render(serializer_class(row, context=context).data)
+            serializer = FastSerializer(serializer_class(context=context), row)
+            self.assertEqual(FastJSONRenderer().render(serializer.data), expected)
+    
+    def test_documents_and_instances(self):
+        """Test raw documents and model instances give the same bytes"""
+        user_id = ObjectId()
+        date = datetime(2024, 3, 1, 7, 30, 15, 123456, tzinfo=timezone.utc)
+        self.assertSameBytes(UserSerializer, [
+            {'_id': user_id, 'username': 'ironman', 'email': 'tony@stark.com', 'name': 'Tony Stark',
+             'alias': None, 'team': 'Team Marvel', 'total_points': 1500, 'created_at': date},
+            User(username='zoë', email='z@example.com', name='Zoë \u2028 Ünïcode', total_points=0,
+                 created_at=datetime(2024, 3, 1)),
+        ])
+        self.assertSameBytes(TeamSerializer, [
+            Team(name='Team DC', captain_id=str(user_id), member_ids=[str(user_id)], total_points=10,
+                 created_at=date),
+        ])
+        self.assertSameBytes(ActivitySerializer, [
+            {'_id': ObjectId(), 'user_id': user_id, 'type': 'Running', 'duration': 45, 'distance': 7.25,
+             'calories_burned': 500, 'points': 45, 'date': date, 'notes': 'Felt "great"'},
+            {'_id': ObjectId(), 'user_id': str(user_id), 'type': 'Swimming', 'duration': 30, 'distance': 1e-05,
+             'calories_burned': 0, 'points': 0, 'date': date, 'notes': None},
+            {'_id': ObjectId(), 'user_id': str(user_id), 'type': 'Yoga', 'duration': 20, 'distance': None,
+             'calories_burned': 80, 'points': 20, 'date': date, 'notes': None},
+        ])
+        self.assertSameBytes(WorkoutSerializer, [
+            {'_id': ObjectId(), 'name': 'Cardio Blast', 'description': None, 'type': 'Cardio', 'duration': 40,
+             'difficulty': 'Beginner', 'exercises': [{'name': 'Running', 'duration': 20.5}], 'created_at': date},
+        ])
+        self.assertSameBytes(LeaderboardSerializer, [
+            {'_id': ObjectId(), 'type': 'individual', 'entity_id': str(user_id), 'name': 'Tony Stark',
+             'points': 1500, 'rank': 1, 'updated_at': date},
+            {'_id': ObjectId(), 'type': 'team', 'entity_id': str(ObjectId()), 'name': 'Team DC',
+             'points': 10, 'rank': 1, 'updated_at': date},
+        ], context={'leaderboard_stats': {str(user_id): {
+            'activity_count': 2, 'total_duration': 75, 'total_distance': 8.5, 'total_calories': 900,
+            'user_name': 'Tony Stark', 'team_name': 'Team Marvel',
+        }}})
+    
+    def test_tuple_rows(self):
+        """Test tuple rows are read by column name"""
+        columns = ['_id', 'name', 'description', 'type', 'duration', 'difficulty', 'exercises', 'created_at']
+        row = (ObjectId(), 'Stretch', 'Easy', 'Yoga', 15, 'Beginner', [], datetime(2024, 1, 1, tzinfo=timezone.utc))
+        serializer = FastSerializer(WorkoutSerializer(), [row], many=True, columns=columns)
+        self.assertEqual(serializer.data, WorkoutSerializer([dict(zip(columns, row))], many=True).data)
@@ -20,12 +20,14 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 import os
+from . import async_views
 from .views import (
     UserViewSet,
     TeamViewSet,
     ActivityViewSet,
     LeaderboardViewSet,
-    WorkoutViewSet
+    WorkoutViewSet,
+    metrics
 )
 
 
@@ -61,5 +63,10 @@ router.register(r'workouts', WorkoutViewSet, basename='workout')
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', api_root, name='api-root'),
+    path('api/_metrics/', metrics, name='metrics'),
     path('api/', include(router.urls)),
+    # Async read path, for deployments served over ASGI
+    path('api/async/leaderboard/', async_views.leaderboard_list, name='async-leaderboard-list'),
+    path('api/async/activities/', async_views.activity_list, name='async-activity-list'),
+    path('api/async/users/<str:pk>/', async_views.user_detail, name='async-user-detail'),
 ]
@@ -1,4 +1,9 @@
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
 from rest_framework import viewsets, status
+from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from .models import User, Team, Activity, Leaderboard, Workout
 from .serializers import (
@@ -8,9 +13,46 @@ from .serializers import (
     LeaderboardSerializer, 
     WorkoutSerializer
 )
+from .buckets import GRANULARITIES, TEAM, USER, WEEK, get_activity_buckets, get_user_teams
+from .cache import CachedResponseMixin, response_cache
+from .export import export_query, iter_activity_batches, parse_bound, stream_csv, stream_ndjson
+from .fast_serializers import FastReadMixin, FastSerializer
+from .ingest import MAX_BULK_ITEMS, ingest_activities
+from .jobs import job_queue, schedule_activity_change
+from .leaderboard import (
+    INDIVIDUAL,
+    LEADERBOARD_TYPES,
+    apply_team_change,
+    apply_user_change,
+    get_index,
+    user_snapshot
+)
+from .monitoring import pool_metrics, route_metrics, timed
+from .parsers import NDJSONParser
+from .recommendations import (
+    RECOMMENDATION_LIMIT,
+    RECOMMENDATION_MAX_LIMIT,
+    describe_profile,
+    get_recommendations,
+    user_profiles
+)
+from .renderers import CSVRenderer, NDJSONRenderer
+from .repository import NativeReadMixin
+from .scoring import SCORED_FIELDS, score_activity
+from .search import get_workout_index, parse_search_params, text_search
+from .stats import USER_ACTIVITY_STATS, activity_snapshot, get_leaderboard_stats
+from .teams import get_team_members, refresh_team_total, rename_team
+
+
+def search_response(view, matches):
+    """Serialize (document, score) search matches, adding the score to each result"""
+    results = view.get_serializer([document for document, _ in matches], many=True).data
+    for result, (_, score) in zip(results, matches):
+        result['score'] = score
+    return Response({'query': view.request.query_params['q'], 'results': results})
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(FastReadMixin, NativeReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for users
     
@@ -18,29 +60,132 @@ class UserViewSet(viewsets.ModelViewSet):
     """
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    keyset_ordering = ('-total_points', '_id')
+    native_actions = NativeReadMixin.native_actions + ('recommended_workouts',)
     
-    def get_queryset(self):
-        queryset = User.objects.all()
+    def get_filters(self):
+        filters = {}
         team = self.request.query_params.get('team', None)
         if team is not None:
-            queryset = queryset.filter(team=team)
-        return queryset.order_by('-total_points')
+            filters['team'] = team
+        return filters
+    
+    def perform_create(self, serializer):
+        user = serializer.save()
+        apply_user_change(current=user)
+    
+    def perform_update(self, serializer):
+        previous = user_snapshot(serializer.instance)
+        user = serializer.save()
+        apply_user_change(previous=previous, current=user)
+    
+    def perform_destroy(self, instance):
+        previous = user_snapshot(instance)
+        instance.delete()
+        apply_user_change(previous=previous)
+    
+    @action(detail=True, url_path='recommended-workouts')
+    def recommended_workouts(self, request, pk=None):
+        """Recommend workouts matching the user's activity mix, durations and intensity
+        
+        Takes limit (default 5, at most 50). Returns the user's profile and
+        the best scoring workouts of the catalog, best first.
+        """
+        user_id = str(self.get_object()['_id'])
+        try:
+            limit = int(request.query_params.get('limit', RECOMMENDATION_LIMIT))
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer'})
+        matches = get_recommendations([user_id], max(1, min(limit, RECOMMENDATION_MAX_LIMIT)))[user_id]
+        
+        serializer = WorkoutSerializer(context=self.get_serializer_context())
+        results = FastSerializer(serializer, [workout for workout, _ in matches], many=True).data
+        for result, (_, score) in zip(results, matches):
+            result['score'] = score
+        return Response({
+            'user_id': user_id,
+            'profile': describe_profile(user_profiles.get([user_id])[0]),
+            'results': results,
+        })
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(CachedResponseMixin, FastReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for teams
     
-    List all teams, create new team, retrieve, update or delete a team
+    List all teams, create new team, retrieve, update or delete a team.
+    ?expand=members adds the members of each team, read with one query.
     """
     queryset = Team.objects.all()
     serializer_class = TeamSerializer
+    keyset_ordering = ('-total_points', '_id')
+    cache_collections = ('teams', 'users')
+    expansions = ('members',)
     
     def get_queryset(self):
-        return Team.objects.all().order_by('-total_points')
+        queryset = Team.objects.all().order_by('-total_points')
+        read_fields = self.get_read_fields()
+        return queryset if read_fields is None else queryset.only(*read_fields)
+    
+    def get_sparse_fields(self):
+        fields = super().get_sparse_fields()
+        if fields is not None and 'members' in self._get_expand():
+            # _add_members reads the member_ids of the serialized teams
+            return fields | {'member_ids'}
+        return fields
+    
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if 'members' in self._get_expand():
+            self._add_members(response.data['results'] if isinstance(response.data, dict) else response.data)
+        return response
+    
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        if 'members' in self._get_expand():
+            self._add_members([response.data])
+        return response
+    
+    def _get_expand(self):
+        expand = {name for name in self.request.query_params.get('expand', '').split(',') if name}
+        if expand.difference(self.expansions):
+            raise ValidationError({'expand': f'Must be a subset of: {", ".join(self.expansions)}'})
+        return expand
+    
+    def _add_members(self, teams):
+        members = get_team_members(
+            member_id for team in teams for member_id in team.get('member_ids') or []
+        )
+        requested = super().get_sparse_fields()
+        for team in teams:
+            team['members'] = [
+                members[str(member_id)] for member_id in team.get('member_ids') or []
+                if str(member_id) in members
+            ]
+            if requested is not None and 'member_ids' not in requested:
+                del team['member_ids']
+    
+    def perform_create(self, serializer):
+        team = serializer.save()
+        team.total_points = refresh_team_total(team.name)
+        apply_team_change(team=team)
+    
+    def perform_update(self, serializer):
+        previous_name = serializer.instance.name
+        team = serializer.save()
+        rename_team(previous_name, team.name)
+        # The save writes back the total_points it read, which may miss
+        # concurrent member updates
+        team.total_points = refresh_team_total(team.name)
+        apply_team_change(team=team)
+    
+    def perform_destroy(self, instance):
+        team_id = instance._id
+        instance.delete()
+        apply_team_change(team_id=team_id)
 
 
-class ActivityViewSet(viewsets.ModelViewSet):
+class ActivityViewSet(FastReadMixin, NativeReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for activities
     
@@ -48,21 +193,139 @@ class ActivityViewSet(viewsets.ModelViewSet):
     """
     queryset = Activity.objects.all()
     serializer_class = ActivitySerializer
+    keyset_ordering = ('-date', '-_id')
+    fast_actions = FastReadMixin.fast_actions + ('search',)
     
-    def get_queryset(self):
-        queryset = Activity.objects.all()
+    def get_filters(self):
+        filters = {}
         user_id = self.request.query_params.get('user_id', None)
         activity_type = self.request.query_params.get('type', None)
         
         if user_id is not None:
-            queryset = queryset.filter(user_id=user_id)
+            filters['user_id'] = user_id
         if activity_type is not None:
-            queryset = queryset.filter(type=activity_type)
+            filters['type'] = activity_type
+        
+        return filters
+    
+    def perform_create(self, serializer):
+        user_id = str(serializer.validated_data['user_id'])
+        activity = serializer.save(
+            **score_activity(serializer.validated_data), team=get_user_teams([user_id])[user_id],
+        )
+        self._record_change(current=activity)
+    
+    def perform_update(self, serializer):
+        previous = activity_snapshot(serializer.instance)
+        data = {
+            field: serializer.validated_data.get(field, getattr(serializer.instance, field))
+            for field in SCORED_FIELDS
+        }
+        # An activity keeps the team it was logged in, unless it moves to
+        # another user or was stored before teams were recorded
+        user_id = str(serializer.validated_data.get('user_id', previous['user_id']))
+        team = previous['team']
+        if user_id != previous['user_id'] or team is None:
+            team = get_user_teams([user_id])[user_id]
+        activity = serializer.save(**score_activity(data), team=team)
+        self._record_change(previous=previous, current=activity)
+    
+    def perform_destroy(self, instance):
+        previous = activity_snapshot(instance)
+        instance.delete()
+        self._record_change(previous=previous)
+    
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """Create many activities from a JSON array or NDJSON body"""
+        items = request.data
+        if not isinstance(items, list):
+            raise ValidationError({'non_field_errors': ['Expected a list of activities.']})
+        if len(items) > MAX_BULK_ITEMS:
+            raise ValidationError({'non_field_errors': [f'At most {MAX_BULK_ITEMS} activities per request.']})
+        
+        results = ingest_activities(items)
+        created = sum(1 for result in results if result['status'] == 'created')
+        if created == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, status=response_status)
+    
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        """Stream activities as NDJSON or CSV (?format=csv), oldest first
+        
+        Filters: user_id, type, since (inclusive) and until (exclusive), the
+        last two as ISO 8601 dates or datetimes.
+        """
+        params = request.query_params
+        since = parse_bound(params['since'], 'since') if 'since' in params else None
+        until = parse_bound(params['until'], 'until') if 'until' in params else None
+        query = export_query(params.get('user_id'), params.get('type'), since, until)
+        
+        renderer = request.accepted_renderer
+        stream = stream_csv if renderer.format == 'csv' else stream_ndjson
+        response = StreamingHttpResponse(
+            stream(iter_activity_batches(query), renderer),
+            content_type=renderer.media_type,
+        )
+        response['Content-Disposition'] = f'attachment; filename="activities.{renderer.format}"'
+        return response
+    
+    @action(detail=False)
+    def stats(self, request):
+        """Activity totals of a user or a team per day, week or month
+        
+        Takes user_id or team, granularity (default week), and since and
+        until as ISO 8601 dates or datetimes. Read from the pre-aggregated
+        activity_buckets, so the cost depends on the number of buckets, not
+        on the number of activities.
+        """
+        params = request.query_params
+        if ('user_id' in params) == ('team' in params):
+            raise ValidationError({'non_field_errors': ['Pass exactly one of user_id and team.']})
+        granularity = params.get('granularity', WEEK)
+        if granularity not in GRANULARITIES:
+            raise ValidationError({'granularity': f'Must be one of: {", ".join(GRANULARITIES)}'})
+        since = parse_bound(params['since'], 'since') if 'since' in params else None
+        until = parse_bound(params['until'], 'until') if 'until' in params else None
+        
+        entity_type, entity_id = (USER, params['user_id']) if 'user_id' in params else (TEAM, params['team'])
+        return Response({
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'granularity': granularity,
+            'results': get_activity_buckets(entity_type, entity_id, granularity, since, until),
+        })
+    
+    @action(detail=False)
+    def search(self, request):
+        """Search activity notes through the text index, best matches first
         
-        return queryset.order_by('-date')
+        Takes q, limit (default 20, at most 100) and the user_id and type
+        filters of the list.
+        """
+        query, limit = parse_search_params(request.query_params)
+        return search_response(self, text_search(Activity, query, self.get_filters(), limit))
+    
+    def _record_change(self, previous=None, current=None):
+        """Queue the rollup, bucket and leaderboard updates of a write
+        
+        They are applied by the job queue shortly after the response is
+        sent, merged with the other writes of the same user.
+        """
+        for user_id in schedule_activity_change(previous=previous, current=current):
+            user_profiles.invalidate(user_id)
 
 
-class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
+class LeaderboardViewSet(CachedResponseMixin, FastReadMixin, NativeReadMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for leaderboard (read-only)
     
@@ -70,18 +333,78 @@ class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
     """
     queryset = Leaderboard.objects.all()
     serializer_class = LeaderboardSerializer
+    keyset_ordering = ('rank', '_id')
+    cache_collections = ('leaderboard', 'users', 'teams', USER_ACTIVITY_STATS)
     
-    def get_queryset(self):
-        queryset = Leaderboard.objects.all()
+    def get_filters(self):
+        filters = {}
         leaderboard_type = self.request.query_params.get('type', None)
         
         if leaderboard_type is not None:
-            queryset = queryset.filter(type=leaderboard_type)
+            filters['type'] = leaderboard_type
+        
+        return filters
+    
+    def list(self, request, *args, **kwargs):
+        """List leaderboard entries with their stats computed in one batch
+        
+        The stats are skipped when ?fields= names none of them.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        entries = list(queryset if page is None else page)
         
-        return queryset.order_by('rank')
+        context = self.get_serializer_context()
+        fields = self.get_sparse_fields()
+        if fields is None or fields.intersection(LeaderboardSerializer.stats_fields):
+            with timed('stats'):
+                context['leaderboard_stats'] = get_leaderboard_stats(entries)
+        serializer = self.get_serializer(entries, many=True, context=context)
+        
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+    
+    def _get_index(self):
+        leaderboard_type = self.request.query_params.get('type', INDIVIDUAL)
+        if leaderboard_type not in LEADERBOARD_TYPES:
+            raise ValidationError({'type': f'Must be one of: {", ".join(LEADERBOARD_TYPES)}'})
+        return get_index(leaderboard_type)
+    
+    def _get_int_param(self, name, default, maximum):
+        try:
+            value = int(self.request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError({name: 'Must be an integer'})
+        return max(0, min(value, maximum))
+    
+    @action(detail=False)
+    def top(self, request):
+        """Return the k highest ranked entries"""
+        k = self._get_int_param('k', 10, 1000)
+        return Response(self._get_index().top(k))
+    
+    @action(detail=True)
+    def rank(self, request, pk=None):
+        """Return the current rank of an entity, looked up by entity_id"""
+        index = self._get_index()
+        entry = index.rank(pk)
+        if entry is None:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        entry['total'] = len(index)
+        return Response(entry)
+    
+    @action(detail=True)
+    def around(self, request, pk=None):
+        """Return the entries ranked just above and below an entity"""
+        window = self._get_int_param('window', 10, 100)
+        entries = self._get_index().around(pk, window)
+        if entries is None:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(entries)
 
 
-class WorkoutViewSet(viewsets.ModelViewSet):
+class WorkoutViewSet(CachedResponseMixin, FastReadMixin, NativeReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for workouts
     
@@ -89,15 +412,51 @@ class WorkoutViewSet(viewsets.ModelViewSet):
     """
     queryset = Workout.objects.all()
     serializer_class = WorkoutSerializer
+    keyset_ordering = ('-created_at', '-_id')
+    cache_collections = ('workouts',)
+    fast_actions = FastReadMixin.fast_actions + ('search',)
     
-    def get_queryset(self):
-        queryset = Workout.objects.all()
+    def get_filters(self):
+        filters = {}
         workout_type = self.request.query_params.get('type', None)
         difficulty = self.request.query_params.get('difficulty', None)
         
         if workout_type is not None:
-            queryset = queryset.filter(type=workout_type)
+            filters['type'] = workout_type
         if difficulty is not None:
-            queryset = queryset.filter(difficulty=difficulty)
+            filters['difficulty'] = difficulty
         
-        return queryset.order_by('-created_at')
+        return filters
+    
+    @action(detail=False)
+    def search(self, request):
+        """Search workout names, exercises, types and descriptions, best matches first
+        
+        Takes q and limit (default 20, at most 100). The last word of q also
+        matches as a prefix. Answered from the in-memory WorkoutSearchIndex,
+        or from the text index once the catalog outgrows it.
+        """
+        query, limit = parse_search_params(request.query_params)
+        index = get_workout_index()
+        if index is not None:
+            matches = index.search(query, limit)
+        else:
+            matches = text_search(Workout, query, limit=limit)
+        return search_response(self, matches)
+
+
+@api_view(['GET'])
+def metrics(request):
+    """Internal endpoint: per-route latency histograms, Mongo pools, response cache and job queue
+
+    Figures are per process, since the last start or fork. Only served to
+    INTERNAL_IPS.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        raise Http404()
+    return Response({
+        'routes': route_metrics.stats(),
+        'mongo_pools': pool_metrics.stats(),
+        'response_cache': response_cache.stats(),
+        'jobs': job_queue.stats(),
+    })